@@ -1,9 +1,9 @@
-import csv
 import sqlite3
 
 from argparse import ArgumentParser
-from collections import defaultdict
-from helpers import copy_database, get_child_ancestors, get_cumulative_counts, get_curie
+from itertools import chain
+from helpers import copy_database, get_count_map
+from snapshot import get_cumulative_counts, load_child_parents
 
 
 def main():
@@ -17,30 +17,13 @@ def main():
     copy_database(args.db, args.output)
     with sqlite3.connect(args.output) as conn:
         cur = conn.cursor()
-        child_parents = {}
-        with open(args.child_parents, "r") as f:
-            reader = csv.reader(f, delimiter="\t")
-            for row in reader:
-                if row[0] == row[1]:
-                    continue
-                parent = row[1]
-                child_parents[row[0]] = parent
-
-        child_ancestors = defaultdict(set)
-        for child in child_parents.keys():
-            if child not in child_ancestors:
-                child_ancestors[child] = set()
-            get_child_ancestors(child_ancestors, child_parents, child, child)
-
-        count_map = {}
-        with open(args.counts, "r") as f:
-            reader = csv.reader(f, delimiter="\t")
-            next(reader)
-            for row in reader:
-                if row[0] == "NULL":
-                    continue
-                count_map[get_curie(row[0])] = int(row[1])
-        cuml_counts = get_cumulative_counts(count_map, child_ancestors)
+        # Read the whole map once, lookups on a snapshot map are binary searches
+        child_parents = dict(load_child_parents(args.child_parents).items())
+
+        count_map = get_count_map(args.counts, header=True)
+        # Every child and parent gets a count, even when it is 0
+        cuml_counts = dict.fromkeys(chain(child_parents.keys(), child_parents.values()), 0)
+        cuml_counts.update(get_cumulative_counts(child_parents, count_map))
 
         for tax_id, count in cuml_counts.items():
             cur.execute(
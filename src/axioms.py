@@ -0,0 +1,120 @@
+import sqlite3
+
+from argparse import ArgumentParser
+from itertools import groupby
+
+
+# Materialized axiom annotations. NCBITaxon stores the type of each synonym on an owl:Axiom blank
+# node in the stanza of the term:
+#   _:b1 owl:annotatedSource NCBITaxon:9606
+#   _:b1 owl:annotatedProperty oio:hasExactSynonym
+#   _:b1 owl:annotatedTarget "human"
+#   _:b1 oio:hasSynonymType ncbitaxon:common_name
+# The axioms table resolves each annotation on an axiom into one flat row:
+#   axioms(pos, stanza, subject, source, property, target, predicate, object, value, datatype,
+#          language)
+# where subject is the blank node, source/property/target are the annotated triple (target is the
+# object or the value) and the remaining columns are the annotation itself, as in statements. pos
+# is the rowid of the annotation's statements row. Unlike edges and ranks there are no triggers,
+# since one axiom spans several rows: rebuild the table (or the changed stanzas, with
+# update_axioms) after changing the statements.
+# Only the browser reads the table, so it is only built for the databases the browser opens:
+# build/ncbitaxon.db (ingest.py), build/organism-tree.db and the published -plus databases
+# (publish.py). The build stages pair labels with synonym types on statements directly.
+
+AXIOM_PREDICATES = {
+    "rdf:type",
+    "owl:annotatedSource",
+    "owl:annotatedProperty",
+    "owl:annotatedTarget",
+}
+
+
+def get_axiom_rows(cur, stanzas=None):
+    """Get one row of the axioms table for each annotation of each axiom, reading the blank node
+    rows once in (stanza, subject) order.
+
+    :param cur: database connection cursor
+    :param stanzas: name of a table with a stanza column to only read those stanzas, or None to
+        read all of them
+    :return: generator of axioms rows
+    """
+    query = """SELECT rowid, stanza, subject, predicate, object, value, datatype, language
+        FROM statements WHERE subject LIKE '_:%'"""
+    if stanzas:
+        query += f" AND stanza IN (SELECT stanza FROM {stanzas})"
+    cur.execute(query + " ORDER BY stanza, subject, rowid")
+    for _, rows in groupby(cur, key=lambda x: (x[1], x[2])):
+        source = prop = target = None
+        annotations = []
+        for row in rows:
+            predicate = row[3]
+            if predicate == "owl:annotatedSource":
+                source = row[4]
+            elif predicate == "owl:annotatedProperty":
+                prop = row[4]
+            elif predicate == "owl:annotatedTarget":
+                target = row[4] or row[5]
+            elif predicate not in AXIOM_PREDICATES:
+                annotations.append(row)
+        if not source:
+            # Not an axiom (e.g. the label source of an override)
+            continue
+        for pos, stanza, subject, predicate, obj, value, datatype, language in annotations:
+            yield (
+                pos, stanza, subject, source, prop, target, predicate, obj, value, datatype, language
+            )
+
+
+def add_axiom_table(cur):
+    """Create (or rebuild) the axioms table from the statements table.
+
+    :param cur: database connection cursor
+    """
+    cur.execute("DROP TABLE IF EXISTS axioms")
+    cur.execute(
+        """CREATE TABLE axioms (pos INTEGER PRIMARY KEY,
+                                stanza TEXT,
+                                subject TEXT,
+                                source TEXT,
+                                property TEXT,
+                                target TEXT,
+                                predicate TEXT,
+                                object TEXT,
+                                value TEXT,
+                                datatype TEXT,
+                                language TEXT)"""
+    )
+    # Stream the axioms from a second cursor into the new table
+    cur.executemany(
+        "INSERT INTO axioms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        get_axiom_rows(cur.connection.cursor()),
+    )
+    cur.execute("CREATE INDEX idx_axioms_source ON axioms (source, property, predicate, target)")
+
+
+def update_axioms(cur, stanzas):
+    """Rebuild the axioms rows of some stanzas after their statements changed.
+
+    :param cur: database connection cursor
+    :param stanzas: name of a table with a stanza column
+    """
+    cur.execute(f"DELETE FROM axioms WHERE stanza IN (SELECT stanza FROM {stanzas})")
+    cur.executemany(
+        "INSERT INTO axioms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        get_axiom_rows(cur.connection.cursor(), stanzas=stanzas),
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Database to add the axioms table to")
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        add_axiom_table(conn.cursor())
+        conn.execute("ANALYZE")
+
+
+if __name__ == "__main__":
+    main()
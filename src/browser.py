@@ -7,8 +7,11 @@ import sqlite3
 import urllib.parse
 
 from collections import defaultdict
-from gizmos import hiccup, tree, search
+from diff import get_changes
+from gizmos import hiccup, tree
 from jinja2 import Template
+from snapshot import Snapshot
+from typeahead import search
 
 
 # Look for list of database files
@@ -57,6 +60,9 @@ browsers = {
     }
 }
 
+# Link format for the changes to the subtree of a term, given the link to the term
+SUBTREE_HREF = "{href}&changes=subtree"
+
 
 def get_data(treename, cur, prefixes, term_id, stanza):
     ontology_iri, ontology_title = tree.get_ontology(cur, prefixes)
@@ -92,17 +98,17 @@ def get_data(treename, cur, prefixes, term_id, stanza):
                     WHERE predicate = 'rdf:type' AND object = 'rdfs:Datatype'"""
                 )
             else:
-                pred = "rdfs:subPropertyOf"
                 if term_id == "owl:Class":
-                    pred = "rdfs:subClassOf"
+                    parents = "SELECT child FROM edges WHERE parent IS NOT 'owl:Thing'"
+                else:
+                    parents = """SELECT subject FROM statements
+                         WHERE predicate = 'rdfs:subPropertyOf'
+                         AND object IS NOT 'owl:Thing'"""
                 # Select all classes without parents and set them as children of owl:Thing
                 cur.execute(
-                    f"""SELECT DISTINCT subject FROM statements 
-                    WHERE subject NOT IN 
-                        (SELECT subject FROM statements
-                         WHERE predicate = '{pred}'
-                         AND object IS NOT 'owl:Thing')
-                    AND subject IN 
+                    f"""SELECT DISTINCT subject FROM statements
+                    WHERE subject NOT IN ({parents})
+                    AND subject IN
                         (SELECT subject FROM statements 
                          WHERE predicate = 'rdf:type'
                          AND object = '{term_id}' AND subject NOT LIKE '_:%'
@@ -202,8 +208,8 @@ def get_rdfa(treename, cur, prefixes, data, href, stanza, term_id):
     subject_label = None
     if term_id == "ontology" and ontology_iri:
         cur.execute(
-            f"""SELECT * FROM statements
-            WHERE subject = '{ontology_iri}'"""
+            f"""SELECT stanza, subject, predicate, object, value, datatype, language
+            FROM statements WHERE subject = '{ontology_iri}'"""
         )
         stanza = cur.fetchall()
         subject = ontology_iri
@@ -266,87 +272,22 @@ def clean_value(value):
 
 
 def get_annotations(treename, cur, prefixes, data, href, term_id, stanza):
-    # The subjects in the stanza that are of type owl:Axiom:
-    annotation_bnodes = set()
-    for row in stanza:
-        if row["predicate"] == "owl:annotatedSource":
-            annotation_bnodes.add(row["subject"])
-
-    annotations = defaultdict(dict)
-    for row in stanza:
-        # subject is the blank node, _:...
-        subject = row["subject"]
-        if subject not in annotation_bnodes:
-            continue
-
-        if subject not in annotations:
-            annotations[subject] = {}
-
-        predicate = row["predicate"]
-        obj = row["object"]
-        value = row["value"]
-
-        if predicate not in [
-            "owl:annotatedSource",
-            "owl:annotatedTarget",
-            "owl:annotatedProperty",
-            "rdf:type",
-        ]:
-            # This is the actual axiom that we care about and contains display value
-            annotations[subject]["predicate"] = predicate
-            if obj:
-                annotations[subject]["object"] = obj
-            if value:
-                annotations[subject]["value"] = value
-            annotations[subject]["annotation"] = row
-
-        if predicate == "owl:annotatedSource":
-            annotations[subject]["source"] = obj
-
-        elif predicate == "owl:annotatedProperty":
-            annotations[subject]["target_predicate"] = obj
-
-        elif predicate == "owl:annotatedTarget":
-            if obj:
-                annotations[subject]["target_object"] = obj
-            if value:
-                annotations[subject]["target_value"] = value
-
+    # Axiom annotations on the statements of this term, from the axioms table (see axioms.py):
+    # source -> annotated predicate -> annotated target -> annotation predicate -> rows
     spv2annotation = {}
-    for bnode, details in annotations.items():
-        source = details["source"]
-        target_predicate = details["target_predicate"]
-        target = details.get("target_object", None) or details.get("target_value", None)
-
-        if source in spv2annotation:
-            # list of predicate -> values on this target (combo of predicate + value)
-            pred2val = spv2annotation[source]
-        else:
-            pred2val = {}
-
-        if target_predicate in pred2val:
-            annotated_values = pred2val[target_predicate]
-        else:
-            annotated_values = {}
-
-        if target in annotated_values:
-            ax_annotations = annotated_values[target]
-        else:
-            ax_annotations = {}
-
-        # predicate of the annotation
-        ann_predicate = details["predicate"]
-        if ann_predicate in ax_annotations:
-            # values of the annotation
-            anns = ax_annotations[ann_predicate]
-        else:
-            anns = []
-        anns.append(details["annotation"])
-
-        ax_annotations[ann_predicate] = anns
-        annotated_values[target] = ax_annotations
-        pred2val[target_predicate] = annotated_values
-        spv2annotation[source] = pred2val
+    cur.execute(
+        """SELECT stanza, subject, source, property, target, predicate, object, value, datatype,
+        language FROM axioms WHERE source = ? ORDER BY pos""",
+        (term_id,),
+    )
+    for row in cur.fetchall():
+        annotation = {
+            k: row[k]
+            for k in ["stanza", "subject", "predicate", "object", "value", "datatype", "language"]
+        }
+        spv2annotation.setdefault(row["source"], {}).setdefault(row["property"], {}).setdefault(
+            row["target"], {}
+        ).setdefault(row["predicate"], []).append(annotation)
 
     # s2 maps the predicates of the given term to their corresponding rows (there can be more than
     # one row per predicate):
@@ -426,6 +367,182 @@ def build_annotations(annotations, predicate_labels):
     return html
 
 
+def build_counts(dbs, term):
+    """Build an HTML table of the rank and epitope counts of a term in each stage, using the tree
+    snapshots of the stages.
+
+    :param dbs: list of browser databases
+    :param term: term ID
+    :return: HTML string
+    """
+    rows = []
+    for db in dbs:
+        # Browser databases with counts use the snapshot of the stage they were built from
+        path = f"../build/{re.sub(r'-plus$', '', db)}.snap"
+        if not os.path.exists(path):
+            continue
+        with Snapshot(path) as snapshot:
+            if snapshot.get_index(term) is None:
+                continue
+            rows.append(
+                (
+                    db,
+                    snapshot.get_rank(term) or "",
+                    snapshot.get_count(term),
+                    snapshot.get_cumulative_count(term),
+                    len(snapshot.get_children(term)),
+                )
+            )
+    if not rows:
+        return ""
+    html = f"<h4>Counts for {term}</h4>"
+    html += '<table class="table table-sm"><thead><th>Database</th><th>Rank</th>'
+    html += "<th>Epitopes</th><th>Epitopes in Subtree</th><th>Children</th></thead><tbody>"
+    for db, rank, count, cuml_count, child_count in rows:
+        html += f"<tr><td>{db}</td><td>{rank}</td><td>{count}</td><td>{cuml_count}</td>"
+        html += f"<td>{child_count}</td></tr>"
+    html += "</tbody></table>"
+    return html
+
+
+def build_changes(dbs, term, href, subtree=False, subtree_href=SUBTREE_HREF):
+    """Build an HTML table of the changes made to a term (or its subtree) by each stage, using the
+    precomputed tree diff.
+
+    :param dbs: list of browser databases
+    :param term: term ID
+    :param href: link format for terms
+    :param subtree: if True, include changes to all descendants of the term
+    :param subtree_href: link format for the subtree changes of the term, or None for no link
+    :return: HTML string
+    """
+    if not os.path.exists("../build/tree-diff.db"):
+        return ""
+    rows = []
+    with sqlite3.connect("../build/tree-diff.db") as conn:
+        cur = conn.cursor()
+        for db in dbs:
+            # Browser databases with counts are diffed using the stage they were built from
+            target = re.sub(r"-plus$", "", db)
+            rows.extend(get_changes(cur, target, term, subtree=subtree))
+
+    def link(curie):
+        if not curie:
+            return ""
+        return f'<a href="{href.format(curie=curie)}">{curie}</a>'
+
+    if subtree:
+        html = f'<h4>Changes under {term}</h4>'
+    elif subtree_href:
+        link_href = subtree_href.format(href=href.format(curie=term))
+        html = f'<h4>Changes to {term} '
+        html += f'<small><a href="{link_href}">(show subtree)</a></small></h4>'
+    else:
+        html = f"<h4>Changes to {term}</h4>"
+    if not rows:
+        return html + "<p>No changes</p>"
+    html += '<table class="table table-sm"><thead><th>Stage</th><th>Term</th><th>Change</th>'
+    html += "<th>Old Parent</th><th>New Parent</th><th>Old Label</th><th>New Label</th></thead>"
+    html += "<tbody>"
+    for source, target, tid, change, old_parent, new_parent, old_label, new_label, _ in rows:
+        html += f"<tr><td>{source} &rarr; {target}</td><td>{link(tid)}</td><td>{change}</td>"
+        html += f"<td>{link(old_parent)}</td><td>{link(new_parent)}</td>"
+        html += f"<td>{old_label or ''}</td><td>{new_label or ''}</td></tr>"
+    html += "</tbody></table>"
+    return html
+
+
+def get_prefixes(cur):
+    """Get the (prefix, base) pairs of a database, longest base first."""
+    cur.execute("SELECT * FROM prefix ORDER BY length(base) DESC")
+    return [(x["prefix"], x["base"]) for x in cur.fetchall()]
+
+
+def render_page(
+    template,
+    dbs,
+    conns,
+    prefixes,
+    term,
+    href,
+    subtree=False,
+    subtree_href=SUBTREE_HREF,
+    search_index=None,
+):
+    """Render the browser page of a term, with one tree column per database.
+
+    :param template: Jinja template of the page
+    :param dbs: list of browser databases
+    :param conns: map of database -> connection (with tree.dict_factory rows)
+    :param prefixes: map of database -> (prefix, base) pairs
+    :param term: term ID
+    :param href: link format for terms
+    :param subtree: if True, show the changes to all descendants of the term
+    :param subtree_href: link format for the subtree changes of the term, or None for no link
+    :param search_index: URL of a static search index for the typeahead (see static.py), or None
+        to search with browser.py
+    :return: HTML string
+    """
+    annotations = {}
+    predicate_labels = {}
+
+    trees = []
+    for db in dbs:
+        cur = conns[db].cursor()
+        all_prefixes = prefixes[db]
+        try:
+            if term == "owl:Class":
+                stanza = []
+            else:
+                cur.execute(
+                    """SELECT stanza, subject, predicate, object, value, datatype, language
+                    FROM statements WHERE stanza = ?""",
+                    (term,),
+                )
+                stanza = cur.fetchall()
+
+            if term != "owl:Class" and not stanza:
+                trees.append(f"<div><h2>{db}</h2><p>Term not found</p></div>")
+                continue
+
+            data = get_data(db, cur, all_prefixes, term, stanza)
+            trees.append(get_tree_html(db, cur, all_prefixes, data, href, term, stanza))
+            if term and term not in top_levels:
+                predicate_values, cur_predicate_labels = get_annotations(
+                    db, cur, all_prefixes, data, href, term, stanza
+                )
+                annotations[db] = predicate_values
+                for predicate, label in cur_predicate_labels.items():
+                    if predicate in predicate_labels:
+                        if predicate_labels[predicate] == predicate and predicate != label:
+                            predicate_labels[predicate] = label
+                    else:
+                        predicate_labels[predicate] = label
+
+        except Exception as e:
+            raise Exception("Error when generating HTML for " + db + ":<br>" + str(e)) from e
+
+    if annotations:
+        ann_html = build_annotations(annotations, predicate_labels)
+    else:
+        ann_html = ""
+
+    counts_html = ""
+    changes_html = ""
+    if term not in top_levels:
+        counts_html = build_counts(dbs, term)
+        changes_html = build_changes(dbs, term, href, subtree=subtree, subtree_href=subtree_href)
+
+    return template.render(
+        trees=trees,
+        title="test",
+        annotations=ann_html,
+        counts=counts_html,
+        changes=changes_html,
+        search_index=search_index,
+    )
+
+
 def main():
     if "QUERY_STRING" in os.environ:
         args = dict(urllib.parse.parse_qsl(os.environ["QUERY_STRING"]))
@@ -444,24 +561,13 @@ def main():
     dbs = args["dbs"].split(",")
 
     if "format" in args and args["format"] == "json":
-        if not args.get("text"):
-            print("Content-Type: application/json")
-            print("")
-            print(json.dumps([]))
-            return
-        # Search text in each database
-        json_list = []
-        search_text = urllib.parse.unquote(args["text"])
-        for db in dbs:
-            json_list.extend(json.loads(search.search(f"../build/{db}.db", search_text)))
-        # Sort alphabetically by length & name and take the first 20 results
-        json_list = sorted(json_list, key=lambda i: i["label"])
-        json_list = sorted(json_list, key=lambda i: (-len(i["label"]), i["label"]))[
-          :20
-        ]
+        # The page typeahead calls typeahead.py directly, without the imports above
+        results = []
+        if args.get("text"):
+            results = search(dbs, urllib.parse.unquote(args["text"]))
         print("Content-Type: application/json")
         print("")
-        print(json.dumps(json_list))
+        print(json.dumps(results))
         return
 
     term = "owl:Class"
@@ -470,58 +576,30 @@ def main():
 
     href = "?dbs=" + args["dbs"] + "&id={curie}"
 
-    annotations = {}
-    predicate_labels = {}
-
-    trees = []
+    conns = {}
+    prefixes = {}
     for db in dbs:
-        with sqlite3.connect(f"../build/{db}.db") as conn:
-            conn.row_factory = tree.dict_factory
-            cur = conn.cursor()
-            # Get prefixes
-            cur.execute("SELECT * FROM prefix ORDER BY length(base) DESC")
-            all_prefixes = [(x["prefix"], x["base"]) for x in cur.fetchall()]
-            try:
-                if term == "owl:Class":
-                    stanza = []
-                else:
-                    cur.execute(f"SELECT * FROM statements WHERE stanza = '{term}'")
-                    stanza = cur.fetchall()
-
-                if term != "owl:Class" and not stanza:
-                    trees.append(f"<div><h2>{db}</h2><p>Term not found</p></div>")
-                    continue
-
-                data = get_data(db, cur, all_prefixes, term, stanza)
-                trees.append(get_tree_html(db, cur, all_prefixes, data, href, term, stanza))
-                if term and term not in top_levels:
-                    predicate_values, cur_predicate_labels = get_annotations(
-                        db, cur, all_prefixes, data, href, term, stanza
-                    )
-                    annotations[db] = predicate_values
-                    for predicate, label in cur_predicate_labels.items():
-                        if predicate in predicate_labels:
-                            if predicate_labels[predicate] == predicate and predicate != label:
-                                predicate_labels[predicate] = label
-                        else:
-                            predicate_labels[predicate] = label
-
-            except Exception as e:
-                print("Content-Type: text/html")
-                print("")
-                print("Error when generating HTML for " + db + ":<br>" + str(e))
-                return
+        conn = sqlite3.connect(f"../build/{db}.db")
+        conn.row_factory = tree.dict_factory
+        conns[db] = conn
+        prefixes[db] = get_prefixes(conn.cursor())
 
     # Load Jinja template with CSS & JS and left & right trees
     with open("index.html.jinja2", "r") as f:
         t = Template(f.read())
 
-    if annotations:
-        ann_html = build_annotations(annotations, predicate_labels)
-    else:
-        ann_html = ""
-
-    html = t.render(trees=trees, title="test", annotations=ann_html)
+    try:
+        html = render_page(
+            t, dbs, conns, prefixes, term, href, subtree=args.get("changes") == "subtree"
+        )
+    except Exception as e:
+        print("Content-Type: text/html")
+        print("")
+        print(str(e))
+        return
+    finally:
+        for conn in conns.values():
+            conn.close()
 
     # Return with CGI headers
     print("Content-Type: text/html")
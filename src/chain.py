@@ -0,0 +1,196 @@
+import csv
+import importlib
+import json
+import os
+import sqlite3
+import sys
+
+from argparse import ArgumentParser
+from check import check, get_required
+from engine import organize as organize_tree
+from helpers import get_count_map, get_curie
+from organize import get_top_level
+from override import clean, override
+from prune2 import prune_tree
+from publish import publish
+from rehome import rehome_and_clean
+from snapshot import write_snapshot
+from taxtree import Tree
+from trim import trim
+
+get_labels = importlib.import_module("get-labels")
+
+
+# Run the "Old Tasks" stages (trim -> override -> organize -> prune -> rehome) in one process.
+# The stages work on one in-memory working database and, from override on, one in-memory Tree.
+# After each stage the tree changes are written to the working database, which is then copied
+# page by page (SQLite backup) to build/ncbi-{stage}.db. The stage's snapshot and browser
+# database (build/ncbi-{stage}.snap & build/ncbi-{stage}-plus.db) are written from the same
+# state, so nothing is re-read or rebuilt between stages.
+
+STAGES = ["trimmed", "override", "organized", "pruned", "rehomed"]
+
+
+def add_counts(cur, cuml_counts):
+    """Add the cumulative epitope counts to the labels, the same as add-counts.py.
+
+    :param cur: database connection cursor
+    :param cuml_counts: map of ID -> cumulative epitope count
+    """
+    cur.executemany(
+        """UPDATE statements SET value = value || ' (' || ? || ')'
+        WHERE stanza = ? AND subject = ? AND predicate = 'rdfs:label'""",
+        [(count, tax_id, tax_id) for tax_id, count in cuml_counts.items()],
+    )
+
+
+def copy_to(conn, path):
+    """Copy the working database to a new file."""
+    if os.path.exists(path):
+        os.remove(path)
+    target = sqlite3.connect(path)
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
+
+
+def save_stage(conn, tree, counts, prefix, normalized=False):
+    """Write the stage database, snapshot and browser database for the current state.
+
+    :param conn: working database connection, with the tree changes written
+    :param tree: Tree of the stage
+    :param counts: map of ID -> epitope count
+    :param prefix: output path prefix, e.g. build/ncbi-trimmed
+    :param normalized: if True, publish the browser database with integer term IDs
+    """
+    conn.commit()
+    copy_to(conn, prefix + ".db")
+    write_snapshot(prefix + ".snap", tree, counts)
+
+    plus = prefix + "-plus.db"
+    build = plus + ".build"
+    copy_to(conn, build)
+    try:
+        with sqlite3.connect(build) as plus_conn:
+            add_counts(plus_conn.cursor(), tree.get_cumulative_counts(counts))
+        plus_conn.close()
+        publish(build, plus, normalized=normalized)
+    finally:
+        os.remove(build)
+
+
+def check_stage(tree, required, prefix):
+    """Check the invariants of a stage (see check.py), write the report to {prefix}-check.json
+    and stop if any check fails. This runs before the stage is saved, so a failing stage leaves
+    no stage outputs (any from an earlier run are removed).
+    """
+    results, warnings = check(tree, required)
+    ok = all(x["ok"] for x in results.values())
+    with open(prefix + "-check.json", "w") as f:
+        report = {"db": prefix + ".db", "ok": ok, "checks": results, "warnings": warnings}
+        json.dump(report, f, indent=2)
+    if not ok:
+        failed = [name for name, result in results.items() if not result["ok"]]
+        print(f"{prefix}.db failed checks: {', '.join(failed)}", file=sys.stderr)
+        for path in [prefix + ".db", prefix + ".snap", prefix + "-plus.db"]:
+            if os.path.exists(path):
+                os.remove(path)
+        sys.exit(1)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("prefixes", help="SQL to create the prefix table")
+    parser.add_argument("ncbitaxon", help="NCBITaxon database")
+    parser.add_argument("active_taxa", help="Active tax IDs used in IEDB")
+    parser.add_argument("iedb_taxa", help="IEDB custom taxa")
+    parser.add_argument("ncbi_taxa", help="LJI SoT ncbi_taxa sheet with preferred labels")
+    parser.add_argument("taxon_parents", help="Parent taxa overrides")
+    parser.add_argument("precious", help="List of taxa to keep")
+    parser.add_argument("counts", help="TSV containing ID -> epitope count")
+    parser.add_argument("top_level", help="Stable top level")
+    parser.add_argument("output", help="Directory to write the stage databases to")
+    parser.add_argument(
+        "--normalize", action="store_true", help="Publish browser databases with integer term IDs"
+    )
+    parser.add_argument(
+        "--check", action="store_true", help="Stop at the first stage that fails check.py"
+    )
+    parser.add_argument("--label-cache", help="Best label cache database to reuse and update")
+    args = parser.parse_args()
+
+    precious = []
+    with open(args.precious, "r") as f:
+        reader = csv.reader(f, delimiter="\t")
+        for row in reader:
+            precious.append(get_curie(row[0]))
+
+    counts = get_count_map(args.counts, header=True)
+
+    top_level = get_top_level(args.top_level)
+    prefixes = {stage: os.path.join(args.output, f"ncbi-{stage}") for stage in STAGES}
+
+    conn = sqlite3.connect(":memory:")
+    with open(args.prefixes, "r") as f:
+        conn.executescript(f.read())
+    cur = conn.cursor()
+
+    print("Trimming...")
+    required = set()
+    with sqlite3.connect(args.ncbitaxon) as source:
+        trim(source.cursor(), cur, args.active_taxa, args.iedb_taxa)
+        if args.check:
+            taxa = {x for x, count in counts.items() if count > 0}
+            taxa.update(precious)
+            required = get_required(source.cursor(), taxa)
+    source.close()
+    cur.execute("CREATE INDEX stanza_idx ON statements (stanza)")
+    cur.execute("CREATE INDEX subject_idx ON statements (subject)")
+    cur.execute("CREATE INDEX object_idx ON statements (object)")
+    cur.execute("ANALYZE")
+    tree = Tree.load(cur)
+    if args.check:
+        check_stage(tree, required, prefixes["trimmed"])
+    save_stage(conn, tree, counts, prefixes["trimmed"], normalized=args.normalize)
+
+    print("Overriding...")
+    labels = get_labels.get_labels(
+        cur, get_labels.get_preferred_labels(args.ncbi_taxa), cache=args.label_cache
+    )
+    override(cur, labels, args.taxon_parents)
+    # Every later stage works on this tree
+    tree = Tree.load(cur)
+    clean(tree, counts, precious)
+    tree.write(cur)
+    if args.check:
+        check_stage(tree, required, prefixes["override"])
+    save_stage(conn, tree, counts, prefixes["override"], normalized=args.normalize)
+
+    print("Organizing...")
+    if "iedb-taxon:0100026-other" not in tree.terms:
+        tree.add_node("iedb-taxon:0100026-other", "OBI:0100026", "Other Organism")
+    organize_tree(tree, top_level, precious)
+    tree.write(cur)
+    if args.check:
+        check_stage(tree, required, prefixes["organized"])
+    save_stage(conn, tree, counts, prefixes["organized"], normalized=args.normalize)
+
+    print("Pruning...")
+    prune_tree(tree, tree.get_cumulative_counts(counts), set(precious))
+    tree.write(cur)
+    if args.check:
+        check_stage(tree, required, prefixes["pruned"])
+    save_stage(conn, tree, counts, prefixes["pruned"], normalized=args.normalize)
+
+    print("Rehoming...")
+    rehome_and_clean(tree, counts, precious)
+    tree.write(cur)
+    if args.check:
+        check_stage(tree, required, prefixes["rehomed"])
+    save_stage(conn, tree, counts, prefixes["rehomed"], normalized=args.normalize)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import csv
+import json
+import sqlite3
+import sys
+
+from argparse import ArgumentParser
+from helpers import get_count_map, get_curie
+from taxtree import Tree
+
+
+# Invariants that every stage (and run.py) guarantees, checked in linear time on the tree loaded
+# with one scan:
+# - cycles: no node is its own ancestor
+# - roots: there is exactly one root (a node with children and no parent), not counting Other
+#   Organism, which run.py keeps at the top level
+# - orphans: every class is a root or under one
+# - missing: every required taxon is in the tree and under a root. Taxa are required when they are
+#   precious or counted and are live classes of the reference database (the NCBITaxon database
+#   the tree was built from), since the stages only keep the taxa that exist there.
+# Warnings are reported but do not fail the check:
+# - empty_others: '-other' nodes without children, which organize and prune leave behind
+# The report is JSON; the exit code is 1 when any check fails.
+
+# Number of failing nodes to list for each check
+EXAMPLES = 20
+
+OTHER_ORGANISM = "iedb-taxon:0100026-other"
+
+
+def get_cycles(tree):
+    """Get every node that is on a cycle of parents, walking up from each node once.
+
+    :param tree: Tree
+    :return: list of nodes on cycles
+    """
+    # node -> 1 while on the current walk, 2 when done
+    state = {}
+    cycles = []
+    for start in tree.child_parents:
+        path = []
+        node = start
+        while node is not None and node not in state:
+            state[node] = 1
+            path.append(node)
+            node = tree.child_parents.get(node)
+        if node is not None and state[node] == 1:
+            # The walk came back to itself: the nodes from there on are the cycle
+            cycles.extend(path[path.index(node):])
+        for n in path:
+            state[n] = 2
+    return cycles
+
+
+def get_result(failures):
+    return {"ok": not failures, "count": len(failures), "examples": failures[:EXAMPLES]}
+
+
+def get_required(cur, taxa):
+    """Get the taxa that are live classes of a database.
+
+    :param cur: database connection cursor of the reference database
+    :param taxa: collection of tax IDs
+    :return: set of tax IDs
+    """
+    cur.execute("CREATE TEMP TABLE required (stanza TEXT PRIMARY KEY)")
+    cur.executemany("INSERT OR IGNORE INTO required VALUES (?)", [(x,) for x in taxa])
+    cur.execute(
+        """SELECT stanza FROM required r
+        WHERE EXISTS (SELECT 1 FROM statements s
+          WHERE s.stanza = r.stanza AND s.predicate = 'rdf:type' AND s.object = 'owl:Class')
+        AND NOT EXISTS (SELECT 1 FROM statements s
+          WHERE s.stanza = r.stanza AND s.predicate = 'owl:deprecated' AND s.value = 'true')"""
+    )
+    required = {row[0] for row in cur.fetchall()}
+    cur.execute("DROP TABLE temp.required")
+    return required
+
+
+def check(tree, required=None):
+    """Check the invariants of a tree.
+
+    :param tree: Tree
+    :param required: collection of taxa that must be in the tree (see get_required)
+    :return: map of check -> {"ok", "count", "examples"}, map of warning -> {"ok", "count",
+        "examples"}
+    """
+    results = {}
+
+    cycles = get_cycles(tree)
+    results["cycles"] = get_result(cycles)
+
+    roots = [x for x, c in tree.children.items() if c and x not in tree.child_parents]
+    main_roots = [x for x in roots if x != OTHER_ORGANISM]
+    results["roots"] = {
+        "ok": len(main_roots) == 1,
+        "count": len(main_roots),
+        "examples": main_roots[:EXAMPLES],
+    }
+
+    reachable = set(tree.get_topological_order(roots))
+    orphans = sorted(x for x in tree.classes if x not in reachable)
+    results["orphans"] = get_result(orphans)
+
+    results["missing"] = get_result(sorted(x for x in required or () if x not in reachable))
+
+    warnings = {}
+    empty_others = sorted(
+        x for x in tree.terms if x.endswith("-other") and not tree.children.get(x)
+    )
+    warnings["empty_others"] = get_result(empty_others)
+    return results, warnings
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Database to check")
+    parser.add_argument("-c", "--counts", help="TSV containing ID -> epitope count")
+    parser.add_argument("-p", "--precious", help="List of taxa to keep")
+    parser.add_argument(
+        "-r",
+        "--reference",
+        help="NCBITaxon database the tree was built from: its live classes among the counted and "
+        "precious taxa must be in the tree (default: the database itself)",
+    )
+    args = parser.parse_args()
+
+    counts = {}
+    if args.counts:
+        counts = get_count_map(args.counts, header=True)
+
+    precious = []
+    if args.precious:
+        with open(args.precious, "r") as f:
+            reader = csv.reader(f, delimiter="\t")
+            for row in reader:
+                precious.append(get_curie(row[0]))
+
+    taxa = {x for x, count in counts.items() if count > 0}
+    taxa.update(precious)
+    with sqlite3.connect(args.reference or args.db) as conn:
+        required = get_required(conn.cursor(), taxa)
+    with sqlite3.connect(args.db) as conn:
+        tree = Tree.load(conn.cursor())
+    results, warnings = check(tree, required)
+    ok = all(x["ok"] for x in results.values())
+    report = {"db": args.db, "ok": ok, "checks": results, "warnings": warnings}
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
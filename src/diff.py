@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+
+from argparse import ArgumentParser
+
+
+def get_tree_state(cur):
+    """Get the child -> parent and term -> label maps of a stage database in one scan.
+
+    :param cur: database connection cursor
+    :return: map of child -> parent, map of term -> label
+    """
+    cur.execute(
+        """SELECT stanza, predicate, object, value FROM statements
+        WHERE subject = stanza AND predicate IN ('rdfs:subClassOf', 'rdfs:label')"""
+    )
+    child_parents = {}
+    labels = {}
+    for stanza, predicate, obj, value in cur:
+        if predicate == "rdfs:subClassOf":
+            if obj and not obj.startswith("_:"):
+                child_parents[stanza] = obj
+        elif stanza not in labels:
+            labels[stanza] = value
+    return child_parents, labels
+
+
+def get_preorder(child_parents, terms):
+    """Number the terms of a tree in pre-order so that each subtree is one contiguous range.
+
+    :param child_parents: map of child -> parent
+    :param terms: all terms in the tree
+    :return: map of term -> (first position, last position of its subtree)
+    """
+    children = {}
+    for child, parent in child_parents.items():
+        children.setdefault(parent, []).append(child)
+    roots = sorted(t for t in terms if child_parents.get(t) not in terms or t == child_parents[t])
+
+    order = {}
+    pos = 0
+    for root in roots:
+        # Iterative DFS; a term is closed once all of its children have been numbered
+        stack = [(root, False)]
+        while stack:
+            term, closed = stack.pop()
+            if closed:
+                order[term] = (order[term][0], pos - 1)
+                continue
+            if term in order:
+                # Cycle, already numbered
+                continue
+            order[term] = (pos, pos)
+            pos += 1
+            stack.append((term, True))
+            for child in sorted(children.get(term, []), reverse=True):
+                stack.append((child, False))
+    return order
+
+
+def diff_stages(old_parents, old_labels, new_parents, new_labels):
+    """Compare two stages of the tree and find all terms that were moved, removed, created or
+    relabeled.
+
+    :param old_parents: map of child -> parent in the old stage
+    :param old_labels: map of term -> label in the old stage
+    :param new_parents: map of child -> parent in the new stage
+    :param new_labels: map of term -> label in the new stage
+    :return: list of (term, change, old parent, new parent, old label, new label)
+    """
+    old_terms = set(old_parents.keys()) | set(old_labels.keys())
+    new_terms = set(new_parents.keys()) | set(new_labels.keys())
+    changes = []
+    for term in sorted(old_terms | new_terms):
+        old_parent = old_parents.get(term)
+        new_parent = new_parents.get(term)
+        old_label = old_labels.get(term)
+        new_label = new_labels.get(term)
+        if term not in new_terms:
+            changes.append((term, "removed", old_parent, None, old_label, None))
+            continue
+        if term not in old_terms:
+            changes.append((term, "created", None, new_parent, None, new_label))
+            continue
+        if old_parent != new_parent:
+            changes.append((term, "moved", old_parent, new_parent, old_label, new_label))
+        if old_label != new_label:
+            changes.append((term, "relabeled", old_parent, new_parent, old_label, new_label))
+    return changes
+
+
+def get_position(order, old_parents, term):
+    """Get the position of a term in the new stage. Removed terms take the position of their
+    closest ancestor that still exists, so that they show up in that ancestor's subtree.
+
+    :param order: map of term -> (first, last) in the new stage
+    :param old_parents: map of child -> parent in the old stage
+    :param term: term to get position of
+    :return: position or None
+    """
+    seen = set()
+    while term and term not in order and term not in seen:
+        seen.add(term)
+        term = old_parents.get(term)
+    if term in order:
+        return order[term][0]
+    return None
+
+
+def create_diff_tables(cur):
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS tree_diff (source TEXT,
+                                                 target TEXT,
+                                                 term TEXT,
+                                                 change TEXT,
+                                                 old_parent TEXT,
+                                                 new_parent TEXT,
+                                                 old_label TEXT,
+                                                 new_label TEXT,
+                                                 position INTEGER)"""
+    )
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS tree_order (stage TEXT,
+                                                  term TEXT,
+                                                  first INTEGER,
+                                                  last INTEGER)"""
+    )
+
+
+def add_diff_indexes(cur):
+    cur.execute("CREATE INDEX idx_tree_diff_term ON tree_diff (target, term)")
+    cur.execute("CREATE INDEX idx_tree_diff_position ON tree_diff (target, position)")
+    cur.execute("CREATE UNIQUE INDEX idx_tree_order_term ON tree_order (stage, term)")
+    cur.execute("ANALYZE")
+
+
+def write_diff(cur, source, target, old_state, new_state):
+    """Write the differences between two stages to the diff tables.
+
+    :param cur: database connection cursor (diff database)
+    :param source: name of the old stage
+    :param target: name of the new stage
+    :param old_state: child -> parent & labels of the old stage
+    :param new_state: child -> parent & labels of the new stage
+    :return: number of changes
+    """
+    old_parents, old_labels = old_state
+    new_parents, new_labels = new_state
+    new_terms = set(new_parents.keys()) | set(new_labels.keys())
+    order = get_preorder(new_parents, new_terms)
+    cur.executemany(
+        "INSERT INTO tree_order VALUES (?, ?, ?, ?)",
+        ((target, term, first, last) for term, (first, last) in order.items()),
+    )
+    changes = diff_stages(old_parents, old_labels, new_parents, new_labels)
+    cur.executemany(
+        "INSERT INTO tree_diff VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            (source, target) + change + (get_position(order, old_parents, change[0]),)
+            for change in changes
+        ),
+    )
+    return len(changes)
+
+
+def get_changes(cur, target, term, subtree=False):
+    """Get the changes for a term (and optionally its whole subtree) between a stage and the
+    stage before it.
+
+    :param cur: database connection cursor (diff database)
+    :param target: name of the stage
+    :param term: term ID
+    :param subtree: if True, include changes to all descendants of the term
+    :return: list of change rows
+    """
+    if not subtree:
+        cur.execute(
+            "SELECT * FROM tree_diff WHERE target = ? AND term = ? ORDER BY change", (target, term)
+        )
+        return cur.fetchall()
+    cur.execute("SELECT first, last FROM tree_order WHERE stage = ? AND term = ?", (target, term))
+    res = cur.fetchone()
+    if not res:
+        # The term does not exist in this stage, only its own changes (e.g. removed) are known
+        return get_changes(cur, target, term)
+    cur.execute(
+        """SELECT * FROM tree_diff WHERE target = ? AND position BETWEEN ? AND ?
+        ORDER BY position, change""",
+        (target, res[0], res[1]),
+    )
+    return cur.fetchall()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("dbs", nargs="+", help="Stage databases, in pipeline order")
+    parser.add_argument("output", help="Output diff database")
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.output) as conn:
+        cur = conn.cursor()
+        create_diff_tables(cur)
+        prev_name = None
+        prev_state = None
+        for db in args.dbs:
+            name = os.path.splitext(os.path.basename(db))[0]
+            with sqlite3.connect(db) as stage_conn:
+                state = get_tree_state(stage_conn.cursor())
+            if prev_state:
+                count = write_diff(cur, prev_name, name, prev_state, state)
+                print(f"{prev_name} -> {name}: {count} changes")
+            prev_name = name
+            prev_state = state
+        add_diff_indexes(cur)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import sqlite3
+
+from argparse import ArgumentParser
+
+
+# Materialized hierarchy and rank tables. Most rows in statements are labels and synonyms, so
+# queries on rdfs:subClassOf and ncbitaxon:has_rank read from these smaller tables instead:
+# - edges(pos, child, parent) for each rdfs:subClassOf with a named (non-blank) parent
+# - ranks(pos, term, rank) for each ncbitaxon:has_rank
+# pos is the rowid of the statements row, so results come back in statements order like the
+# statements indexes return them. Triggers on statements keep both tables in sync with every
+# INSERT, UPDATE and DELETE. VACUUM renumbers the rowids of a table that has gaps (e.g. after
+# ingest.py --delta) unless they are declared as an INTEGER PRIMARY KEY, which is why ingest.py
+# creates statements with an id column.
+
+TRIGGERS = [
+    """CREATE TRIGGER edges_insert AFTER INSERT ON statements
+    WHEN NEW.predicate = 'rdfs:subClassOf' AND NEW.object NOT LIKE '_:%'
+    BEGIN
+      INSERT INTO edges VALUES (NEW.rowid, NEW.subject, NEW.object);
+    END""",
+    """CREATE TRIGGER edges_delete AFTER DELETE ON statements
+    WHEN OLD.predicate = 'rdfs:subClassOf'
+    BEGIN
+      DELETE FROM edges WHERE pos = OLD.rowid;
+    END""",
+    """CREATE TRIGGER edges_update AFTER UPDATE OF subject, predicate, object ON statements
+    WHEN OLD.predicate = 'rdfs:subClassOf' OR NEW.predicate = 'rdfs:subClassOf'
+    BEGIN
+      DELETE FROM edges WHERE pos = OLD.rowid;
+      INSERT INTO edges SELECT NEW.rowid, NEW.subject, NEW.object
+      WHERE NEW.predicate = 'rdfs:subClassOf' AND NEW.object NOT LIKE '_:%';
+    END""",
+    """CREATE TRIGGER ranks_insert AFTER INSERT ON statements
+    WHEN NEW.predicate = 'ncbitaxon:has_rank' AND NEW.object IS NOT NULL
+    BEGIN
+      INSERT INTO ranks VALUES (NEW.rowid, NEW.subject, NEW.object);
+    END""",
+    """CREATE TRIGGER ranks_delete AFTER DELETE ON statements
+    WHEN OLD.predicate = 'ncbitaxon:has_rank'
+    BEGIN
+      DELETE FROM ranks WHERE pos = OLD.rowid;
+    END""",
+    """CREATE TRIGGER ranks_update AFTER UPDATE OF subject, predicate, object ON statements
+    WHEN OLD.predicate = 'ncbitaxon:has_rank' OR NEW.predicate = 'ncbitaxon:has_rank'
+    BEGIN
+      DELETE FROM ranks WHERE pos = OLD.rowid;
+      INSERT INTO ranks SELECT NEW.rowid, NEW.subject, NEW.object
+      WHERE NEW.predicate = 'ncbitaxon:has_rank' AND NEW.object IS NOT NULL;
+    END""",
+]
+
+
+def add_edge_table(cur):
+    """Create and fill the edges table and its indexes, without triggers. This is all a database
+    that is not written to again needs (see publish.py).
+
+    :param cur: database connection cursor
+    """
+    cur.execute("CREATE TABLE edges (pos INTEGER PRIMARY KEY, child TEXT, parent TEXT)")
+    cur.execute(
+        """INSERT INTO edges SELECT rowid, subject, object FROM statements
+        WHERE predicate = 'rdfs:subClassOf' AND object NOT LIKE '_:%'"""
+    )
+    cur.execute("CREATE INDEX idx_edges_child ON edges (child, pos, parent)")
+    cur.execute("CREATE INDEX idx_edges_parent ON edges (parent, pos, child)")
+
+
+def add_edge_tables(cur):
+    """Create and fill the edges and ranks tables and the triggers that keep them in sync with
+    the statements table. Does nothing if the tables already exist.
+
+    :param cur: database connection cursor
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'edges'")
+    if cur.fetchone():
+        return
+    add_edge_table(cur)
+
+    cur.execute("CREATE TABLE ranks (pos INTEGER PRIMARY KEY, term TEXT, rank TEXT)")
+    cur.execute(
+        """INSERT INTO ranks SELECT rowid, subject, object FROM statements
+        WHERE predicate = 'ncbitaxon:has_rank' AND object IS NOT NULL"""
+    )
+    cur.execute("CREATE INDEX idx_ranks_term ON ranks (term, pos, rank)")
+    cur.execute("CREATE INDEX idx_ranks_rank ON ranks (rank, pos, term)")
+    for trigger in TRIGGERS:
+        cur.execute(trigger)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Database to add edges and ranks tables to")
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        add_edge_tables(conn.cursor())
+        conn.execute("ANALYZE")
+
+
+if __name__ == "__main__":
+    main()
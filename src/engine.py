@@ -0,0 +1,555 @@
+from helpers import get_curie
+
+
+# Nodes to start rehoming from
+# TODO: this should get the manual structure nodes from top-level sheet
+# - start at top level and then go down until we find non-manual node
+# - that is where we want to start rehoming
+# - skip rehoming for terms that have other children that are precious and go to next level
+REHOME_ROOTS = [
+    "NCBITaxon:2",  # bacterium
+    "NCBITaxon:10239",  # virus
+    "NCBITaxon:4751",  # fungus
+    "NCBITaxon:58024",  # spermatophyte
+    "NCBITaxon:6854",  # arachnid
+    "NCBITaxon:6657",  # crustacean
+    "NCBITaxon:50557",  # insect
+    "NCBITaxon:6447",  # mollusc
+    "NCBITaxon:6231",  # nematode
+    "NCBITaxon:6157",  # platyhelminth
+]
+
+
+# The same organize rules as run.py/organize.py, run over an in-memory Tree.
+# Nothing is written until the caller calls Tree.write.
+
+
+def get_precious_descendants(tree, precious, node):
+    """Get the top-most precious descendants of a node (precious nodes under another precious
+    descendant are moved along with it), from the tree's cached subtree summaries.
+    """
+    return tree.get_summaries(precious).get_precious_descendants(node)
+
+
+def clean_others(tree, precious):
+    """Remove 'other' nodes that have no epitopes of their own, the same as helpers.clean_others.
+    Their precious descendants stay under the 'other' node (or its parent if the 'other' node is
+    the only child) and the rest is moved to 'Other Organism'.
+
+    :param tree: Tree to clean
+    :param precious: collection of taxa to keep
+    """
+    precious = tree.get_precious_index(precious)
+    others = sorted(
+        (x for x in tree.terms if x.endswith("-other") and x != "iedb-taxon:0100026-other"),
+        key=lambda x: tree.order.get(x, len(tree.order)),
+    )
+    for other_id in others:
+        if other_id in precious:
+            # This 'other' node has epitopes, do nothing
+            continue
+        parent = tree.get_parent(other_id)
+        if not parent:
+            continue
+
+        # Get the precious descendants before moving anything around
+        precious_descendants = get_precious_descendants(tree, precious, other_id)
+        if len(tree.children[parent]) == 1:
+            # Get rid of the other node and bump up all terms
+            tree.move(other_id, "iedb-taxon:0100026-other")
+            move_to = parent
+        else:
+            # Otherwise move the direct children to Other Organism
+            move_to = other_id
+            tree.move_all(tree.get_children(other_id), "iedb-taxon:0100026-other")
+
+        # Move the precious descendants back to this other term OR its parent
+        tree.move_all(precious_descendants, move_to)
+
+
+def get_term_to_remove(tree, cuml_counts, term_id):
+    """Get the highest ancestor of a term (or the term itself) that has no epitopes below an
+    ancestor with epitopes, the same as helpers.get_term_to_remove.
+    """
+    seen = {term_id}
+    parent = tree.get_parent(term_id)
+    while parent is not None and cuml_counts.get(parent, 0) <= 0 and parent not in seen:
+        seen.add(parent)
+        term_id = parent
+        parent = tree.get_parent(term_id)
+    return term_id
+
+
+def get_no_epitope_branches(tree, cuml_counts, leaves=None):
+    """Get the highest term of each zero-epitope branch, the same as helpers.clean_no_epitopes.
+    A branch that reaches up to Other Organism is already in place, so Other Organism itself is
+    never returned (moving it would make it its own parent).
+
+    :param tree: Tree
+    :param cuml_counts: map of ID -> cumulative epitope count
+    :param leaves: nodes without children to start from (default all of them)
+    :return: set of terms
+    """
+    if leaves is None:
+        leaves = [x for x in tree.terms if not tree.children.get(x)]
+    remove = set()
+    for term_id in leaves:
+        if cuml_counts.get(term_id, 0) > 0:
+            continue
+        remove.add(get_term_to_remove(tree, cuml_counts, term_id))
+    remove.discard("iedb-taxon:0100026-other")
+    return remove
+
+
+def clean_no_epitopes(tree, cuml_counts, leaves=None):
+    """Move zero-epitope branches to 'Other Organism', the same as helpers.clean_no_epitopes. All
+    branches to move are found before anything is moved.
+
+    :param tree: Tree to clean
+    :param cuml_counts: map of ID -> cumulative epitope count
+    :param leaves: nodes without children to start from (default all of them)
+    """
+    tree.move_all(get_no_epitope_branches(tree, cuml_counts, leaves), "iedb-taxon:0100026-other")
+
+
+def move_precious_to_other(tree, precious, parent_tax_id, parent_tax_label, others):
+    other_id = tree.create_other(parent_tax_id, parent_tax_label)
+    exclude_from_other_org = set()
+    for o in others:
+        if o in precious:
+            exclude_from_other_org.add(o)
+            continue
+        precious_descendants = get_precious_descendants(tree, precious, o)
+        exclude_from_other_org.update(precious_descendants)
+        tree.move_all(precious_descendants, other_id)
+    # Move all others to other organism now that their species are gone
+    tree.move_all(set(others) - exclude_from_other_org, "iedb-taxon:0100026-other")
+
+
+def move_rank_to_other(tree, parent_tax_id, parent_tax_label, others, rank, precious):
+    tree.create_other(parent_tax_id, parent_tax_label)
+    if rank == "none":
+        tree.move_all(others, f"iedb-taxon:{parent_tax_id}-other")
+        return
+
+    rank_id = "NCBITaxon:" + rank
+    precious_others = None
+    for o in others:
+        other_id = f"iedb-taxon:{parent_tax_id}-other"
+        if o in precious:
+            # Move this node to other then move its at-rank (or precious) children under it
+            tree.move(o, other_id)
+            other_id = o
+
+        at_rank = tree.get_at_rank(o, rank_id)
+
+        # Also add in any precious
+        # (making sure not to remove any important species-subspecies relationships)
+        # These are the top-most precious descendants that are not under an at-rank node
+        precious_others = set()
+        if precious.has_precious_descendant(o):
+            at_rank_set = set(at_rank)
+            for p in get_precious_descendants(tree, precious, o):
+                if not at_rank_set.intersection(tree.get_ancestors(p, o)):
+                    precious_others.add(p)
+        at_rank.extend(precious_others)
+        tree.move_all(at_rank, other_id)
+
+        if not other_id.endswith("other"):
+            # o is precious, move its non-at-rank children to other organism
+            other_organisms = [x for x in tree.get_children(other_id) if x not in at_rank]
+            tree.move_all(other_organisms, "iedb-taxon:0100026-other")
+        else:
+            # The top-most ancestor of every node moved out is o itself,
+            # so now o (with whatever is left under it) goes to 'other organism'
+            tree.move(o, "iedb-taxon:0100026-other")
+
+    # Finally, move the 'precious' others to the correct level
+    if precious_others:
+        tree.move_all(precious_others, f"iedb-taxon:{parent_tax_id}-other")
+
+
+def move_up(tree, top_level_id, top_level_label, rank, precious, extras):
+    top_level = get_curie(top_level_id)
+    rank_id = "NCBITaxon:" + rank
+
+    # Find all nodes of the given rank
+    at_rank = tree.get_at_rank(top_level, rank_id)
+    at_rank.extend(extras)
+
+    # Ancestors of each node below the top level and the nodes under a precious ancestor,
+    # before anything is moved
+    at_rank_ancestors = {x: tree.get_ancestors(x, top_level) for x in at_rank}
+    under_precious = {x for x in at_rank if precious.get_precious_ancestor(x, top_level)}
+
+    # Rank-level nodes under an extra stay in place
+    # (the legacy path only ever matches extras here, not precious, so neither do we)
+    keep_in_place = set()
+    for taxa in at_rank:
+        if extras.intersection(at_rank_ancestors[taxa]):
+            keep_in_place.add(taxa)
+    at_rank = set(at_rank) - keep_in_place
+
+    # Bump all nodes of given rank to top-level
+    tree.move_all(at_rank, top_level)
+
+    # Find nodes to remove (ancestors to limit) - excluding at_rank under extras
+    other_organisms = set()
+    precious_others = set()
+    for f in at_rank:
+        ancestors = at_rank_ancestors[f]
+        if not ancestors:
+            continue
+        if f in under_precious or extras.intersection(ancestors):
+            # Extras & precious may not be of given rank
+            continue
+        move = ancestors[-1]
+        # Check for a descendant that is in precious and make sure to move it to 'other'
+        if precious.has_precious_descendant(move):
+            precious_others.update(precious.intersection(tree.get_descendants(move, [f])))
+        other_organisms.add(move)
+
+    # Find non-rank level nodes under top-level
+    non_at_rank = []
+    for tax_id in tree.get_children(top_level):
+        if tax_id in extras or tax_id in precious:
+            continue
+        if tree.ranks.get(tax_id, "") != rank_id:
+            non_at_rank.append(tax_id)
+
+    # Move all species-level or precious terms to "Other" then delete ancestors
+    if non_at_rank or precious_others:
+        move_precious_to_other(tree, precious, top_level_id, top_level_label, non_at_rank)
+
+    tree.move_all(other_organisms, "iedb-taxon:0100026-other")
+
+
+def organize(tree, top_level, precious, nodes=None):
+    """Organize the tree under the stable top level.
+
+    :param tree: Tree to organize
+    :param top_level: map of top level ID -> details, lowest level first
+    :param precious: collection of taxa to keep
+    :param nodes: only organize these top level nodes (default all)
+    """
+    precious = tree.get_precious_index(precious)
+    for curie, details in top_level.items():
+        if nodes is not None and curie not in nodes:
+            continue
+        # First, rehome this node
+        tree.move(curie, get_curie(details["Parent ID"]))
+
+        rank = details.get("Child Rank", "").strip()
+        if rank == "":
+            # Nothing to do, everything stays as-is
+            continue
+
+        if rank == "manual":
+            # Everything NOT in this set gets moved to other
+            others = [x for x in tree.get_children(curie) if x not in top_level]
+            other_rank = details.get("Other Rank", "")
+            if other_rank.strip() == "":
+                other_rank = "species"
+            move_rank_to_other(
+                tree, details["ID"], details["Label"], others, other_rank, precious
+            )
+            continue
+
+        # Otherwise, move all of given rank to top-level
+        extras = {
+            get_curie(x) for x in details.get("Extra Nodes", "").split(", ") if x.strip() != ""
+        }
+        move_up(tree, details["ID"], details["Label"], rank, precious, extras)
+
+
+# Chain collapse for pruning. Each function makes one pass up from the start nodes, visiting every
+# node at most once, and returns all of the re-parenting to be written as one batch.
+
+
+def get_collapse_moves(child_parents, cuml_counts, precious, top_level, starts):
+    """Find the nodes to move for run.py prune. A node is moved above every ancestor with the same
+    cumulative count, stopping at (and also skipping) the first precious ancestor.
+
+    :param child_parents: map of child -> parent
+    :param cuml_counts: map of ID -> cumulative epitope count
+    :param precious: set of taxa to keep
+    :param top_level: top level IDs, where the walk up stops
+    :param starts: nodes to start from (leaves with epitopes)
+    :return: map of node -> new parent
+    """
+    # node -> last node of the chain of same-count ancestors starting at this node
+    chain_end = {}
+    for node in child_parents:
+        path = []
+        on_path = set()
+        n = node
+        while n not in chain_end:
+            parent = child_parents.get(n)
+            if (
+                n in on_path
+                or n in precious
+                or not parent
+                or cuml_counts.get(n, 0) != cuml_counts.get(parent, 0)
+            ):
+                chain_end[n] = n
+                break
+            path.append(n)
+            on_path.add(n)
+            n = parent
+        for p in path:
+            chain_end[p] = chain_end[n]
+
+    moves = {}
+    visited = set()
+    for node in starts:
+        while node and node not in visited:
+            visited.add(node)
+            last = chain_end.get(node, node)
+            parent = child_parents.get(last)
+            if last == node:
+                # Nothing to collapse here, continue with the parent
+                node = parent
+            elif parent:
+                moves[node] = parent
+                node = parent
+            else:
+                moves[node] = last
+                break
+            if node in top_level:
+                break
+    return moves
+
+
+def get_threshold_chains(child_parents, cuml_counts, precious, starts, threshold=0.99):
+    """Find the collapse steps for prune2.py. A node is collapsed into its parent when it has
+    more than the threshold of its parent's epitopes. Each step (first, last) moves first up to
+    the parent of last and last to that parent's 'other' node.
+
+    The recursive walk this replaces emitted the same steps many times over, and later steps win
+    where two of them move the same node. The walk is replayed backwards here, expanding the walk
+    from each node only once, so that each step is kept at the position of its last occurrence
+    and applying the steps in order gives the same tree.
+
+    :param child_parents: map of child -> parent
+    :param cuml_counts: map of ID -> cumulative epitope count
+    :param precious: set of taxa to keep
+    :param starts: nodes to start from (leaves with epitopes)
+    :param threshold: threshold for percentage of epitopes
+    :return: list of (first node, last node)
+    """
+
+    def is_stop(n):
+        return not n or n == "NCBITaxon:1" or n.endswith("other")
+
+    def get_up(n):
+        # The parent that n collapses into, if any
+        parent = child_parents.get(n)
+        if is_stop(parent) or parent in precious:
+            return None
+        parent_count = cuml_counts.get(parent, 0)
+        if parent_count and cuml_counts.get(n, 0) / parent_count > threshold:
+            return parent
+        return None
+
+    expanded = set()
+    seen = set()
+    steps = []
+
+    def add_step(step):
+        if step not in seen:
+            seen.add(step)
+            steps.append(step)
+
+    def walk(node):
+        # The walk from node, last step first
+        while node not in expanded:
+            expanded.add(node)
+            chain = [node]
+            up = get_up(node)
+            while up:
+                chain.append(up)
+                up = get_up(up)
+            if len(chain) == 1:
+                # Nothing to collapse here: go on with the parent
+                parent = child_parents.get(node)
+                if is_stop(parent):
+                    return
+                node = parent
+                continue
+            step = (chain[0], chain[1])
+            walk(chain[1])
+            for n in chain[2:]:
+                walk(n)
+                add_step(step)
+            top_parent = child_parents.get(chain[-1])
+            if not is_stop(top_parent):
+                walk(top_parent)
+                add_step(step)
+            return
+
+    for node in reversed(starts):
+        walk(node)
+    steps.reverse()
+    return steps
+
+
+def get_collapse_nodes(child_parents, cuml_counts, precious, starts):
+    """Find the nodes to remove for prune.py. A node is removed (and replaced by the lowest node of
+    its chain) when it has the same cumulative count as its child, unless it is precious.
+
+    :param child_parents: map of child -> parent
+    :param cuml_counts: map of ID -> cumulative epitope count
+    :param precious: set of taxa to keep
+    :param starts: leaves to start from
+    :return: map of node to remove -> node to replace it
+    """
+
+    def is_stop(n):
+        return not n or n == "OBI:0100026"
+
+    def find_start(n):
+        while n in precious and n != "NCBITaxon:1" and n in child_parents:
+            n = child_parents[n]
+        return n
+
+    # Find the nodes that are compared with their parents on the way up from each leaf
+    # (the walk skips precious leaves and their precious ancestors)
+    # Leaves are walked in reverse, so where a zero-count node could collapse into more than one
+    # child, the child on the path of the last leaf is used (like the per-leaf walk did)
+    walked = []
+    seen = set()
+    for s in reversed(starts):
+        s2 = child_parents.get(s)
+        if not s2:
+            continue
+        if s2 in precious or s2 == "NCBITaxon:1":
+            s2 = find_start(s)
+        if s2 == "NCBITaxon:1" or s2.endswith("other"):
+            continue
+        node = s if s2 == child_parents[s] else s2
+        while node not in seen:
+            parent = child_parents.get(node)
+            if is_stop(parent):
+                break
+            seen.add(node)
+            walked.append(node)
+            node = parent
+
+    # parent -> child it collapses into
+    down = {}
+    for node in walked:
+        parent = child_parents[node]
+        if parent in precious or is_stop(child_parents.get(parent)):
+            continue
+        if parent not in down and cuml_counts.get(node, 0) == cuml_counts.get(parent, 0):
+            down[parent] = node
+
+    collapse_nodes = {}
+    for remove in down:
+        path = [remove]
+        n = down[remove]
+        while n in down and n not in collapse_nodes and n not in path:
+            path.append(n)
+            n = down[n]
+        replace = collapse_nodes.get(n, n)
+        for p in path:
+            collapse_nodes[p] = replace
+    return collapse_nodes
+
+
+def move_species_to_other(tree):
+    """Move species to their parent's 'other' node when the parent has at least as many ranked
+    children that are not species, the same as prune.clean. Only the parents of species are
+    checked, using the rank histogram of their children.
+
+    :param tree: Tree to clean
+    """
+    species = "NCBITaxon:species"
+    parents = {tree.get_parent(x) for x in tree.rank_index.get_nodes(species)}
+    parents.discard(None)
+    for parent_id in sorted(parents, key=lambda x: tree.order.get(x, len(tree.order))):
+        child_ranks = tree.get_child_ranks(parent_id)
+        if len(child_ranks) < 2 or species not in child_ranks:
+            continue
+        species_count = child_ranks[species]
+        if species_count > sum(child_ranks.values()) - species_count:
+            # When there are more species, than non-species, don't bother putting them in other
+            continue
+        parent_tax = parent_id.split(":")[1]
+        tree.create_other(parent_tax, tree.labels.get(parent_id, parent_id))
+        tree.move_all(
+            [x for x in tree.get_children(parent_id) if tree.ranks.get(x) == species],
+            f"iedb-taxon:{parent_tax}-other",
+        )
+
+
+def rehome(tree, cuml_counts, precious, roots=None, threshold=0.01):
+    """Move children with less than the threshold of their parent's epitopes to the parent's
+    'other' node, keeping their precious descendants under the 'other' node. This is one top-down
+    pass over the Tree; the new 'other' nodes and moved edges are written with Tree.write.
+
+    :param tree: Tree to rehome
+    :param cuml_counts: map of ID -> cumulative epitope count
+    :param precious: collection of taxa to keep
+    :param roots: nodes to start from (default REHOME_ROOTS)
+    :param threshold: threshold for percentage of epitopes
+    """
+    if roots is None:
+        roots = REHOME_ROOTS
+    precious = tree.get_precious_index(precious)
+
+    stack = []
+    for taxa in reversed(roots):
+        # Check for direct 'other' children that are precious
+        # If there is one, start rehoming from the children instead
+        children = []
+        flag = False
+        for child_id in tree.get_children(taxa):
+            if child_id.endswith("-other"):
+                if child_id in precious:
+                    flag = True
+            else:
+                children.append(child_id)
+        if flag:
+            stack.extend(reversed(children))
+        else:
+            stack.append(taxa)
+
+    # Each parent only changes its own children, and only moves nodes out of the subtrees it does
+    # not continue into, so each parent can be handled before its children
+    while stack:
+        parent_id = stack.pop()
+        children = tree.get_children(parent_id)
+
+        # Check if all children are already species/subspecies
+        child_ranks = set(tree.get_child_ranks(parent_id))
+        child_ranks -= {"NCBITaxon:species", "NCBITaxon:subspecies"}
+        if not child_ranks:
+            # Do not go to next level because it won't change
+            continue
+
+        # Find children under threshold
+        parent_count = cuml_counts.get(parent_id, 0)
+        under_threshold = []
+        for term_id in children:
+            if not parent_count:
+                break
+            count = cuml_counts.get(term_id, 0)
+            if count / parent_count < threshold and not term_id.startswith("iedb-taxon"):
+                under_threshold.append(term_id)
+
+        # Remaining is everything that will not be moved to other
+        remaining = [x for x in children if x not in under_threshold]
+        if len(remaining) == 1 and remaining[0].endswith("-other"):
+            # Special case: if we rehome, "other" will be the only child of this node
+            # Jump to rehoming the next level down
+            stack.extend(reversed(under_threshold))
+            continue
+
+        others = [x for x in under_threshold if not x.endswith("other")]
+        if others:
+            # Find precious nodes in descendants of new other terms & move these to the other node
+            parent_label = tree.labels.get(parent_id, parent_id)
+            move_precious_to_other(tree, precious, parent_id.split(":")[1], parent_label, others)
+        # Go to next level for each not under threshold
+        stack.extend(reversed([x for x in remaining if not x.endswith("other")]))
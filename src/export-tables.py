@@ -0,0 +1,138 @@
+import csv
+import gzip
+import io
+import sqlite3
+
+from argparse import ArgumentParser
+from helpers import get_count_map
+from taxtree import Tree
+
+
+# Write the TSV tables that later stages and the browser read, from one scan of a database:
+# - {prefix}-child-parents.tsv: child, parent (no header, as read by snapshot.load_child_parents)
+# - {prefix}-labels.tsv: ID, label
+# - {prefix}-ranks.tsv: ID, rank
+# - {prefix}-lineages.tsv: ID, ancestor IDs from the root down joined with '|'
+# - {prefix}-counts.tsv: ID, own epitope count, cumulative epitope count
+# Rows are sorted by ID so the same database always gives the same files.
+
+TABLES = ["child-parents", "labels", "ranks", "lineages", "counts"]
+
+
+def get_lineage(tree, node):
+    """Get the ancestors of a node from the root down.
+
+    :param tree: Tree
+    :param node: node to get lineage of
+    :return: list of ancestor IDs
+    """
+    lineage = []
+    seen = {node}
+    parent = tree.child_parents.get(node)
+    while parent is not None and parent not in seen:
+        seen.add(parent)
+        lineage.append(parent)
+        parent = tree.child_parents.get(parent)
+    lineage.reverse()
+    return lineage
+
+
+def get_lineages(tree):
+    """Get the lineage of every node under a root in one pass from the roots down: the lineage of
+    a node is the lineage of its parent plus the parent.
+
+    :param tree: Tree
+    :return: map of node -> ancestor IDs from the root down joined with '|'
+    """
+    lineages = {}
+    for node in tree.get_topological_order():
+        parent = tree.child_parents.get(node)
+        if parent is None or parent == node:
+            lineages[node] = ""
+        elif lineages[parent]:
+            lineages[node] = lineages[parent] + "|" + parent
+        else:
+            lineages[node] = parent
+    return lineages
+
+
+def get_rows(tree, counts):
+    """Yield (table, row) for every row of every table, in ID order.
+
+    :param tree: Tree
+    :param counts: map of ID -> epitope count
+    """
+    cuml_counts = tree.get_cumulative_counts(counts)
+    lineages = get_lineages(tree)
+    nodes = {x for x in tree.terms if x in tree.classes or x in tree.child_parents}
+    nodes.update(x for x, children in tree.children.items() if children)
+    nodes = sorted(nodes)
+    for node in nodes:
+        parent = tree.child_parents.get(node)
+        if parent is not None:
+            yield "child-parents", [node, parent]
+        label = tree.labels.get(node)
+        if label is not None:
+            yield "labels", [node, label]
+        rank = tree.ranks.get(node)
+        if rank is not None:
+            yield "ranks", [node, rank]
+        lineage = lineages.get(node)
+        if lineage is None:
+            # Not under a root (e.g. on a cycle)
+            lineage = "|".join(get_lineage(tree, node))
+        yield "lineages", [node, lineage]
+        yield "counts", [node, counts.get(node, 0), cuml_counts.get(node, 0)]
+
+
+def export_tables(tree, counts, prefix, compress=False):
+    """Write all tables for a tree.
+
+    :param tree: Tree
+    :param counts: map of ID -> epitope count
+    :param prefix: output path prefix, e.g. build/ncbi-trimmed
+    :param compress: if True, write gzip-compressed .tsv.gz files
+    :return: map of table -> path
+    """
+    extension = ".tsv.gz" if compress else ".tsv"
+    paths = {table: f"{prefix}-{table}{extension}" for table in TABLES}
+    files = {}
+    writers = {}
+    try:
+        for table, path in paths.items():
+            if compress:
+                # mtime=0 so the compressed bytes only depend on the content
+                gz = gzip.GzipFile(path, "wb", mtime=0)
+                files[table] = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+            else:
+                files[table] = open(path, "w", encoding="utf-8", newline="")
+            writers[table] = csv.writer(files[table], delimiter="\t", lineterminator="\n")
+        writers["labels"].writerow(["ID", "Label"])
+        writers["ranks"].writerow(["ID", "Rank"])
+        writers["lineages"].writerow(["ID", "Lineage"])
+        writers["counts"].writerow(["ID", "Count", "Cumulative Count"])
+        for table, row in get_rows(tree, counts):
+            writers[table].writerow(row)
+    finally:
+        for f in files.values():
+            f.close()
+    return paths
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Database to get the tree from")
+    parser.add_argument("counts", help="TSV containing ID -> epitope count")
+    parser.add_argument("prefix", help="Output path prefix, e.g. build/ncbi-trimmed")
+    parser.add_argument("-z", "--gzip", action="store_true", help="Write .tsv.gz files")
+    args = parser.parse_args()
+
+    counts = get_count_map(args.counts, header=True)
+
+    with sqlite3.connect(args.db) as conn:
+        tree = Tree.load(conn.cursor())
+    export_tables(tree, counts, args.prefix, compress=args.gzip)
+
+
+if __name__ == "__main__":
+    main()
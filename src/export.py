@@ -0,0 +1,229 @@
+import re
+import sqlite3
+
+from argparse import ArgumentParser
+from itertools import groupby
+from xml.sax.saxutils import escape, quoteattr
+
+
+# Streaming RDF/XML and Turtle export of a statements table. Rows are read in stanza order from
+# one cursor and written one stanza at a time, so only the current stanza is held in memory.
+# Blank node subjects in a stanza (e.g. synonym axioms) are written as their own nodes.
+
+NCNAME = re.compile(r"[A-Za-z_][A-Za-z0-9_.\-]*$")
+TURTLE_LOCAL = re.compile(r"[A-Za-z0-9_]([A-Za-z0-9_.\-]*[A-Za-z0-9_\-])?$")
+
+
+def get_prefixes(cur):
+    cur.execute("SELECT prefix, base FROM prefix")
+    return dict(cur.fetchall())
+
+
+def get_stanzas(cur):
+    """Yield (stanza, rows) for each stanza, with the rows of the stanza in table order.
+
+    :param cur: database connection cursor
+    """
+    cur.execute(
+        """SELECT stanza, subject, predicate, object, value, datatype, language
+        FROM statements ORDER BY stanza, rowid"""
+    )
+    for stanza, rows in groupby(cur, key=lambda row: row[0]):
+        yield stanza, list(rows)
+
+
+def get_subjects(rows):
+    """Group the rows of a stanza by subject, in the order the subjects first appear."""
+    subjects = {}
+    for _, subject, predicate, obj, value, datatype, language in rows:
+        subjects.setdefault(subject, []).append((predicate, obj, value, datatype, language))
+    return subjects
+
+
+class RDFXMLWriter:
+    """Write stanzas as RDF/XML."""
+
+    def __init__(self, f, prefixes, predicates, ontology_iri=None):
+        """
+        :param f: file to write to
+        :param prefixes: map of prefix -> base IRI
+        :param predicates: all predicate CURIEs (to declare their XML namespaces up front)
+        :param ontology_iri: IRI of the owl:Ontology header, if any
+        """
+        self.f = f
+        self.prefixes = prefixes
+        self.namespaces = {"rdf": prefixes["rdf"], "owl": prefixes["owl"]}
+        self.tags = {}
+        for predicate in sorted(predicates):
+            self.tags[predicate] = self.get_tag(predicate)
+        self.ontology_iri = ontology_iri
+
+    def expand(self, curie):
+        if curie.startswith("<") and curie.endswith(">"):
+            return curie[1:-1]
+        prefix, _, local = curie.partition(":")
+        if prefix in self.prefixes:
+            return self.prefixes[prefix] + local
+        return curie
+
+    def get_tag(self, curie):
+        """Get the XML QName of a predicate, splitting its IRI after the last '/' or '#' when the
+        CURIE itself is not a valid QName (e.g. ONTIE:0003617).
+        """
+        prefix, _, local = curie.partition(":")
+        if prefix in self.prefixes and NCNAME.match(local) and NCNAME.match(prefix):
+            self.namespaces[prefix] = self.prefixes[prefix]
+            return curie
+        if prefix not in self.prefixes:
+            raise ValueError(f"Unknown prefix for predicate {curie}")
+        iri = self.expand(curie)
+        split = max(iri.rfind("/"), iri.rfind("#")) + 1
+        namespace, local = iri[:split], iri[split:]
+        if not NCNAME.match(local):
+            raise ValueError(f"Cannot write predicate {curie} as an XML element")
+        for prefix, base in self.namespaces.items():
+            if base == namespace:
+                return f"{prefix}:{local}"
+        prefix = f"ns{len(self.namespaces)}"
+        self.namespaces[prefix] = namespace
+        return f"{prefix}:{local}"
+
+    def get_node_attribute(self, name, curie):
+        if curie.startswith("_:"):
+            return f"rdf:nodeID={quoteattr(curie[2:])}"
+        return f"rdf:{name}={quoteattr(self.expand(curie))}"
+
+    def start(self):
+        self.f.write('<?xml version="1.0"?>\n<rdf:RDF')
+        for prefix, base in self.namespaces.items():
+            self.f.write(f"\n     xmlns:{prefix}={quoteattr(base)}")
+        self.f.write(">\n")
+        if self.ontology_iri:
+            self.f.write(f"  <owl:Ontology rdf:about={quoteattr(self.ontology_iri)}/>\n")
+
+    def write_stanza(self, rows):
+        for subject, properties in get_subjects(rows).items():
+            types = [obj for predicate, obj, _, _, _ in properties if predicate == "rdf:type"]
+            element = "rdf:Description"
+            if types and types[0] in ("owl:Class", "owl:Axiom"):
+                element = types[0]
+                properties = [p for p in properties if p[0] != "rdf:type" or p[1] != element]
+            name = "nodeID" if subject.startswith("_:") else "about"
+            self.f.write(f"  <{element} {self.get_node_attribute(name, subject)}>\n")
+            for predicate, obj, value, datatype, language in properties:
+                tag = self.tags[predicate]
+                if obj is not None:
+                    self.f.write(f"    <{tag} {self.get_node_attribute('resource', obj)}/>\n")
+                    continue
+                attributes = ""
+                if datatype:
+                    attributes += f" rdf:datatype={quoteattr(self.expand(datatype))}"
+                if language:
+                    attributes += f" xml:lang={quoteattr(language)}"
+                self.f.write(f"    <{tag}{attributes}>{escape(value or '')}</{tag}>\n")
+            self.f.write(f"  </{element}>\n")
+
+    def end(self):
+        self.f.write("</rdf:RDF>\n")
+
+
+class TurtleWriter:
+    """Write stanzas as Turtle."""
+
+    def __init__(self, f, prefixes, ontology_iri=None):
+        """
+        :param f: file to write to
+        :param prefixes: map of prefix -> base IRI
+        :param ontology_iri: IRI of the owl:Ontology header, if any
+        """
+        self.f = f
+        self.prefixes = prefixes
+        self.ontology_iri = ontology_iri
+
+    def get_term(self, curie):
+        if curie.startswith("_:") or curie.startswith("<"):
+            return curie
+        prefix, _, local = curie.partition(":")
+        if prefix not in self.prefixes:
+            return f"<{curie}>"
+        if TURTLE_LOCAL.match(local):
+            return curie
+        return f"<{self.prefixes[prefix]}{local}>"
+
+    def get_literal(self, value, datatype, language):
+        value = (value or "").replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n").replace("\r", "\\r")
+        literal = f'"{value}"'
+        if language:
+            return f"{literal}@{language}"
+        if datatype:
+            return f"{literal}^^{self.get_term(datatype)}"
+        return literal
+
+    def start(self):
+        for prefix, base in self.prefixes.items():
+            self.f.write(f"@prefix {prefix}: <{base}> .\n")
+        self.f.write("\n")
+        if self.ontology_iri:
+            self.f.write(f"<{self.ontology_iri}> a owl:Ontology .\n\n")
+
+    def write_stanza(self, rows):
+        for subject, properties in get_subjects(rows).items():
+            objects = []
+            for predicate, obj, value, datatype, language in properties:
+                if obj is not None:
+                    o = self.get_term(obj)
+                else:
+                    o = self.get_literal(value, datatype, language)
+                p = "a" if predicate == "rdf:type" else self.get_term(predicate)
+                objects.append(f"{p} {o}")
+            self.f.write(f"{self.get_term(subject)} " + " ;\n    ".join(objects) + " .\n\n")
+
+    def end(self):
+        pass
+
+
+def export(cur, f, fmt, ontology_iri=None):
+    """Write all statements as RDF/XML ('owl') or Turtle ('ttl').
+
+    :param cur: database connection cursor
+    :param f: file to write to
+    :param fmt: 'owl' or 'ttl'
+    :param ontology_iri: IRI of the owl:Ontology header, if any
+    :return: number of stanzas written
+    """
+    prefixes = get_prefixes(cur)
+    if fmt == "owl":
+        cur.execute("SELECT DISTINCT predicate FROM statements")
+        predicates = [x[0] for x in cur.fetchall()]
+        writer = RDFXMLWriter(f, prefixes, predicates, ontology_iri=ontology_iri)
+    else:
+        writer = TurtleWriter(f, prefixes, ontology_iri=ontology_iri)
+    writer.start()
+    count = 0
+    for _, rows in get_stanzas(cur):
+        writer.write_stanza(rows)
+        count += 1
+    writer.end()
+    return count
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Database to export")
+    parser.add_argument("output", help="Output .owl (RDF/XML) or .ttl (Turtle) file")
+    parser.add_argument("-f", "--format", choices=["owl", "ttl"], help="Output format")
+    parser.add_argument("-i", "--iri", help="Ontology IRI")
+    args = parser.parse_args()
+
+    fmt = args.format
+    if not fmt:
+        fmt = "ttl" if args.output.endswith(".ttl") else "owl"
+
+    with sqlite3.connect(args.db) as conn, open(args.output, "w") as f:
+        count = export(conn.cursor(), f, fmt, ontology_iri=args.iri)
+    print(f"Exported {count} stanzas to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,15 @@ import string
 
 from argparse import ArgumentParser
 from helpers import get_curie
+from labelcache import get_best_labels
+
+
+# Columns of the label overrides TSV (read by override.py)
+LABEL_HEADERS = ["Taxon ID", "Label", "Label Source", "Synonyms"]
+
+# Version of the rules in get_new_label: change it whenever they change, so cached labels are
+# picked again (see labelcache.py)
+RULE_VERSION = "get-labels-1"
 
 
 def bare(s):
@@ -29,20 +38,22 @@ def get_new_label(cur, labels, tax_id):
     cur.execute("SELECT value FROM statements WHERE stanza = ? AND predicate = 'rdfs:label'", (tax_id,))
     res = cur.fetchone()
     if not res:
-        return None, None
+        return None, None, None
     base_label = res[0]
     label = clean(base_label)
     bare_label = bare(label)
     source = "NCBI Taxonomy scientific name"
 
-    # query for exact synonyms & their synonym types
+    # query for exact synonyms & their synonym types: every exact synonym (including IEDB synonyms,
+    # which have no axiom) is paired with every synonym type in the stanza, in statement order
     cur.execute(
         """SELECT s1.value, s2.object FROM statements s1
            JOIN statements s2 ON s1.stanza = s2.stanza
            WHERE s1.stanza = ?
            AND s1.predicate = 'oio:hasExactSynonym'
            AND s2.subject LIKE '_:%'
-           AND s2.predicate = 'oio:hasSynonymType'""",
+           AND s2.predicate = 'oio:hasSynonymType'
+           ORDER BY s2.rowid, s1.rowid""",
         (tax_id,)
     )
     exact_syns = {}
@@ -92,32 +103,67 @@ def get_new_label(cur, labels, tax_id):
     return None, None, None
 
 
-def main():
-    parser = ArgumentParser()
-    parser.add_argument("db", help="NCBITaxon database")
-    parser.add_argument("labels", help="LJI SoT ncbi_taxa sheet with preferred labels")
-    args = parser.parse_args()
+def get_preferred_labels(path):
+    """Read the preferred labels from the ncbi_taxa sheet.
 
+    :param path: path to ncbi_taxa TSV
+    :return: map of tax ID -> {"Label", "Synonyms"}
+    """
     preferred_labels = {}
-    with open(args.labels, "r") as f:
+    with open(path, "r") as f:
         reader = csv.DictReader(f, delimiter="\t")
         for row in reader:
             preferred_labels[get_curie(row["Taxon ID"])] = {"Label": row["Label"], "Synonyms": row["IEDB Synonyms"]}
+    return preferred_labels
+
+
+def get_labels(cur, preferred_labels, cache=None):
+    """Get the label overrides for all NCBITaxon classes.
+
+    :param cur: database connection cursor
+    :param preferred_labels: map of tax ID -> {"Label", "Synonyms"} from the ncbi_taxa sheet
+    :param cache: path to a best label cache (see labelcache.py), or None to pick every label
+    :return: list of label override rows, keyed by LABEL_HEADERS
+    """
+    cur.execute("SELECT DISTINCT stanza FROM statements WHERE stanza LIKE 'NCBITaxon:%' AND object = 'owl:Class'")
+    tax_ids = [res[0] for res in cur.fetchall()]
+    best_labels = {}
+    if cache:
+        best_labels = get_best_labels(
+            cur,
+            [x for x in tax_ids if x not in preferred_labels],
+            cache,
+            RULE_VERSION,
+            lambda x: get_new_label(cur, {}, x)[:2],
+        )
 
     new_labels = []
-    with sqlite3.connect(args.db) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT DISTINCT stanza FROM statements WHERE stanza LIKE 'NCBITaxon:%' AND object = 'owl:Class'")
-        for res in cur.fetchall():
-            tax_id = res[0]
+    for tax_id in tax_ids:
+        if tax_id in best_labels:
+            label, source = best_labels[tax_id]
+            synonyms = ""
+        else:
             label, source, synonyms = get_new_label(cur, preferred_labels, tax_id)
-            if not label:
-                continue
-            new_labels.append([tax_id, label, source, synonyms])
+        if not label:
+            continue
+        new_labels.append(dict(zip(LABEL_HEADERS, [tax_id, label, source, synonyms])))
+    return new_labels
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="NCBITaxon database")
+    parser.add_argument("labels", help="LJI SoT ncbi_taxa sheet with preferred labels")
+    parser.add_argument("--cache", help="Best label cache database to reuse and update")
+    args = parser.parse_args()
+
+    preferred_labels = get_preferred_labels(args.labels)
+    with sqlite3.connect(args.db) as conn:
+        new_labels = get_labels(conn.cursor(), preferred_labels, cache=args.cache)
 
-    print("Taxon ID\tLabel\tLabel Source\tSynonyms")
+    print("\t".join(LABEL_HEADERS))
     for detail in new_labels:
-        print("\t".join(detail))
+        print("\t".join([detail[x] for x in LABEL_HEADERS]))
 
 
 if __name__ == '__main__':
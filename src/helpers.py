@@ -1,12 +1,13 @@
 import csv
 import sqlite3
 
+from edges import add_edge_tables
+
 
 def clean_no_epitopes(cur, counts):
     # Get bottom-level terms (are not object of subclass statement)
     cur.execute(
-        """SELECT DISTINCT stanza FROM statements WHERE stanza NOT IN
-        (SELECT object FROM statements WHERE predicate = 'rdfs:subClassOf')"""
+        "SELECT DISTINCT stanza FROM statements WHERE stanza NOT IN (SELECT parent FROM edges)"
     )
     remove = set()
     for res in cur.fetchall():
@@ -39,10 +40,10 @@ def clean_others(cur, precious):
 
         # Check if this is the ONLY child of the parent class
         cur.execute(
-            f"""SELECT s2.stanza, s2.object FROM statements s1 
-            JOIN statements s2 ON s1.object = s2.object
-            WHERE s1.stanza = ? AND s1.predicate = 'rdfs:subClassOf'
-            AND s2.predicate = 'rdfs:subClassOf'""",
+            """SELECT e2.child, e2.parent FROM edges e1
+            JOIN edges e2 ON e1.parent = e2.parent
+            WHERE e1.child = ?
+            ORDER BY e2.pos""",
             (other_id,),
         )
         res = cur.fetchall()
@@ -59,10 +60,7 @@ def clean_others(cur, precious):
         else:
             # Otherwise move the direct children to Other Organism
             move_to = other_id
-            cur.execute(
-                "SELECT stanza FROM statements WHERE object = ? AND predicate = 'rdfs:subClassOf'",
-                (other_id,),
-            )
+            cur.execute("SELECT child FROM edges WHERE parent = ?", (other_id,))
             children = [x[0] for x in cur.fetchall()]
             child_str = ", ".join([f"'{x}'" for x in children])
             cur.execute(
@@ -83,7 +81,10 @@ def copy_database(input_db, output_db):
     with sqlite3.connect(input_db) as conn:
         # Get stanzas from source database
         cur = conn.cursor()
-        cur.execute("SELECT * FROM statements")
+        cur.execute(
+            """SELECT stanza, subject, predicate, object, value, datatype, language
+            FROM statements"""
+        )
         rows = cur.fetchall()
         insert = []
         for r in rows:
@@ -115,6 +116,7 @@ def copy_database(input_db, output_db):
             cur_new.execute("CREATE INDEX stanza_idx ON statements (stanza)")
             cur_new.execute("CREATE INDEX subject_idx ON statements (subject)")
             cur_new.execute("CREATE INDEX object_idx ON statements (object)")
+            add_edge_tables(cur_new)
             cur_new.execute("ANALYZE")
 
 
@@ -160,8 +162,7 @@ def get_child_parents(cur):
     cur.execute(
         """SELECT DISTINCT stanza FROM statements
         WHERE object = 'owl:Class'
-        AND stanza NOT IN (SELECT object FROM statements
-         WHERE predicate = 'rdfs:subClassOf')"""
+        AND stanza NOT IN (SELECT parent FROM edges)"""
     )
     for row in cur.fetchall():
         ids.append(row[0])
@@ -174,11 +175,9 @@ def get_child_parents(cur):
             VALUES (?, NULL)
             UNION
             -- The non-blank parents of all of the parent terms extracted so far:
-            SELECT object AS parent, subject AS child
-            FROM statements, ancestors
-            WHERE ancestors.parent = statements.stanza
-              AND statements.predicate = 'rdfs:subClassOf'
-              AND statements.object NOT LIKE '_:%'
+            SELECT edges.parent, edges.child
+            FROM edges, ancestors
+            WHERE ancestors.parent = edges.child
             )
             SELECT * FROM ancestors""",
             (tax_id,),
@@ -191,10 +190,18 @@ def get_child_parents(cur):
     return child_parent
 
 
-def get_count_map(f):
+def get_count_map(f, header=False):
+    """Read a TSV of ID -> epitope count, skipping NULL IDs.
+
+    :param f: path to the counts TSV
+    :param header: if True, skip the first (header) row
+    :return: map of ID -> epitope count
+    """
     count_map = {}
     with open(f, "r") as f:
         reader = csv.reader(f, delimiter="\t")
+        if header:
+            next(reader, None)
         for row in reader:
             if row[0] == "NULL":
                 continue
@@ -233,11 +240,7 @@ def get_curie(tax_id):
 
 def get_descendants(cur, node, limits, descendants, only_limit=False):
     # Get the children and maybe iterate
-    cur.execute(
-        """SELECT DISTINCT subject FROM statements
-        WHERE object = ? AND predicate = 'rdfs:subClassOf'""",
-        (node,),
-    )
+    cur.execute("SELECT DISTINCT child FROM edges WHERE parent = ?", (node,))
     for row in cur.fetchall():
         tax_id = row[0]
         if tax_id in limits:
@@ -251,19 +254,12 @@ def get_descendants(cur, node, limits, descendants, only_limit=False):
 
 def get_descendants_and_ranks(cur, child_parent, ranks, node):
     # Get the rank of this node
-    cur.execute(
-        "SELECT object FROM statements WHERE predicate = 'ncbitaxon:has_rank' AND subject = ?",
-        (node,),
-    )
+    cur.execute("SELECT rank FROM ranks WHERE term = ?", (node,))
     res = cur.fetchone()
     if res:
         ranks[node] = res[0]
     # Get the children and maybe iterate
-    cur.execute(
-        """SELECT DISTINCT subject FROM statements
-        WHERE object = ? AND predicate = 'rdfs:subClassOf'""",
-        (node,),
-    )
+    cur.execute("SELECT DISTINCT child FROM edges WHERE parent = ?", (node,))
     for row in cur.fetchall():
         child_parent[row[0]] = node
         get_descendants_and_ranks(cur, child_parent, ranks, row[0])
@@ -289,10 +285,7 @@ def get_precious_descendants(cur, precious, node):
 
 
 def get_term_to_remove(cur, counts, term_id):
-    cur.execute(
-        "SELECT object FROM statements WHERE predicate = 'rdfs:subClassOf' AND stanza = ?",
-        (term_id,),
-    )
+    cur.execute("SELECT parent FROM edges WHERE child = ?", (term_id,))
     res = cur.fetchone()
     if res:
         parent_id = res[0]
@@ -355,10 +348,7 @@ def move_rank_to_other(cur, parent_tax_id, parent_tax_label, others, rank="speci
         if not other_id.endswith("other"):
             # Special clean up when the other node is not actually an "other" (o is precious)
             # Find the non-at-ranks and move to other organism
-            cur.execute(
-                "SELECT stanza FROM statements WHERE predicate = 'rdfs:subClassOf' AND object = ?",
-                (other_id,),
-            )
+            cur.execute("SELECT child FROM edges WHERE parent = ?", (other_id,))
             other_organisms = [x[0] for x in cur.fetchall() if x[0] not in at_rank]
             o_str = ", ".join([f"'{x}'" for x in other_organisms])
             cur.execute(
@@ -0,0 +1,575 @@
+import csv
+import os
+import sqlite3
+import xml.etree.ElementTree as ET
+
+from argparse import ArgumentParser
+from axioms import add_axiom_table, update_axioms
+from edges import add_edge_tables
+
+
+# Streaming NCBITaxon ingester, from the RDF/XML release or directly from an NCBI taxdump. Only the
+# triples that the build uses are written:
+# - owl:Class declarations
+# - labels, parents and ranks
+# - synonyms and the owl:Axiom annotations that give their synonym types
+# Rows are laid out the same way rdftab lays out the RDF/XML, and memory use does not grow with the
+# size of the input.
+#
+# With --delta, a new release is compared with the statements already in the database instead:
+# the release is streamed into a temporary table, both tables are read once in stanza order, and
+# only the stanzas that differ (ignoring blank node IDs) are replaced in place. The edges & ranks
+# triggers and update_axioms keep the derived tables in step. Every replaced stanza gets at least
+# one row in the change report (added, deleted, merged, label, parent, rank, synonyms or other),
+# which later stages can use to only redo the affected taxa.
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+ABOUT = f"{{{RDF}}}about"
+RESOURCE = f"{{{RDF}}}resource"
+DATATYPE = f"{{{RDF}}}datatype"
+LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+SYNONYM_PREDICATES = {
+    "oio:hasExactSynonym",
+    "oio:hasRelatedSynonym",
+    "oio:hasBroadSynonym",
+    "oio:hasNarrowSynonym",
+}
+CLASS_PREDICATES = {"rdfs:label", "rdfs:subClassOf", "ncbitaxon:has_rank"} | SYNONYM_PREDICATES
+AXIOM_PREDICATES = {
+    "owl:annotatedSource",
+    "owl:annotatedProperty",
+    "owl:annotatedTarget",
+    "oio:hasSynonymType",
+}
+
+# taxdump name class -> synonym predicate (as in the NCBITaxon OWL build)
+NAME_CLASS_PREDICATES = {
+    "acronym": "oio:hasBroadSynonym",
+    "anamorph": "oio:hasRelatedSynonym",
+    "blast name": "oio:hasRelatedSynonym",
+    "common name": "oio:hasExactSynonym",
+    "equivalent name": "oio:hasExactSynonym",
+    "genbank acronym": "oio:hasBroadSynonym",
+    "genbank anamorph": "oio:hasRelatedSynonym",
+    "genbank common name": "oio:hasExactSynonym",
+    "genbank synonym": "oio:hasRelatedSynonym",
+    "in-part": "oio:hasRelatedSynonym",
+    "includes": "oio:hasRelatedSynonym",
+    "misnomer": "oio:hasRelatedSynonym",
+    "misspelling": "oio:hasRelatedSynonym",
+    "synonym": "oio:hasRelatedSynonym",
+    "teleomorph": "oio:hasRelatedSynonym",
+}
+
+BATCH_SIZE = 50000
+
+# Columns of a statements row, without the id
+COLUMNS = "stanza, subject, predicate, object, value, datatype, language"
+
+# Columns of the --delta change report
+DELTA_HEADERS = ["Taxon ID", "Change", "Old", "New"]
+
+
+class BatchInserter:
+    """Insert statements rows in batches."""
+
+    def __init__(self, cur, table="statements", batch_size=BATCH_SIZE):
+        self.cur = cur
+        self.table = table
+        self.batch_size = batch_size
+        self.rows = []
+        self.count = 0
+
+    def add(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.cur.executemany(
+            f"INSERT INTO {self.table} ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", self.rows
+        )
+        self.count += len(self.rows)
+        self.rows = []
+
+
+def create_statements(cur, table="statements"):
+    """Create a statements table. The id is the rowid, declared so that VACUUM keeps it: the
+    edges, ranks and axioms tables refer to statements rows by rowid, and --delta leaves gaps.
+    """
+    cur.execute(
+        f"""CREATE TABLE {table} (id INTEGER PRIMARY KEY,
+                                    stanza TEXT,
+                                    subject TEXT,
+                                    predicate TEXT,
+                                    object TEXT,
+                                    value TEXT,
+                                    datatype TEXT,
+                                    language TEXT)"""
+    )
+
+
+def index_statements(cur):
+    """Add the indexes that the build queries use, then the edges, ranks and axioms tables. Labels
+    and synonyms are only looked up by term, so there is no index on value.
+
+    :param cur: database connection cursor
+    """
+    cur.execute("CREATE INDEX idx_stanza ON statements (stanza)")
+    cur.execute("CREATE INDEX idx_subject ON statements (subject)")
+    cur.execute("CREATE INDEX idx_predicate ON statements (predicate)")
+    cur.execute("CREATE INDEX idx_object ON statements (object)")
+    add_edge_tables(cur)
+    add_axiom_table(cur)
+    cur.execute("ANALYZE")
+
+
+def get_prefixes(cur):
+    """Get (prefix, base) pairs from the prefix table, longest base first."""
+    cur.execute("SELECT prefix, base FROM prefix ORDER BY length(base) DESC")
+    return cur.fetchall()
+
+
+def get_curie(prefixes, iri):
+    """Compact an IRI with the prefix table, or return it in angle brackets like rdftab."""
+    for prefix, base in prefixes:
+        if iri.startswith(base):
+            return prefix + ":" + iri[len(base) :]
+    return f"<{iri}>"
+
+
+def get_tag_curie(prefixes, tag):
+    # ElementTree tags are {namespace}local
+    return get_curie(prefixes, tag[1:].replace("}", "", 1))
+
+
+def get_object_row(prefixes, stanza, subject, predicate, elem):
+    """Get the statements row of one property element: a resource object or a literal value."""
+    resource = elem.get(RESOURCE)
+    if resource is not None:
+        return stanza, subject, predicate, get_curie(prefixes, resource), None, None, None
+    datatype = elem.get(DATATYPE)
+    if datatype is not None:
+        datatype = get_curie(prefixes, datatype)
+    return stanza, subject, predicate, None, elem.text or "", datatype, elem.get(LANG)
+
+
+def get_class_rows(prefixes, elem):
+    """Get the statements rows of an owl:Class element."""
+    about = elem.get(ABOUT)
+    if about is None:
+        return []
+    term = get_curie(prefixes, about)
+    rows = [(term, term, "rdf:type", "owl:Class", None, None, None)]
+    for child in elem:
+        predicate = get_tag_curie(prefixes, child.tag)
+        if predicate not in CLASS_PREDICATES:
+            continue
+        if predicate == "rdfs:subClassOf" and child.get(RESOURCE) is None:
+            # Anonymous superclasses (restrictions) are not part of the hierarchy
+            continue
+        rows.append(get_object_row(prefixes, term, term, predicate, child))
+    return rows
+
+
+def get_axiom_rows(prefixes, elem, node_id):
+    """Get the statements rows of an owl:Axiom element that annotates a synonym. The stanza is the
+    annotated term and the subject is a new blank node.
+    """
+    properties = {}
+    for child in elem:
+        predicate = get_tag_curie(prefixes, child.tag)
+        if predicate in ("owl:annotatedSource", "owl:annotatedProperty"):
+            resource = child.get(RESOURCE)
+            properties[predicate] = get_curie(prefixes, resource) if resource else None
+    source = properties.get("owl:annotatedSource")
+    if not source or properties.get("owl:annotatedProperty") not in SYNONYM_PREDICATES:
+        return []
+    rows = [(source, node_id, "rdf:type", "owl:Axiom", None, None, None)]
+    for child in elem:
+        predicate = get_tag_curie(prefixes, child.tag)
+        if predicate in AXIOM_PREDICATES:
+            rows.append(get_object_row(prefixes, source, node_id, predicate, child))
+    return rows
+
+
+def ingest_owl(cur, path, table="statements"):
+    """Stream the classes and synonym axioms of an RDF/XML file into the statements table.
+
+    :param cur: database connection cursor (with a prefix table)
+    :param path: path to RDF/XML file
+    :param table: name of the statements table to create
+    :return: number of rows inserted
+    """
+    prefixes = get_prefixes(cur)
+    create_statements(cur, table)
+    inserter = BatchInserter(cur, table=table)
+    blank_nodes = 0
+    depth = 0
+    context = ET.iterparse(path, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        if depth > 0:
+            # Nested elements are handled with their top level element
+            continue
+        tag = get_tag_curie(prefixes, elem.tag)
+        if tag == "owl:Class":
+            inserter.add(get_class_rows(prefixes, elem))
+        elif tag == "owl:Axiom":
+            rows = get_axiom_rows(prefixes, elem, f"_:b{blank_nodes + 1}")
+            if rows:
+                blank_nodes += 1
+                inserter.add(rows)
+        root.clear()
+    inserter.flush()
+    return inserter.count
+
+
+def read_dmp(path):
+    """Yield the fields of each line of a taxdump .dmp file."""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.endswith("\t|"):
+                line = line[:-2]
+            yield line.split("\t|\t")
+
+
+def read_names(path):
+    """Yield (tax ID, list of (name, unique name, name class)) from names.dmp, which is sorted by
+    tax ID.
+    """
+    tax_id = None
+    names = []
+    for row in read_dmp(path):
+        row_id = int(row[0])
+        if row_id != tax_id:
+            if tax_id is not None:
+                if row_id < tax_id:
+                    raise ValueError(f"{path} is not sorted by tax ID")
+                yield tax_id, names
+            tax_id = row_id
+            names = []
+        names.append((row[1], row[2], row[3]))
+    if tax_id is not None:
+        yield tax_id, names
+
+
+def get_taxon_rows(tax_id, parent_id, rank, names, node_id):
+    """Get the statements rows of one taxdump node and its names.
+
+    :param tax_id: NCBI tax ID
+    :param parent_id: NCBI tax ID of the parent
+    :param rank: NCBI rank
+    :param names: list of (name, unique name, name class)
+    :param node_id: number of the first blank node to use for synonym axioms
+    :return: list of rows, number of the next blank node
+    """
+    term = f"NCBITaxon:{tax_id}"
+    rows = [(term, term, "rdf:type", "owl:Class", None, None, None)]
+    for name, unique_name, name_class in names:
+        if name_class == "scientific name":
+            rows.append((term, term, "rdfs:label", None, unique_name or name, None, None))
+    if tax_id != parent_id:
+        rows.append((term, term, "rdfs:subClassOf", f"NCBITaxon:{parent_id}", None, None, None))
+    if rank != "no rank":
+        rank = rank.replace(" ", "_")
+        rows.append((term, term, "ncbitaxon:has_rank", f"NCBITaxon:{rank}", None, None, None))
+
+    axioms = []
+    for name, _, name_class in names:
+        predicate = NAME_CLASS_PREDICATES.get(name_class)
+        if not predicate:
+            continue
+        rows.append((term, term, predicate, None, name, None, None))
+        subject = f"_:b{node_id}"
+        node_id += 1
+        synonym_type = "ncbitaxon:" + name_class.replace(" ", "_")
+        axioms.extend(
+            [
+                (term, subject, "rdf:type", "owl:Axiom", None, None, None),
+                (term, subject, "owl:annotatedSource", term, None, None, None),
+                (term, subject, "owl:annotatedProperty", predicate, None, None, None),
+                (term, subject, "owl:annotatedTarget", None, name, None, None),
+                (term, subject, "oio:hasSynonymType", synonym_type, None, None, None),
+            ]
+        )
+    return rows + axioms, node_id
+
+
+def ingest_taxdump(cur, directory, table="statements"):
+    """Stream an NCBI taxdump (nodes.dmp, names.dmp, merged.dmp & delnodes.dmp) into the
+    statements table. nodes.dmp and names.dmp are merged in one pass since both are sorted by tax
+    ID. Merged and deleted tax IDs are kept as deprecated terms (merged ones with their
+    replacement) but are not classes. Stanzas are written in the order of their IRIs, like the
+    RDF/XML release.
+
+    :param cur: database connection cursor
+    :param directory: directory with the taxdump files
+    :param table: name of the statements table to create
+    :return: number of rows inserted
+    """
+    create_statements(cur, table)
+    # Rows are streamed into a temporary table in tax ID order, then copied in stanza order
+    cur.execute(f"CREATE TEMP TABLE taxdump AS SELECT {COLUMNS} FROM {table} WHERE 0")
+    inserter = BatchInserter(cur, table="taxdump")
+
+    names = read_names(os.path.join(directory, "names.dmp"))
+    name_id, node_names = next(names, (None, []))
+    node_id = 1
+    for row in read_dmp(os.path.join(directory, "nodes.dmp")):
+        tax_id = int(row[0])
+        while name_id is not None and name_id < tax_id:
+            name_id, node_names = next(names, (None, []))
+        rows, node_id = get_taxon_rows(
+            tax_id, int(row[1]), row[2], node_names if name_id == tax_id else [], node_id
+        )
+        inserter.add(rows)
+
+    for row in read_dmp(os.path.join(directory, "merged.dmp")):
+        term = f"NCBITaxon:{row[0]}"
+        inserter.add(
+            [
+                (term, term, "owl:deprecated", None, "true", "xsd:boolean", None),
+                (term, term, "obo:IAO_0100001", f"NCBITaxon:{row[1]}", None, None, None),
+            ]
+        )
+    for row in read_dmp(os.path.join(directory, "delnodes.dmp")):
+        term = f"NCBITaxon:{row[0]}"
+        inserter.add([(term, term, "owl:deprecated", None, "true", "xsd:boolean", None)])
+    inserter.flush()
+
+    cur.execute(
+        f"INSERT INTO {table} ({COLUMNS}) SELECT {COLUMNS} FROM taxdump ORDER BY stanza, rowid"
+    )
+    cur.execute("DROP TABLE taxdump")
+    return inserter.count
+
+
+def ingest(cur, source, table="statements"):
+    """Stream an NCBITaxon release into a new statements table.
+
+    :param cur: database connection cursor (with a prefix table)
+    :param source: NCBITaxon RDF/XML file or directory with an NCBI taxdump
+    :param table: name of the statements table to create
+    :return: number of rows inserted
+    """
+    if os.path.isdir(source):
+        return ingest_taxdump(cur, source, table)
+    return ingest_owl(cur, source, table)
+
+
+def read_stanzas(cur, table):
+    """Yield (stanza, list of rows) from a statements table in stanza order."""
+    cur.execute(
+        f"""SELECT stanza, subject, predicate, object, value, datatype, language
+        FROM {table} ORDER BY stanza, rowid"""
+    )
+    stanza = None
+    rows = []
+    for row in cur:
+        if row[0] != stanza:
+            if rows:
+                yield stanza, rows
+            stanza = row[0]
+            rows = []
+        rows.append(row)
+    if rows:
+        yield stanza, rows
+
+
+def get_stanza_content(rows):
+    """Get the content of a stanza that does not depend on its blank node IDs or row order: the
+    sorted named rows, and the sorted annotations of each axiom.
+    """
+    named = []
+    axioms = {}
+    for row in rows:
+        values = tuple("" if x is None else x for x in row[2:])
+        if row[1].startswith("_:"):
+            axioms.setdefault(row[1], []).append(values)
+        else:
+            named.append((row[1],) + values)
+    return sorted(named), sorted(sorted(x) for x in axioms.values())
+
+
+def get_stanza_summary(stanza, rows):
+    """Get the parts of a stanza that the change report compares.
+
+    :param stanza: term ID
+    :param rows: statements rows of the stanza
+    :return: dict of live, label, parents, rank, replaced_by & synonyms
+    """
+    summary = {
+        "class": False,
+        "deprecated": False,
+        "label": None,
+        "parents": [],
+        "rank": None,
+        "replaced_by": None,
+    }
+    synonyms = []
+    axioms = {}
+    for _, subject, predicate, obj, value, _, _ in rows:
+        if subject.startswith("_:"):
+            axioms.setdefault(subject, {})[predicate] = obj or value
+        elif subject != stanza:
+            continue
+        elif predicate == "rdf:type" and obj == "owl:Class":
+            summary["class"] = True
+        elif predicate == "owl:deprecated" and value == "true":
+            summary["deprecated"] = True
+        elif predicate == "rdfs:label" and summary["label"] is None:
+            summary["label"] = value
+        elif predicate == "rdfs:subClassOf" and obj and not obj.startswith("_:"):
+            summary["parents"].append(obj)
+        elif predicate == "ncbitaxon:has_rank":
+            summary["rank"] = obj
+        elif predicate == "obo:IAO_0100001":
+            summary["replaced_by"] = obj
+        elif predicate in SYNONYM_PREDICATES:
+            synonyms.append((predicate, value))
+
+    synonym_types = {}
+    for axiom in axioms.values():
+        if axiom.get("owl:annotatedSource") == stanza:
+            key = (axiom.get("owl:annotatedProperty"), axiom.get("owl:annotatedTarget"))
+            synonym_types[key] = axiom.get("oio:hasSynonymType")
+    summary["synonyms"] = {
+        f"{value} ({synonym_types.get((predicate, value)) or predicate})"
+        for predicate, value in synonyms
+    }
+    summary["parents"] = "|".join(sorted(summary["parents"]))
+    summary["live"] = summary["class"] and not summary["deprecated"]
+    return summary
+
+
+def get_changes(stanza, old_rows, new_rows):
+    """Get the change report rows of a stanza that differs between two releases.
+
+    :param stanza: term ID
+    :param old_rows: statements rows of the stanza in the database (empty if it is new)
+    :param new_rows: statements rows of the stanza in the release (empty if it was removed)
+    :return: list of rows, keyed by DELTA_HEADERS
+    """
+    old = get_stanza_summary(stanza, old_rows)
+    new = get_stanza_summary(stanza, new_rows)
+    changes = []
+    if new["live"] and not old["live"]:
+        changes.append(("added", "", new["label"] or ""))
+    elif old["live"] and not new["live"]:
+        if new["replaced_by"]:
+            changes.append(("merged", old["label"] or "", new["replaced_by"]))
+        else:
+            changes.append(("deleted", old["label"] or "", ""))
+    elif old["live"]:
+        for key in ["label", "parents", "rank"]:
+            if old[key] != new[key]:
+                change = "parent" if key == "parents" else key
+                changes.append((change, old[key] or "", new[key] or ""))
+        if old["synonyms"] != new["synonyms"]:
+            changes.append(
+                (
+                    "synonyms",
+                    "|".join(sorted(old["synonyms"] - new["synonyms"])),
+                    "|".join(sorted(new["synonyms"] - old["synonyms"])),
+                )
+            )
+    if not changes:
+        changes.append(("other", "", ""))
+    return [dict(zip(DELTA_HEADERS, (stanza,) + change)) for change in changes]
+
+
+def ingest_delta(cur, source):
+    """Update the statements of a database to a new NCBITaxon release, only replacing the stanzas
+    that changed. The statements table must have the indexes and derived tables that
+    index_statements adds.
+
+    :param cur: database connection cursor (with a prefix table & statements)
+    :param source: NCBITaxon RDF/XML file or directory with an NCBI taxdump
+    :return: list of change report rows, keyed by DELTA_HEADERS
+    """
+    ingest(cur, source, "temp.release")
+    cur.execute("CREATE INDEX temp.idx_release_stanza ON release (stanza)")
+
+    # Merge join the two tables in stanza order
+    changes = []
+    changed = []
+    max_node = 0
+    old_stanzas = read_stanzas(cur, "statements")
+    new_stanzas = read_stanzas(cur.connection.cursor(), "release")
+    old = next(old_stanzas, None)
+    new = next(new_stanzas, None)
+    while old or new:
+        if new is None or (old is not None and old[0] < new[0]):
+            stanza, old_rows, new_rows = old[0], old[1], []
+        elif old is None or new[0] < old[0]:
+            stanza, old_rows, new_rows = new[0], [], new[1]
+        else:
+            stanza, old_rows, new_rows = old[0], old[1], new[1]
+        for row in old_rows:
+            if row[1].startswith("_:b") and row[1][3:].isdigit():
+                max_node = max(max_node, int(row[1][3:]))
+        if get_stanza_content(old_rows) != get_stanza_content(new_rows):
+            changed.append((stanza,))
+            changes.extend(get_changes(stanza, old_rows, new_rows))
+        if old_rows:
+            old = next(old_stanzas, None)
+        if new_rows:
+            new = next(new_stanzas, None)
+
+    cur.execute("CREATE TEMP TABLE delta_stanzas (stanza TEXT PRIMARY KEY)")
+    cur.executemany("INSERT INTO delta_stanzas VALUES (?)", changed)
+    cur.execute("DELETE FROM statements WHERE stanza IN (SELECT stanza FROM delta_stanzas)")
+    # Number the new blank nodes after the existing ones
+    cur.execute(
+        f"""INSERT INTO statements ({COLUMNS})
+        SELECT stanza,
+          CASE WHEN subject LIKE '_:b%' THEN '_:b' || (CAST(substr(subject, 4) AS INTEGER) + ?)
+          ELSE subject END,
+          predicate, object, value, datatype, language
+        FROM release WHERE stanza IN (SELECT stanza FROM delta_stanzas)
+        ORDER BY stanza, rowid""",
+        (max_node,),
+    )
+    update_axioms(cur, "delta_stanzas")
+    cur.execute("DROP TABLE delta_stanzas")
+    cur.execute("DROP TABLE release")
+    cur.execute("ANALYZE")
+    return changes
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("source", help="NCBITaxon RDF/XML file or directory with an NCBI taxdump")
+    parser.add_argument("db", help="Database with a prefix table to load statements into")
+    parser.add_argument(
+        "--delta",
+        metavar="REPORT",
+        help="Update the statements already in the database to the release in place, "
+        "and write the changes to this TSV",
+    )
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        cur = conn.cursor()
+        if args.delta:
+            changes = ingest_delta(cur, args.source)
+            with open(args.delta, "w") as f:
+                writer = csv.DictWriter(f, DELTA_HEADERS, delimiter="\t", lineterminator="\n")
+                writer.writeheader()
+                writer.writerows(changes)
+            print(f"Updated {len({x['Taxon ID'] for x in changes})} stanzas")
+            return
+        count = ingest(cur, args.source)
+        print(f"Inserted {count} statements, adding indexes...")
+        index_statements(cur)
+
+
+if __name__ == "__main__":
+    main()
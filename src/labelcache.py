@@ -0,0 +1,127 @@
+import hashlib
+import json
+import sqlite3
+import sys
+
+
+# Persistent cache of the automatically picked best labels (get-labels.py & run.py), so a build
+# only runs the label rules for taxa whose inputs changed since a previous build. Each entry is
+# keyed by:
+# - the tax ID
+# - a digest of everything the rules read for the taxon: its label, its exact synonyms, the synonym
+#   types of its axioms and its first related synonym
+# - the version of the rules, which the caller bumps whenever it changes them
+# A new NCBITaxon release only changes the digests of the taxa NCBI changed. IEDB label overrides
+# are not cached; they always win. Taxa without a better label are cached too (as NULL), since
+# they are most of the taxa. Adding an entry drops the other entries of the taxon for the same
+# rule version, so the cache holds one entry per taxon and rule version.
+
+
+def get_digests(cur, tax_ids):
+    """Get the digest of the label rule inputs of each taxon, reading each input with one query.
+
+    :param cur: database connection cursor
+    :param tax_ids: collection of tax IDs
+    :return: map of tax ID -> hex digest
+    """
+    labels = {}
+    cur.execute(
+        "SELECT stanza, value FROM statements WHERE predicate = 'rdfs:label' ORDER BY rowid"
+    )
+    for tax_id, value in cur:
+        labels.setdefault(tax_id, value)
+
+    # The rules pair every exact synonym with every synonym type in the stanza, so both lists are
+    # read separately, in statement order
+    exact_synonyms = {}
+    cur.execute(
+        """SELECT stanza, value FROM statements
+        WHERE predicate = 'oio:hasExactSynonym' ORDER BY rowid"""
+    )
+    for tax_id, value in cur:
+        exact_synonyms.setdefault(tax_id, []).append(value)
+
+    synonym_types = {}
+    cur.execute(
+        """SELECT stanza, object FROM statements
+        WHERE predicate = 'oio:hasSynonymType' AND subject LIKE '_:%' ORDER BY rowid"""
+    )
+    for tax_id, synonym_type in cur:
+        synonym_types.setdefault(tax_id, []).append(synonym_type)
+
+    related_synonyms = {}
+    cur.execute(
+        """SELECT stanza, value FROM statements
+        WHERE predicate = 'oio:hasRelatedSynonym' ORDER BY rowid"""
+    )
+    for tax_id, value in cur:
+        related_synonyms.setdefault(tax_id, value)
+
+    digests = {}
+    for tax_id in tax_ids:
+        inputs = [
+            labels.get(tax_id),
+            exact_synonyms.get(tax_id, []),
+            synonym_types.get(tax_id, []),
+            related_synonyms.get(tax_id),
+        ]
+        digests[tax_id] = hashlib.sha1(json.dumps(inputs).encode("utf-8")).hexdigest()
+    return digests
+
+
+def create_cache(conn):
+    """Create the cache table if it does not exist."""
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS best_labels (tax_id TEXT,
+                                                  digest TEXT,
+                                                  rule_version TEXT,
+                                                  label TEXT,
+                                                  source TEXT,
+                                                  PRIMARY KEY (tax_id, digest, rule_version))"""
+    )
+
+
+def get_best_labels(cur, tax_ids, path, rule_version, get_label):
+    """Get the best label of each taxon from the cache, running the label rules only for taxa that
+    are not in the cache with the same inputs and rule version, and add those to the cache.
+
+    :param cur: database connection cursor
+    :param tax_ids: list of tax IDs
+    :param path: path to the cache database (created if it does not exist)
+    :param rule_version: version of the label rules
+    :param get_label: function of tax ID -> (label, label source), or (None, None) to keep the
+        NCBITaxon label
+    :return: map of tax ID -> (label, label source)
+    """
+    digests = get_digests(cur, tax_ids)
+    with sqlite3.connect(path) as cache:
+        create_cache(cache)
+        cached = {}
+        for tax_id, digest, label, source in cache.execute(
+            "SELECT tax_id, digest, label, source FROM best_labels WHERE rule_version = ?",
+            (rule_version,),
+        ):
+            if digests.get(tax_id) == digest:
+                cached[tax_id] = (label, source)
+
+        results = {}
+        new_rows = []
+        for tax_id in tax_ids:
+            if tax_id in cached:
+                results[tax_id] = cached[tax_id]
+                continue
+            label, source = get_label(tax_id)
+            results[tax_id] = (label, source)
+            new_rows.append((tax_id, digests[tax_id], rule_version, label, source))
+        # Drop the entries that the new digests supersede
+        cache.executemany(
+            "DELETE FROM best_labels WHERE tax_id = ? AND rule_version = ?",
+            [(x[0], x[2]) for x in new_rows],
+        )
+        cache.executemany("INSERT INTO best_labels VALUES (?, ?, ?, ?, ?)", new_rows)
+    cache.close()
+    print(
+        f"Reused {len(tax_ids) - len(new_rows)} cached labels, computed {len(new_rows)}",
+        file=sys.stderr,
+    )
+    return results
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+
+from argparse import ArgumentParser
+
+
+# Normalized schema for finished databases: every CURIE in stanza, subject, predicate and object is
+# stored once in the term table, and the statements rows refer to it by integer ID. A statements
+# view over the integer table returns the usual text rows, so gizmos, the browser and the next
+# stages read a normalized database the same way as a plain one. Each row keeps its rowid as the
+# id of term_statements, which the view exposes as its rowid column, so ORDER BY rowid and the pos
+# of the edges, ranks and axioms tables still follow the statements order. The view is read-only,
+# so only normalize a database once nothing else will write to it.
+
+TERM_COLUMNS = ["stanza", "subject", "predicate", "object"]
+
+
+def is_normalized(cur):
+    """Return True if the database has already been normalized.
+
+    :param cur: database connection cursor
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'term'")
+    return cur.fetchone() is not None
+
+
+def normalize(conn):
+    """Replace the statements table with integer term IDs and a compatibility view. Rows keep
+    their rowids.
+
+    :param conn: database connection
+    """
+    cur = conn.cursor()
+    if is_normalized(cur):
+        return
+    cur.execute("CREATE TABLE term (id INTEGER PRIMARY KEY, curie TEXT NOT NULL UNIQUE)")
+    cur.execute(
+        f"""INSERT INTO term (curie)
+        SELECT curie FROM ({" UNION ".join(f"SELECT {x} AS curie FROM statements" for x in TERM_COLUMNS)})
+        WHERE curie IS NOT NULL"""
+    )
+
+    cur.execute(
+        """CREATE TABLE term_statements (id INTEGER PRIMARY KEY,
+                                         stanza INTEGER,
+                                         subject INTEGER,
+                                         predicate INTEGER,
+                                         object INTEGER,
+                                         value TEXT,
+                                         datatype TEXT,
+                                         language TEXT)"""
+    )
+    cur.execute(
+        """INSERT INTO term_statements
+        SELECT s.rowid, t1.id, t2.id, t3.id, t4.id, s.value, s.datatype, s.language
+        FROM statements s
+        LEFT JOIN term t1 ON t1.curie = s.stanza
+        LEFT JOIN term t2 ON t2.curie = s.subject
+        LEFT JOIN term t3 ON t3.curie = s.predicate
+        LEFT JOIN term t4 ON t4.curie = s.object
+        ORDER BY s.rowid"""
+    )
+    cur.execute("DROP TABLE statements")
+    cur.execute(
+        """CREATE VIEW statements AS
+        SELECT s.id AS rowid,
+               t1.curie AS stanza,
+               t2.curie AS subject,
+               t3.curie AS predicate,
+               t4.curie AS object,
+               s.value AS value,
+               s.datatype AS datatype,
+               s.language AS language
+        FROM term_statements s
+        LEFT JOIN term t1 ON t1.id = s.stanza
+        LEFT JOIN term t2 ON t2.id = s.subject
+        LEFT JOIN term t3 ON t3.id = s.predicate
+        LEFT JOIN term t4 ON t4.id = s.object"""
+    )
+    for column in TERM_COLUMNS + ["value"]:
+        cur.execute(f"CREATE INDEX idx_term_{column} ON term_statements ({column})")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.execute("ANALYZE")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Database to normalize in place")
+    args = parser.parse_args()
+
+    size = os.path.getsize(args.db)
+    with sqlite3.connect(args.db) as conn:
+        normalize(conn)
+    print(f"Normalized {args.db}: {size:,} -> {os.path.getsize(args.db):,} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,12 @@
 
 import csv
 import sqlite3
+import sys
 
 from argparse import ArgumentParser
 from collections import defaultdict
+from diff import diff_stages, get_tree_state
+from engine import organize as organize_tree
 from helpers import (
     copy_database,
     get_all_ancestors,
@@ -14,6 +17,7 @@ from helpers import (
     move_precious_to_other,
     move_rank_to_other,
 )
+from taxtree import Tree
 
 
 def get_top_ancestor(child_parent, node, limit):
@@ -95,11 +99,7 @@ def move_up(cur, top_level_id, top_level_label, rank, precious=None, extras=None
         other_organisms.add(move)
 
     # Find non-rank level nodes under top-level
-    cur.execute(
-        """SELECT DISTINCT subject FROM statements
-        WHERE predicate = 'rdfs:subClassOf' AND object = ?""",
-        (top_level,),
-    )
+    cur.execute("SELECT DISTINCT child FROM edges WHERE parent = ?", (top_level,))
     non_at_rank = []
     for row in cur.fetchall():
         tax_id = row[0]
@@ -138,11 +138,7 @@ def organize(cur, top_level, precious):
 
         if rank == "manual":
             # Everything NOT in this set gets moved to other
-            cur.execute(
-                """SELECT DISTINCT subject FROM statements
-                WHERE object = ? AND predicate = 'rdfs:subClassOf'""",
-                (curie,),
-            )
+            cur.execute("SELECT DISTINCT child FROM edges WHERE parent = ?", (curie,))
             others = []
             for row in cur.fetchall():
                 if row[0] not in top_level:
@@ -162,6 +158,32 @@ def organize(cur, top_level, precious):
         move_up(cur, details["ID"], details["Label"], rank, extras=extras, precious=precious)
 
 
+def verify(conn, top_level, precious):
+    """Run the legacy organize and the in-memory organize on copies of the same database and
+    compare the resulting trees.
+
+    :param conn: database connection (not modified)
+    :param top_level: map of top level ID -> details
+    :param precious: list of taxa to keep
+    :return: list of differences (term, change, legacy parent, new parent, legacy label, new label)
+    """
+    conn.commit()
+    legacy_conn = sqlite3.connect(":memory:")
+    conn.backup(legacy_conn)
+    organize(legacy_conn.cursor(), top_level, precious)
+
+    new_conn = sqlite3.connect(":memory:")
+    conn.backup(new_conn)
+    cur = new_conn.cursor()
+    tree = Tree.load(cur)
+    organize_tree(tree, top_level, precious)
+    tree.write(cur)
+
+    legacy_parents, legacy_labels = get_tree_state(legacy_conn.cursor())
+    new_parents, new_labels = get_tree_state(cur)
+    return diff_stages(legacy_parents, legacy_labels, new_parents, new_labels)
+
+
 def get_line(top_structure, line, node):
     children = top_structure.get(node)
     if not children:
@@ -171,25 +193,17 @@ def get_line(top_structure, line, node):
         get_line(top_structure, line, c)
 
 
-def main():
-    parser = ArgumentParser()
-    parser.add_argument("db")
-    parser.add_argument("top_level")
-    parser.add_argument("precious")
-    parser.add_argument("output")
-    args = parser.parse_args()
-
-    precious = []
-    with open(args.precious, "r") as f:
-        reader = csv.reader(f, delimiter="\t")
-        for row in reader:
-            precious.append(get_curie(row[0]))
+def get_top_level(path):
+    """Read the stable top level sheet, ordered from the lowest level to the highest.
 
+    :param path: path to top level TSV
+    :return: map of top level ID -> details
+    """
     # ID -> Details
     top_level_unordered = {}
     # Parent -> Children
     top_structure = defaultdict(set)
-    with open(args.top_level, "r") as f:
+    with open(path, "r") as f:
         reader = csv.DictReader(f, delimiter="\t")
         for row in reader:
             tax_id = get_curie(row["ID"])
@@ -208,25 +222,65 @@ def main():
         full_line.extend(line)
     # Go from lowest -> highest level
     full_line.reverse()
-    top_level = {node: top_level_unordered[node] for node in full_line}
+    return {node: top_level_unordered[node] for node in full_line}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db")
+    parser.add_argument("top_level")
+    parser.add_argument("precious")
+    parser.add_argument("output")
+    parser.add_argument(
+        "--legacy", action="store_true", help="Organize with per-node SQL updates"
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Compare the in-memory organize with the legacy organize (output is not changed)",
+    )
+    args = parser.parse_args()
+
+    precious = []
+    with open(args.precious, "r") as f:
+        reader = csv.reader(f, delimiter="\t")
+        for row in reader:
+            precious.append(get_curie(row[0]))
+
+    top_level = get_top_level(args.top_level)
 
     copy_database(args.db, args.output)
     with sqlite3.connect(args.output) as conn:
         cur = conn.cursor()
-        cur.execute(
-            """INSERT INTO statements (stanza, subject, predicate, object, value) VALUES
-            ('iedb-taxon:0100026-other',
-             'iedb-taxon:0100026-other',
-             'rdfs:subClassOf',
-             'OBI:0100026',
-             null),
-            ('iedb-taxon:0100026-other',
-             'iedb-taxon:0100026-other',
-             'rdfs:label',
-             null,
-             'Other Organism');"""
-        )
-        organize(cur, top_level, precious)
+        # Other Organism is already there when the override stage moved zero-epitope terms to it
+        cur.execute("SELECT 1 FROM statements WHERE stanza = 'iedb-taxon:0100026-other'")
+        if not cur.fetchone():
+            cur.execute(
+                """INSERT INTO statements (stanza, subject, predicate, object, value) VALUES
+                ('iedb-taxon:0100026-other',
+                 'iedb-taxon:0100026-other',
+                 'rdfs:subClassOf',
+                 'OBI:0100026',
+                 null),
+                ('iedb-taxon:0100026-other',
+                 'iedb-taxon:0100026-other',
+                 'rdfs:label',
+                 null,
+                 'Other Organism');"""
+            )
+        if args.verify:
+            differences = verify(conn, top_level, precious)
+            for term, change, legacy_parent, new_parent, legacy_label, new_label in differences:
+                print(f"{term}\t{change}\t{legacy_parent}\t{new_parent}\t{legacy_label}\t{new_label}")
+            print(f"{len(differences)} differences from legacy organize")
+            if differences:
+                sys.exit(1)
+        if args.legacy:
+            organize(cur, top_level, precious)
+        else:
+            tree = Tree.load(cur)
+            organize_tree(tree, top_level, precious)
+            tree.write(cur)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,156 @@
 #!/usr/bin/env python3
 
 import csv
+import logging
 import sqlite3
 
 from argparse import ArgumentParser
-from collections import defaultdict
-from helpers import clean_no_epitopes, get_child_ancestors, get_child_parents, get_count_map, get_cumulative_counts, get_curie
+from edges import add_edge_tables
+from engine import get_no_epitope_branches
+from helpers import get_count_map, get_curie
+from taxtree import Tree
+
+
+# Overrides are staged in temp tables and applied with a few set-based statements in the caller's
+# transaction, so the number of statements does not grow with the number of overrides. Overrides
+# for terms without a label (or parent) change nothing and are reported; the label sources and
+# synonyms of label overrides are added either way.
+
+
+def apply_label_overrides(cur, overrides):
+    """Replace the labels of terms and add the label sources (as blank nodes) and synonyms. When a
+    term has more than one override, the last one wins.
+
+    :param cur: database connection cursor
+    :param overrides: (tax ID, label, label source, comma-separated synonyms) tuples
+    :return: tax IDs of the overrides that matched no label
+    """
+    cur.execute("DROP TABLE IF EXISTS temp.label_overrides")
+    cur.execute("DROP TABLE IF EXISTS temp.synonym_overrides")
+    cur.execute(
+        """CREATE TEMP TABLE label_overrides (seq INTEGER PRIMARY KEY,
+                                              tax_id TEXT,
+                                              label TEXT,
+                                              source TEXT)"""
+    )
+    cur.execute(
+        """CREATE TEMP TABLE synonym_overrides (seq INTEGER PRIMARY KEY,
+                                                label_seq INTEGER,
+                                                tax_id TEXT,
+                                                synonym TEXT)"""
+    )
+    labels = []
+    synonyms = []
+    for seq, (tax_id, label, source, syns) in enumerate(overrides, start=1):
+        labels.append((seq, tax_id, label, source))
+        for syn in syns.split(","):
+            if syn.strip() == "":
+                continue
+            synonyms.append((seq, tax_id, syn))
+    cur.executemany("INSERT INTO label_overrides VALUES (?, ?, ?, ?)", labels)
+    cur.executemany(
+        "INSERT INTO synonym_overrides (label_seq, tax_id, synonym) VALUES (?, ?, ?)", synonyms
+    )
+    cur.execute("CREATE INDEX temp.idx_label_overrides ON label_overrides (tax_id, seq)")
+
+    cur.execute(
+        """SELECT tax_id FROM label_overrides o
+        WHERE NOT EXISTS (SELECT 1 FROM statements s
+                          WHERE s.stanza = o.tax_id
+                            AND s.subject = o.tax_id
+                            AND s.predicate = 'rdfs:label')
+        GROUP BY tax_id ORDER BY min(seq)"""
+    )
+    unmatched = [row[0] for row in cur.fetchall()]
+
+    cur.execute(
+        """UPDATE statements
+        SET value = (SELECT label FROM label_overrides o
+                     WHERE o.tax_id = statements.stanza
+                     ORDER BY seq DESC LIMIT 1)
+        WHERE stanza IN (SELECT tax_id FROM label_overrides)
+          AND subject = stanza
+          AND predicate = 'rdfs:label'"""
+    )
+    # Each label source gets its own blank node, numbered in override order, and is followed by
+    # the synonyms of the same override
+    cur.execute(
+        """INSERT INTO statements (stanza, subject, predicate, value)
+        SELECT stanza, subject, predicate, value FROM (
+          SELECT seq, 0 AS n, tax_id AS stanza, printf('_:bnode%08d', seq) AS subject,
+                 'oio:hasLabelSource' AS predicate, source AS value
+          FROM label_overrides
+          UNION ALL
+          SELECT label_seq, seq, tax_id, tax_id, 'oio:hasExactSynonym', synonym
+          FROM synonym_overrides
+        ) ORDER BY seq, n"""
+    )
+    cur.execute("DROP TABLE temp.label_overrides")
+    cur.execute("DROP TABLE temp.synonym_overrides")
+    return unmatched
+
+
+def apply_parent_overrides(cur, overrides):
+    """Replace the parents of terms. When a term has more than one override, the last one wins.
+
+    :param cur: database connection cursor
+    :param overrides: (tax ID, parent ID) tuples
+    :return: tax IDs of the overrides that matched no parent
+    """
+    cur.execute("DROP TABLE IF EXISTS temp.parent_overrides")
+    cur.execute(
+        """CREATE TEMP TABLE parent_overrides (seq INTEGER PRIMARY KEY,
+                                               tax_id TEXT,
+                                               parent_id TEXT)"""
+    )
+    cur.executemany(
+        "INSERT INTO parent_overrides (tax_id, parent_id) VALUES (?, ?)", list(overrides)
+    )
+    cur.execute("CREATE INDEX temp.idx_parent_overrides ON parent_overrides (tax_id, seq)")
+
+    cur.execute(
+        """SELECT tax_id FROM parent_overrides o
+        WHERE NOT EXISTS (SELECT 1 FROM statements s
+                          WHERE s.stanza = o.tax_id
+                            AND s.subject = o.tax_id
+                            AND s.predicate = 'rdfs:subClassOf')
+        GROUP BY tax_id ORDER BY min(seq)"""
+    )
+    unmatched = [row[0] for row in cur.fetchall()]
+
+    cur.execute(
+        """UPDATE statements
+        SET object = (SELECT parent_id FROM parent_overrides o
+                      WHERE o.tax_id = statements.stanza
+                      ORDER BY seq DESC LIMIT 1)
+        WHERE stanza IN (SELECT tax_id FROM parent_overrides)
+          AND subject = stanza
+          AND predicate = 'rdfs:subClassOf'"""
+    )
+    cur.execute("DROP TABLE temp.parent_overrides")
+    return unmatched
+
+
+def report_unmatched(kind, total, unmatched):
+    """Log the overrides that matched nothing.
+
+    :param kind: "label" or "parent"
+    :param total: number of overrides
+    :param unmatched: tax IDs of the overrides that matched nothing
+    """
+    if unmatched:
+        logging.warning(
+            f"{len(unmatched)} of {total} {kind} overrides matched nothing:\n- "
+            + "\n- ".join(unmatched)
+        )
 
 
 def update_names(cur, names):
+    """Replace cellular organisms with OBI organism and apply the label overrides.
+
+    :param cur: database connection cursor
+    :param names: label override rows (Taxon ID, Label, Label Source, Synonyms)
+    """
     # Replace cellular organisms with OBI organism
     cur.execute(
         "UPDATE statements SET stanza = 'OBI:0100026' WHERE stanza = 'NCBITaxon:131567';"
@@ -25,53 +167,63 @@ def update_names(cur, names):
     cur.execute(
         "UPDATE statements SET object = 'OBI:0100026' WHERE object = 'NCBITaxon:131567';"
     )
-    bnode_id = 1
-    with open(names, "r") as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        for row in reader:
-            tax_id = row["Taxon ID"]
-            new_label = row["Label"]
-            label_source = row["Label Source"]
-            cur.execute(
-                """UPDATE statements SET value = ?
-                WHERE stanza = ? AND subject = ? AND predicate = 'rdfs:label'""",
-                (new_label, tax_id, tax_id),
-            )
-            cur.execute(
-                """INSERT INTO statements (stanza, subject, predicate, value) VALUES
-                (?, ?, 'oio:hasLabelSource', ?)""", (tax_id, f"_:bnode{bnode_id:08}", label_source))
-            bnode_id += 1
-            for syn in row["Synonyms"].split(","):
-                if syn.strip() == "":
-                    continue
-                cur.execute(
-                    """INSERT INTO statements (stanza, subject, predicate, value) VALUES
-                    (?, ?, "oio:hasExactSynonym", ?)""",
-                    (tax_id, tax_id, syn),
-                )
+    overrides = [
+        (row["Taxon ID"], row["Label"], row["Label Source"], row["Synonyms"]) for row in names
+    ]
+    report_unmatched("label", len(overrides), apply_label_overrides(cur, overrides))
 
 
 def update_parents(cur, parents):
     with open(parents, "r") as f:
         reader = csv.DictReader(f, delimiter="\t")
-        for row in reader:
-            tax_id = get_curie(row["Taxon ID"])
-            parent_id = get_curie(row["Parent ID"])
-            cur.execute(
-                """
-                UPDATE statements
-                SET object = ?
-                WHERE stanza = ? AND subject = ? AND predicate = 'rdfs:subClassOf';
-            """,
-                (parent_id, tax_id, tax_id),
-            )
+        overrides = [(get_curie(row["Taxon ID"]), get_curie(row["Parent ID"])) for row in reader]
+    report_unmatched("parent", len(overrides), apply_parent_overrides(cur, overrides))
+
+
+def override(cur, names, parents):
+    """Apply the label and parent overrides to a statements table.
+
+    :param cur: database connection cursor
+    :param names: label override rows (Taxon ID, Label, Label Source, Synonyms)
+    :param parents: path to parent overrides TSV
+    """
+    # Override labels with IEDB labels
+    print("updating labels...")
+    update_names(cur, names)
+
+    # Override parents
+    print("updating parents...")
+    update_parents(cur, parents)
+
+
+def clean(tree, count_map, precious=None):
+    """Move the zero-epitope branches of the overridden tree to 'Other Organism', which is added
+    under Organism when there is anything to move. Precious taxa and their ancestors stay in place
+    like taxa with epitopes.
+
+    :param tree: Tree to clean
+    :param count_map: map of ID -> epitope count
+    :param precious: collection of taxa to keep
+    """
+    counts = dict(count_map)
+    for tax_id in precious or ():
+        counts[tax_id] = max(counts.get(tax_id, 0), 1)
+    remove = get_no_epitope_branches(tree, tree.get_cumulative_counts(counts))
+    if not remove:
+        return
+    if "iedb-taxon:0100026-other" not in tree.terms:
+        tree.add_node("iedb-taxon:0100026-other", "OBI:0100026", "Other Organism")
+    tree.move_all(remove, "iedb-taxon:0100026-other")
 
 
 def update(source, target, precious, counts, names, parents):
     with sqlite3.connect(source) as conn:
         # Get stanzas from source database
         cur = conn.cursor()
-        cur.execute("SELECT * FROM statements")
+        cur.execute(
+            """SELECT stanza, subject, predicate, object, value, datatype, language
+            FROM statements"""
+        )
         rows = cur.fetchall()
         insert = []
         for r in rows:
@@ -98,26 +250,10 @@ def update(source, target, precious, counts, names, parents):
                                                         language TEXT)"""
             )
             cur_new.execute(f"INSERT INTO statements VALUES " + insert)
+            add_edge_tables(cur_new)
 
-            # Override labels with IEDB labels
-            print("updating labels...")
-            update_names(cur_new, names)
-
-            # Override parents
-            print("updating parents...")
-            update_parents(cur_new, parents)
-
-            # Get updated child->ancestors
-            child_parents = get_child_parents(cur_new)
-            child_ancestors = defaultdict(set)
-            for child in child_parents.keys():
-                if child not in child_ancestors:
-                    child_ancestors[child] = set()
-                get_child_ancestors(child_ancestors, child_parents, child, child)
-
-            # Use child->ancestors to get updated cumulative epitope counts
-            count_map = get_count_map(counts)
-            cuml_counts = get_cumulative_counts(count_map, child_ancestors)
+            with open(names, "r") as f:
+                override(cur_new, csv.DictReader(f, delimiter="\t"), parents)
 
             precious_terms = []
             with open(precious, "r") as f:
@@ -126,7 +262,9 @@ def update(source, target, precious, counts, names, parents):
                     precious_terms.append(get_curie(row[0]))
 
             # Clean up zero-epitope terms
-            clean_no_epitopes(cur_new, cuml_counts, precious_terms)
+            tree = Tree.load(cur_new)
+            clean(tree, get_count_map(counts), precious_terms)
+            tree.write(cur_new)
 
 
 def main():
@@ -134,12 +272,19 @@ def main():
     parser.add_argument("db", type=str, help="Existing NCBITaxon database to update")
     parser.add_argument("name_overrides", type=str, help="Label overrides")
     parser.add_argument("parent_overrides", type=str, help="Parent taxa overrides")
-    parser.add_argument("precious")
+    parser.add_argument("precious", type=str, help="List of taxa to keep")
     parser.add_argument("child_parents", type=str, help="Child parent map from database to update")
     parser.add_argument("counts", type=str, help="Epitope counts")
     parser.add_argument("output", type=str, help="Output database")
     args = parser.parse_args()
-    update(args.db, args.output, args.precious, args.counts, args.name_overrides, args.parent_overrides)
+    update(
+        args.db,
+        args.output,
+        args.precious,
+        args.counts,
+        args.name_overrides,
+        args.parent_overrides,
+    )
 
 
 if __name__ == "__main__":
@@ -17,4 +17,5 @@ INSERT OR IGNORE INTO prefix VALUES
 ("NCBITaxon",  "http://purl.obolibrary.org/obo/NCBITaxon_"),
 ("ncbitaxon",  "http://purl.obolibrary.org/obo/ncbitaxon#"),
 ("OBI",        "http://purl.obolibrary.org/obo/OBI_"),
+("ONTIE",      "https://ontology.iedb.org/ontology/ONTIE_"),
 ("iedb-taxon", "http://iedb.org/taxon/");
\ No newline at end of file
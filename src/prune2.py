@@ -2,42 +2,27 @@ import csv
 import sqlite3
 
 from argparse import ArgumentParser
-from collections import defaultdict
-from helpers import (
-    copy_database,
-    create_other,
-    get_child_ancestors,
-    get_count_map,
-    get_cumulative_counts,
-    get_curie,
-)
-
-
-def get_collapse(data, collapse, prev_nodes, threshold=0.99):
-    child_parents = data["child_parents"]
-    counts = data["counts"]
-    precious = data["precious"]
+from engine import get_threshold_chains
+from helpers import copy_database, get_count_map, get_curie
+from snapshot import get_cumulative_counts, load_child_parents
+from taxtree import Tree
 
-    last_node = prev_nodes[-1]
-    current_node = child_parents.get(last_node)
-    if not current_node or current_node == "NCBITaxon:1" or current_node.endswith("other"):
-        return
 
-    prev_count = counts.get(last_node, 0)
-    cur_count = counts.get(current_node, 0)
-    if current_node not in precious and prev_count / cur_count > threshold:
-        # Continue to check the next one until we hit one with less than threshold
-        prev_nodes.append(current_node)
-        get_collapse(data, collapse, prev_nodes, threshold=threshold)
+def collapse(tree, child_parents, chains):
+    """Apply the collapse steps in order: move the first node of each step up to the parent of the
+    last node, and the last node to that parent's 'other' node.
 
-    # End with prev node
-    if prev_nodes[0] != last_node:
-        prev_nodes.append(last_node)
-        collapse.append(prev_nodes)
-
-    # Continue with this node as the start node
-    prev_nodes = [current_node]
-    get_collapse(data, collapse, prev_nodes, threshold=threshold)
+    :param tree: Tree to change
+    :param child_parents: map of child -> parent before pruning
+    :param chains: list of (first node, last node) from get_threshold_chains
+    """
+    for first_node, last_node in chains:
+        parent_node = child_parents[last_node]
+        # Create the "other" class for the parent
+        parent_tax = parent_node.split(":")[1]
+        other_id = tree.create_other(parent_tax, tree.labels.get(parent_node, parent_node))
+        tree.move(first_node, parent_node)
+        tree.move(last_node, other_id)
 
 
 def prune(cur, data, threshold=0.99):
@@ -48,43 +33,36 @@ def prune(cur, data, threshold=0.99):
     cur.execute(
         """SELECT DISTINCT stanza FROM statements
            WHERE object = 'owl:Class'
-           AND stanza NOT IN (SELECT object FROM statements
-            WHERE predicate = 'rdfs:subClassOf')"""
+           AND stanza NOT IN (SELECT parent FROM edges)"""
     )
-    for res in cur.fetchall():
-        s = res[0]
-        if counts.get(s, 0) == 0:
-            continue
-        # Go up until we find a parent that does not have > 99% of epitopes
-        collapse = []
-        get_collapse(data, collapse, [s], threshold=threshold)
-        for c in collapse:
-            first_node = c[0]
-            last_node = c[-1]
-            parent_node = child_parents.get(last_node)
-            if not parent_node:
-                continue
-            # Create the "other" class for the parent
-            cur.execute(
-                "SELECT value FROM statements WHERE stanza = ? AND predicate = 'rdfs:label'",
-                (parent_node,),
-            )
-            res = cur.fetchone()
-            if res:
-                parent_label = res[0]
-            else:
-                parent_label = parent_node
-            parent_tax = parent_node.split(":")[1]
-            create_other(cur, parent_tax, parent_label)
-
-            cur.execute(
-                "UPDATE statements SET object = ? WHERE stanza = ? AND predicate = 'rdfs:subClassOf'",
-                (parent_node, first_node),
-            )
-            cur.execute(
-                "UPDATE statements SET object = ? WHERE stanza = ? AND predicate = 'rdfs:subClassOf'",
-                (f"iedb-taxon:{parent_tax}-other", last_node),
-            )
+    starts = [x[0] for x in cur.fetchall() if counts.get(x[0], 0) != 0]
+
+    # Go up until we find a parent that does not have > 99% of epitopes
+    chains = get_threshold_chains(
+        child_parents, counts, data["precious"], starts, threshold=threshold
+    )
+
+    tree = Tree.load(cur)
+    collapse(tree, child_parents, chains)
+    tree.write(cur)
+
+
+def prune_tree(tree, cuml_counts, precious, threshold=0.99):
+    """Collapse chains of nodes with more than the threshold of their parent's epitopes on an
+    in-memory tree, the same as prune.
+
+    :param tree: Tree to prune
+    :param cuml_counts: map of ID -> cumulative epitope count
+    :param precious: set of taxa to keep
+    :param threshold: threshold for percentage of epitopes
+    """
+    # Start from bottom nodes, in table order
+    leaves = sorted(tree.get_leaves(), key=lambda x: tree.order.get(x, len(tree.order)))
+    starts = [x for x in leaves if cuml_counts.get(x, 0) != 0]
+
+    child_parents = dict(tree.child_parents)
+    chains = get_threshold_chains(child_parents, cuml_counts, precious, starts, threshold=threshold)
+    collapse(tree, child_parents, chains)
 
 
 def main():
@@ -92,7 +70,7 @@ def main():
     parser.add_argument("db", help="Database to add counts to")
     parser.add_argument("precious", help="List of taxa to keep")
     parser.add_argument("counts", help="TSV containing ID -> epitope count")
-    parser.add_argument("child_parents", help="TSV containing ID -> parent")
+    parser.add_argument("child_parents", help="Snapshot or TSV containing ID -> parent")
     parser.add_argument("output", help="Output database")
     args = parser.parse_args()
 
@@ -102,34 +80,19 @@ def main():
         for row in reader:
             precious.append(get_curie(row[0]))
 
-    child_parents = {}
-    with open(args.child_parents, "r") as f:
-        reader = csv.reader(f, delimiter="\t")
-        for row in reader:
-            if row[0] == row[1]:
-                continue
-            parent = row[1]
-            child_parents[row[0]] = parent
-
-    child_ancestors = defaultdict(set)
-    for child in child_parents.keys():
-        if child not in child_ancestors:
-            child_ancestors[child] = set()
-        get_child_ancestors(child_ancestors, child_parents, child, child)
+    child_parents = load_child_parents(args.child_parents)
 
     count_map = get_count_map(args.counts)
 
     data = {
-        "child_ancestors": child_ancestors,
         "child_parents": child_parents,
-        "precious": precious,
+        "counts": get_cumulative_counts(child_parents, count_map),
+        "precious": set(precious),
     }
 
     copy_database(args.db, args.output)
     with sqlite3.connect(args.output) as conn:
         cur = conn.cursor()
-        cuml_counts = get_cumulative_counts(count_map, child_ancestors)
-        data["counts"] = cuml_counts
         prune(cur, data)
 
 
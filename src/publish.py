@@ -0,0 +1,109 @@
+import hashlib
+import os
+import sqlite3
+
+from argparse import ArgumentParser
+from axioms import add_axiom_table
+from edges import add_edge_table
+from normalize import normalize
+
+
+# Publish a finished database for the browser. The rows are rewritten into a new file grouped by
+# stanza (so one term's rows share pages), with only the tables and indexes the browser and search
+# use (the edges and axioms tables, but not ranks or the sync triggers: the published file is
+# read-only), fresh statistics and a fingerprint of the content. The new file replaces the output
+# with one rename, so a browser request sees either the old file or the new one, never a partial
+# file.
+
+BROWSER_INDEXES = ["stanza", "subject", "object", "value"]
+
+
+def get_fingerprint(cur):
+    """Get the SHA-256 of all statements rows in stanza order (the order publish copies them in).
+
+    :param cur: database connection cursor
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    cur.execute(
+        """SELECT stanza, subject, predicate, object, value, datatype, language
+        FROM statements ORDER BY rowid"""
+    )
+    for row in cur:
+        digest.update(repr(row).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def publish(db, output, normalized=False):
+    """Write a read-optimized copy of a database and atomically move it into place.
+
+    :param db: path to finished database
+    :param output: path to published database
+    :param normalized: if True, store the statements with integer term IDs (see normalize.py)
+    :return: fingerprint of the published statements
+    """
+    tmp = output + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        with sqlite3.connect(tmp) as conn:
+            cur = conn.cursor()
+            cur.execute("ATTACH DATABASE ? AS source", (db,))
+            cur.execute("CREATE TABLE prefix AS SELECT * FROM source.prefix")
+            cur.execute(
+                """CREATE TABLE statements (stanza TEXT,
+                                            subject TEXT,
+                                            predicate TEXT,
+                                            object TEXT,
+                                            value TEXT,
+                                            datatype TEXT,
+                                            language TEXT)"""
+            )
+            cur.execute(
+                """INSERT INTO statements
+                SELECT stanza, subject, predicate, object, value, datatype, language
+                FROM source.statements ORDER BY stanza, rowid"""
+            )
+            conn.commit()
+            cur.execute("DETACH DATABASE source")
+
+            add_edge_table(cur)
+            add_axiom_table(cur)
+            fingerprint = get_fingerprint(cur)
+            cur.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+            cur.execute("SELECT count(*) FROM statements")
+            cur.execute(
+                "INSERT INTO metadata VALUES ('fingerprint', ?), ('statements', ?)",
+                (fingerprint, cur.fetchone()[0]),
+            )
+            if normalized:
+                normalize(conn)
+            else:
+                for column in BROWSER_INDEXES:
+                    cur.execute(f"CREATE INDEX idx_{column} ON statements ({column})")
+                conn.commit()
+                conn.execute("VACUUM")
+                conn.execute("ANALYZE")
+        conn.close()
+        os.replace(tmp, output)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return fingerprint
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Finished database")
+    parser.add_argument("output", help="Published database to replace")
+    parser.add_argument(
+        "--normalize", action="store_true", help="Store statements with integer term IDs"
+    )
+    args = parser.parse_args()
+
+    fingerprint = publish(args.db, args.output, normalized=args.normalize)
+    print(f"Published {args.output} ({fingerprint})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import multiprocessing
+
+from engine import (
+    REHOME_ROOTS,
+    clean_no_epitopes,
+    get_collapse_moves,
+    organize,
+    rehome,
+)
+from helpers import get_curie
+
+
+# Sharded build of the organize, prune, rehome and zero-epitope cleanup stages.
+#
+# After override, the tree is split at stable top level nodes whose subtrees no other stage reaches
+# into. Each shard runs all four stages in a worker process on a forked copy of the tree and
+# returns the changes of each stage. The main process runs the same stages on the rest of the tree
+# (the trunk) and applies the shard changes stage by stage, so the result is the same as the
+# serial build.
+
+# State shared with the forked workers
+_state = {}
+
+
+def get_loaded_ancestors(tree, node):
+    """Yield (ancestor, child on the path to node) for all ancestors of a node."""
+    seen = {node}
+    parent = tree.get_parent(node)
+    while parent is not None and parent not in seen:
+        yield parent, node
+        seen.add(parent)
+        node = parent
+        parent = tree.get_parent(node)
+
+
+def get_final_ancestors(tree, top_level, node):
+    """Yield (ancestor, child on the path to node) for all ancestors of a top level node after
+    organize: its top level parents, then the ancestors of the first parent that is not top level.
+    """
+    seen = {node}
+    parent = get_curie(top_level[node]["Parent ID"])
+    while parent in top_level and parent not in seen:
+        yield parent, node
+        seen.add(parent)
+        node = parent
+        parent = get_curie(top_level[node]["Parent ID"])
+    if parent in seen:
+        return
+    yield parent, node
+    yield from get_loaded_ancestors(tree, parent)
+
+
+def get_shards(tree, top_level, rehome_roots=None):
+    """Find the top level nodes that can be built as independent shards. A top level node is a shard
+    when:
+    - no ancestor (before or after organize) is a rehome root
+    - every top level ancestor leaves it in place: it has no Child Rank, or it is 'manual' and the
+      node is under one of its top level children (which are never moved)
+    - the top level nodes under it before organize are the same as after organize
+    When shards are nested, the lowest ones are used and the rest is built with the trunk.
+
+    :param tree: Tree after override
+    :param top_level: map of top level ID -> details, lowest level first
+    :param rehome_roots: nodes that rehome starts from
+    :return: map of shard root -> top level IDs in the shard (lowest level first)
+    """
+    if rehome_roots is None:
+        rehome_roots = REHOME_ROOTS
+    rehome_roots = set(rehome_roots)
+
+    def leaves_in_place(ancestor, child):
+        if ancestor in rehome_roots:
+            return False
+        if ancestor not in top_level:
+            return True
+        rank = top_level[ancestor].get("Child Rank", "").strip()
+        return rank == "" or (rank == "manual" and child in top_level)
+
+    loaded = {}
+    final = {}
+    for node in top_level:
+        if node not in tree.terms:
+            continue
+        loaded[node] = list(get_loaded_ancestors(tree, node))
+        final[node] = list(get_final_ancestors(tree, top_level, node))
+
+    candidates = {}
+    for node in loaded:
+        if not all(leaves_in_place(a, c) for a, c in loaded[node] + final[node]):
+            continue
+        loaded_members = {x for x in loaded if any(a == node for a, _ in loaded[x])}
+        final_members = {x for x in final if any(a == node for a, _ in final[x])}
+        if loaded_members != final_members:
+            continue
+        candidates[node] = loaded_members
+
+    shards = {}
+    for node in top_level:
+        if node not in candidates or candidates[node].intersection(candidates):
+            continue
+        members = candidates[node] | {node}
+        shards[node] = [x for x in top_level if x in members]
+    return shards
+
+
+def run_shard(root):
+    """Run organize, prune, rehome and zero-epitope cleanup on the subtree of one shard root.
+
+    :param root: shard root
+    :return: list of the changes of each stage (see Tree.pop_changes), and True if the zero-epitope
+             cleanup was done for the whole shard
+    """
+    tree = _state["tree"]
+    counts = _state["counts"]
+    top_level = _state["top_level"]
+    precious = _state["precious"]
+    results = []
+
+    organize(tree, top_level, precious, nodes=set(_state["shards"][root]))
+    results.append(tree.pop_changes())
+
+    cuml_counts = tree.get_cumulative_counts(counts, [root])
+    nodes = tree.get_topological_order([root])
+    child_parents = {x: tree.child_parents[x] for x in nodes if x in tree.child_parents}
+    starts = [x for x in nodes if x in tree.classes and not tree.children.get(x)]
+    starts = [x for x in starts if counts.get(x, 0) != 0]
+    moves = get_collapse_moves(
+        child_parents, cuml_counts, _state["prune_precious"], top_level, starts
+    )
+    for node, parent in moves.items():
+        tree.move(node, parent)
+    results.append(tree.pop_changes())
+
+    cuml_counts = tree.get_cumulative_counts(counts, [root])
+    roots = [x for x in _state["rehome_roots"] if x in cuml_counts]
+    rehome(tree, cuml_counts, precious, roots=roots)
+    results.append(tree.pop_changes())
+
+    # If the whole shard has no epitopes, the branch to remove may be above the shard root
+    cuml_counts = tree.get_cumulative_counts(counts, [root])
+    cleaned = cuml_counts.get(root, 0) > 0
+    if cleaned:
+        leaves = [x for x in cuml_counts if not tree.children.get(x)]
+        clean_no_epitopes(tree, cuml_counts, leaves)
+    results.append(tree.pop_changes())
+    return results, cleaned
+
+
+def build(tree, counts, top_level, precious, jobs, rehome_roots=None):
+    """Run organize, prune, rehome and zero-epitope cleanup with the shards in worker processes.
+
+    :param tree: Tree after override
+    :param counts: map of ID -> epitope count
+    :param top_level: map of top level ID -> details, lowest level first
+    :param precious: collection of taxa to keep
+    :param jobs: number of worker processes
+    :param rehome_roots: nodes that rehome starts from (default REHOME_ROOTS)
+    :return: number of shards
+    """
+    if rehome_roots is None:
+        rehome_roots = REHOME_ROOTS
+    shards = get_shards(tree, top_level, rehome_roots)
+    precious = tree.get_precious_index(precious)
+    prune_precious = set(counts.keys())
+    prune_precious.update(top_level.keys())
+
+    # Workers are forked, so they share the loaded tree instead of copying it
+    _state.update(
+        tree=tree,
+        counts=counts,
+        top_level=top_level,
+        precious=precious,
+        prune_precious=prune_precious,
+        rehome_roots=rehome_roots,
+        shards=shards,
+    )
+    try:
+        with multiprocessing.get_context("fork").Pool(jobs) as pool:
+            results = pool.map(run_shard, shards)
+    finally:
+        _state.clear()
+
+    def get_shard_nodes(roots):
+        return set(tree.get_topological_order(roots))
+
+    def apply(stage):
+        for stage_changes, _ in results:
+            tree.apply_changes(*stage_changes[stage])
+
+    # Organize
+    apply(0)
+    members = {x for shard in shards.values() for x in shard}
+    organize(tree, top_level, precious, nodes=set(top_level) - members)
+
+    # Prune - all moves are found before any are made, then the shard moves are added
+    shard_nodes = get_shard_nodes(shards)
+    cuml_counts = tree.get_cumulative_counts(counts)
+    starts = [x for x in tree.get_leaves() if counts.get(x, 0) != 0 and x not in shard_nodes]
+    moves = get_collapse_moves(tree.child_parents, cuml_counts, prune_precious, top_level, starts)
+    for node, parent in moves.items():
+        tree.move(node, parent)
+    apply(1)
+
+    # Rehome
+    shard_nodes = get_shard_nodes(shards)
+    cuml_counts = tree.get_cumulative_counts(counts)
+    roots = [x for x in rehome_roots if x not in shard_nodes]
+    rehome(tree, cuml_counts, precious, roots=roots)
+    apply(2)
+
+    # Clean up zero-epitope terms
+    cleaned = [root for root, (_, done) in zip(shards, results) if done]
+    shard_nodes = get_shard_nodes(cleaned)
+    cuml_counts = tree.get_cumulative_counts(counts)
+    leaves = [x for x in tree.terms if not tree.children.get(x) and x not in shard_nodes]
+    clean_no_epitopes(tree, cuml_counts, leaves)
+    apply(3)
+    return len(shards)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+import csv
+import mmap
+import sqlite3
+import struct
+import sys
+
+from argparse import ArgumentParser
+from array import array
+from collections.abc import Mapping
+from helpers import get_count_map
+from taxtree import Tree
+
+
+# Binary tree snapshot for handing a stage's tree to the next stage and the browser without
+# re-parsing a database or TSV. The file is memory-mapped read-only, so opening it only reads the
+# header and processes that open the same snapshot share its pages.
+#
+# Layout (all numbers little-endian):
+# - header: magic, version, number of nodes, number of ranks, number of sections
+# - section table: (offset, length) of each section, in SECTIONS order
+# - sections, each aligned to 8 bytes
+# Nodes are numbered by their interned ID in the tree (load order, then new nodes).
+
+MAGIC = b"TAXSNAP\x00"
+VERSION = 1
+HEADER = struct.Struct("<8sIIII")
+SECTION = struct.Struct("<QQ")
+NO_RANK = 0xFFFF
+
+# name -> array type code (None for UTF-8 blobs)
+SECTIONS = {
+    # ID string of each node: offsets into the ID blob (n + 1)
+    "id_offsets": "Q",
+    "id_blob": None,
+    # Node indexes sorted by ID, for binary search
+    "sorted": "i",
+    # Parent index of each node, -1 for no parent
+    "parents": "i",
+    # Children of each node: offsets into the children array (n + 1)
+    "child_offsets": "I",
+    "children": "i",
+    # Rank code of each node, NO_RANK for no rank
+    "ranks": "H",
+    "rank_offsets": "Q",
+    "rank_blob": None,
+    # Own & cumulative epitope counts
+    "counts": "Q",
+    "cumulative_counts": "Q",
+    # Label of each node: offsets into the label blob (n + 1)
+    "label_offsets": "Q",
+    "label_blob": None,
+}
+
+
+def get_blob(strings):
+    """Get the UTF-8 blob and (n + 1) offsets of a list of strings."""
+    offsets = array("Q", [0])
+    parts = []
+    pos = 0
+    for s in strings:
+        b = s.encode("utf-8")
+        parts.append(b)
+        pos += len(b)
+        offsets.append(pos)
+    return offsets, b"".join(parts)
+
+
+def write_snapshot(path, tree, counts):
+    """Write a tree snapshot.
+
+    :param path: path to write to
+    :param tree: Tree to write
+    :param counts: map of ID -> epitope count
+    """
+    # Parents that were not loaded as terms (e.g. outside a trimmed tree) are still nodes
+    nodes = sorted(tree.terms | set(tree.child_parents.values()), key=tree.intern)
+    index = {node: i for i, node in enumerate(nodes)}
+    cuml_counts = tree.get_cumulative_counts(counts)
+
+    id_offsets, id_blob = get_blob(nodes)
+    rank_names = sorted(set(tree.ranks.values()))
+    rank_codes = {rank: i for i, rank in enumerate(rank_names)}
+    rank_offsets, rank_blob = get_blob(rank_names)
+    label_offsets, label_blob = get_blob([tree.labels.get(x, "") for x in nodes])
+
+    child_offsets = array("I", [0])
+    children = array("i")
+    for node in nodes:
+        children.extend(index[x] for x in tree.get_children(node) if x in index)
+        child_offsets.append(len(children))
+
+    sections = {
+        "id_offsets": id_offsets,
+        "id_blob": id_blob,
+        "sorted": array("i", sorted(range(len(nodes)), key=lambda i: nodes[i].encode("utf-8"))),
+        "parents": array("i", [index.get(tree.child_parents.get(x), -1) for x in nodes]),
+        "child_offsets": child_offsets,
+        "children": children,
+        "ranks": array("H", [rank_codes.get(tree.ranks.get(x), NO_RANK) for x in nodes]),
+        "rank_offsets": rank_offsets,
+        "rank_blob": rank_blob,
+        "counts": array("Q", [counts.get(x, 0) for x in nodes]),
+        "cumulative_counts": array("Q", [cuml_counts.get(x, 0) for x in nodes]),
+        "label_offsets": label_offsets,
+        "label_blob": label_blob,
+    }
+
+    with open(path, "wb") as f:
+        pos = HEADER.size + SECTION.size * len(SECTIONS)
+        table = []
+        data = []
+        for name in SECTIONS:
+            b = sections[name]
+            if isinstance(b, array):
+                if sys.byteorder != "little":
+                    b.byteswap()
+                b = b.tobytes()
+            # Align each section to 8 bytes
+            padding = -pos % 8
+            data.append(b"\x00" * padding)
+            pos += padding
+            table.append((pos, len(b)))
+            data.append(b)
+            pos += len(b)
+        f.write(HEADER.pack(MAGIC, VERSION, len(nodes), len(rank_names), len(SECTIONS)))
+        for offset, length in table:
+            f.write(SECTION.pack(offset, length))
+        for b in data:
+            f.write(b)
+
+
+class Snapshot:
+    """Read-only, memory-mapped tree snapshot."""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        magic, version, self.size, self.rank_count, _ = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION or sys.byteorder != "little":
+            raise ValueError(f"{path} is not a version {VERSION} tree snapshot")
+        self.sections = {}
+        for i, (name, typecode) in enumerate(SECTIONS.items()):
+            offset, length = SECTION.unpack_from(self.mmap, HEADER.size + i * SECTION.size)
+            section = self.view[offset : offset + length]
+            self.sections[name] = section.cast(typecode) if typecode else section
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        for section in self.sections.values():
+            section.release()
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+    def get_string(self, offsets, blob, i):
+        return bytes(self.sections[blob][offsets[i] : offsets[i + 1]]).decode("utf-8")
+
+    def get_id(self, i):
+        """Get the ID of a node index."""
+        return self.get_string(self.sections["id_offsets"], "id_blob", i)
+
+    def get_index(self, node):
+        """Get the index of a node ID with a binary search over the sorted IDs, or None."""
+        key = node.encode("utf-8")
+        offsets = self.sections["id_offsets"]
+        blob = self.sections["id_blob"]
+        order = self.sections["sorted"]
+        lo = 0
+        hi = self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = order[mid]
+            value = bytes(blob[offsets[i] : offsets[i + 1]])
+            if value == key:
+                return i
+            if value < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def get_parent(self, node):
+        i = self.get_index(node)
+        if i is None or self.sections["parents"][i] < 0:
+            return None
+        return self.get_id(self.sections["parents"][i])
+
+    def get_children(self, node):
+        """Get the children of a node in the order they appear in the statements table."""
+        i = self.get_index(node)
+        if i is None:
+            return []
+        offsets = self.sections["child_offsets"]
+        children = self.sections["children"]
+        return [self.get_id(c) for c in children[offsets[i] : offsets[i + 1]]]
+
+    def get_ancestors(self, node):
+        """Get the ancestors of a node, from its parent up to the root."""
+        ancestors = []
+        i = self.get_index(node)
+        parents = self.sections["parents"]
+        seen = set()
+        while i is not None and parents[i] >= 0 and parents[i] not in seen:
+            i = parents[i]
+            seen.add(i)
+            ancestors.append(self.get_id(i))
+        return ancestors
+
+    def get_label(self, node):
+        i = self.get_index(node)
+        if i is None:
+            return None
+        return self.get_string(self.sections["label_offsets"], "label_blob", i) or None
+
+    def get_rank(self, node):
+        i = self.get_index(node)
+        if i is None or self.sections["ranks"][i] == NO_RANK:
+            return None
+        return self.get_string(self.sections["rank_offsets"], "rank_blob", self.sections["ranks"][i])
+
+    def get_count(self, node):
+        i = self.get_index(node)
+        return 0 if i is None else self.sections["counts"][i]
+
+    def get_cumulative_count(self, node):
+        i = self.get_index(node)
+        return 0 if i is None else self.sections["cumulative_counts"][i]
+
+    def get_child_parents(self):
+        """Get the child -> parent map of the whole tree, read from the parents section as it is
+        used. Nodes that are their own parent have no parent, like in a child-parents TSV.
+        """
+        return ParentMap(self)
+
+
+class ParentMap(Mapping):
+    """Read-only child -> parent map over the parents section of a snapshot. Lookups are binary
+    searches over the IDs, so no dict of the whole tree is built. The snapshot must stay open
+    while the map is used.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.parents = snapshot.sections["parents"]
+        self.size = None
+
+    def get_parent_index(self, i):
+        p = self.parents[i]
+        return None if p < 0 or p == i else p
+
+    def __getitem__(self, node):
+        i = self.snapshot.get_index(node)
+        p = None if i is None else self.get_parent_index(i)
+        if p is None:
+            raise KeyError(node)
+        return self.snapshot.get_id(p)
+
+    def __iter__(self):
+        for i in range(len(self.parents)):
+            if self.get_parent_index(i) is not None:
+                yield self.snapshot.get_id(i)
+
+    def __len__(self):
+        if self.size is None:
+            parents = range(len(self.parents))
+            self.size = sum(1 for i in parents if self.get_parent_index(i) is not None)
+        return self.size
+
+    def get_cumulative_counts(self, counts):
+        """Get the cumulative epitope counts over the parent and children sections, the same as
+        Tree.get_cumulative_counts.
+
+        :param counts: map of ID -> epitope count
+        :return: map of ID -> cumulative epitope count, for nodes with a count
+        """
+        snapshot = self.snapshot
+        offsets = snapshot.sections["child_offsets"]
+        children = snapshot.sections["children"]
+        # Every node reachable from the roots, parents first
+        order = [
+            i
+            for i in range(len(self.parents))
+            if self.get_parent_index(i) is None and offsets[i + 1] > offsets[i]
+        ]
+        seen = set(order)
+        n = 0
+        while n < len(order):
+            i = order[n]
+            for c in children[offsets[i] : offsets[i + 1]]:
+                if c not in seen:
+                    seen.add(c)
+                    order.append(c)
+            n += 1
+
+        own = {}
+        for node, count in counts.items():
+            i = snapshot.get_index(node)
+            if i is not None and count:
+                own[i] = count
+        cuml_counts = array("Q", bytes(8 * len(self.parents)))
+        for i in reversed(order):
+            count = cuml_counts[i] + own.get(i, 0)
+            cuml_counts[i] = count
+            p = self.get_parent_index(i)
+            if p is not None:
+                cuml_counts[p] += count
+        return {snapshot.get_id(i): cuml_counts[i] for i in order if cuml_counts[i]}
+
+
+def load_child_parents(path):
+    """Load the child -> parent map from a tree snapshot or a child-parents TSV. Nodes that are
+    their own parent are left out.
+
+    :param path: path to a .snap file or TSV
+    :return: map of child -> parent (a ParentMap over the open snapshot for a .snap file)
+    """
+    if path.endswith(".snap"):
+        return Snapshot(path).get_child_parents()
+    child_parents = {}
+    with open(path, "r") as f:
+        reader = csv.reader(f, delimiter="\t")
+        for row in reader:
+            if row[0] == row[1]:
+                continue
+            child_parents[row[0]] = row[1]
+    return child_parents
+
+
+def get_cumulative_counts(child_parents, counts):
+    """Get the cumulative epitope counts of a map from load_child_parents.
+
+    :param child_parents: map of child -> parent
+    :param counts: map of ID -> epitope count
+    :return: map of ID -> cumulative epitope count
+    """
+    if isinstance(child_parents, ParentMap):
+        return child_parents.get_cumulative_counts(counts)
+    return Tree(child_parents).get_cumulative_counts(counts)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Database to get the tree from")
+    parser.add_argument("counts", help="TSV containing ID -> epitope count")
+    parser.add_argument("output", help="Output snapshot")
+    args = parser.parse_args()
+
+    counts = get_count_map(args.counts, header=True)
+
+    with sqlite3.connect(args.db) as conn:
+        tree = Tree.load(conn.cursor())
+    write_snapshot(args.output, tree, counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+
+from argparse import ArgumentParser
+from browser import get_prefixes, render_page
+from gizmos import tree
+from jinja2 import Template
+from typeahead import get_sort_key
+
+
+# Static export of the browser. For each set of databases (the same as the dbs parameter of
+# browser.py) every term page is rendered to {output}/{dbs}/{term}.html, the owl:Class page to
+# index.html, and the labels to a search index (search.json) that the page typeahead loads instead
+# of asking browser.py. The pages then only need a plain file server. Terms are rendered in forked
+# worker processes that share the template and prefix tables; each worker opens its own database
+# connections. Pages are rendered from the src directory with the databases in ../build, the same
+# as browser.py is run.
+
+# Link format for terms in static pages, relative to the page (so a ':' is not read as a scheme)
+STATIC_HREF = "./{curie}.html"
+
+# Terms rendered per task
+CHUNK_SIZE = 100
+
+# State shared with the forked workers
+_state = {}
+
+
+def get_terms(cur):
+    """Get the classes of a database that can be written as pages. Terms added by the stages
+    (e.g. the '-other' nodes) may only have a parent and a label, so any term with a parent counts.
+
+    :param cur: database connection cursor
+    :return: set of term IDs
+    """
+    cur.execute(
+        """SELECT DISTINCT stanza FROM statements
+        WHERE (predicate = 'rdf:type' AND object = 'owl:Class') OR predicate = 'rdfs:subClassOf'"""
+    )
+    # Blank nodes, IRIs and terms with a path separator have no file name
+    return {
+        row[0]
+        for row in cur.fetchall()
+        if row[0] and not row[0].startswith(("_:", "<")) and "/" not in row[0]
+    }
+
+
+def get_search_index(cur, terms):
+    """Get the labels of the given terms for the search index.
+
+    :param cur: database connection cursor
+    :param terms: collection of term IDs to include
+    :return: map of term ID -> label
+    """
+    cur.execute("SELECT subject, value FROM statements WHERE predicate = 'rdfs:label'")
+    return {term: label for term, label in cur.fetchall() if term in terms and label}
+
+
+def render_terms(terms):
+    """Render and write the pages of some terms with the connections of this worker.
+
+    :param terms: list of term IDs
+    :return: number of pages written
+    """
+    dbs = _state["dbs"]
+    if "conns" not in _state:
+        _state["conns"] = {}
+        for db in dbs:
+            conn = sqlite3.connect(os.path.join(_state["build"], f"{db}.db"))
+            conn.row_factory = tree.dict_factory
+            _state["conns"][db] = conn
+    for term in terms:
+        html = render_page(
+            _state["template"],
+            dbs,
+            _state["conns"],
+            _state["prefixes"],
+            term,
+            STATIC_HREF,
+            subtree_href=None,
+            search_index="search.json",
+        )
+        path = "index.html" if term == "owl:Class" else f"{term}.html"
+        with open(os.path.join(_state["output"], path), "w") as f:
+            f.write(html)
+    return len(terms)
+
+
+def export(dbs, output, template, build="../build", jobs=1):
+    """Write the static pages and search index of one set of databases.
+
+    :param dbs: list of browser databases (names in the build directory, without .db)
+    :param output: directory to write the pages to
+    :param template: Jinja template of the page
+    :param build: directory with the databases
+    :param jobs: number of worker processes
+    :return: number of pages written
+    """
+    os.makedirs(output, exist_ok=True)
+    prefixes = {}
+    terms = set()
+    labels = {}
+    for db in dbs:
+        with sqlite3.connect(os.path.join(build, f"{db}.db")) as conn:
+            conn.row_factory = sqlite3.Row
+            cur = conn.cursor()
+            prefixes[db] = get_prefixes(cur)
+            db_terms = get_terms(cur)
+            # The label of a term is the one from the first database that has it
+            for term, label in get_search_index(cur, db_terms).items():
+                labels.setdefault(term, label)
+            terms.update(db_terms)
+        conn.close()
+
+    # Same order as the typeahead results, then by ID
+    entries = [{"id": term, "label": label} for term, label in labels.items()]
+    entries.sort(key=lambda x: (get_sort_key(x), x["id"]))
+    for i, entry in enumerate(entries):
+        entry["order"] = i
+    with open(os.path.join(output, "search.json"), "w") as f:
+        json.dump(entries, f)
+
+    terms = ["owl:Class"] + sorted(terms)
+    chunks = [terms[i : i + CHUNK_SIZE] for i in range(0, len(terms), CHUNK_SIZE)]
+    _state.update(dbs=dbs, output=output, template=template, prefixes=prefixes, build=build)
+    try:
+        if jobs > 1:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(jobs) as pool:
+                return sum(pool.imap_unordered(render_terms, chunks))
+        return sum(render_terms(chunk) for chunk in chunks)
+    finally:
+        for conn in _state.get("conns", {}).values():
+            conn.close()
+        _state.clear()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("output", help="Directory to write the site to")
+    parser.add_argument(
+        "--dbs",
+        action="append",
+        help="Comma-separated browser databases to show side by side (repeat for more page sets)",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    # Render from the src directory, like browser.py
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    with open("index.html.jinja2", "r") as f:
+        template = Template(f.read())
+
+    for dbs in args.dbs or ["new-subspecies-tree-plus"]:
+        count = export(dbs.split(","), os.path.join(output, dbs), template, jobs=args.jobs)
+        print(f"Wrote {count} pages for {dbs}")
+
+
+if __name__ == "__main__":
+    main()
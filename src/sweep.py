@@ -0,0 +1,131 @@
+import csv
+import multiprocessing
+import sqlite3
+import sys
+
+from argparse import ArgumentParser
+from helpers import get_count_map, get_curie
+from prune2 import prune_tree
+from rehome import rehome_and_clean
+from taxtree import Tree
+
+
+# Dry run of the prune and rehome stages for a grid of thresholds. The organized tree is loaded
+# once; each setting runs in its own worker process on a forked copy of it, so the settings do not
+# see each other's changes and nothing is written to a database. One TSV row of tree statistics
+# is printed per setting.
+
+HEADERS = [
+    "Prune Threshold",
+    "Rehome Threshold",
+    "Nodes",
+    "Depth",
+    "Other Nodes",
+    "Largest Fan-out",
+    "Largest Fan-out Node",
+    "Moved Precious",
+]
+
+# State shared with the forked workers
+_state = {}
+
+
+def get_stats(tree, precious):
+    """Get the statistics of a tree after pruning and rehoming.
+
+    :param tree: Tree
+    :param precious: set of taxa to keep
+    :return: nodes, depth, other nodes, largest fan-out, largest fan-out node, moved precious
+    """
+    depths = {}
+    for node in tree.get_topological_order():
+        parent = tree.child_parents.get(node)
+        depths[node] = depths.get(parent, -1) + 1 if parent != node else 0
+    others = sum(1 for x in depths if x.endswith("-other"))
+    fan_out, fan_out_node = 0, None
+    for node in depths:
+        children = len(tree.children.get(node, ()))
+        if children > fan_out:
+            fan_out, fan_out_node = children, node
+    moved = sum(1 for x in tree.get_changes() if x in precious)
+    return len(depths), max(depths.values(), default=0), others, fan_out, fan_out_node, moved
+
+
+def run_setting(thresholds):
+    """Prune and rehome the forked tree with one pair of thresholds.
+
+    :param thresholds: (prune threshold, rehome threshold)
+    :return: row of HEADERS
+    """
+    prune_threshold, rehome_threshold = thresholds
+    tree = _state["tree"]
+    counts = _state["counts"]
+    precious = _state["precious"]
+    prune_tree(tree, tree.get_cumulative_counts(counts), _state["precious_set"], prune_threshold)
+    rehome_and_clean(tree, counts, precious, threshold=rehome_threshold)
+    return [prune_threshold, rehome_threshold, *get_stats(tree, _state["precious_set"])]
+
+
+def sweep(tree, counts, precious, prune_thresholds, rehome_thresholds, jobs=1):
+    """Evaluate every pair of prune and rehome thresholds on copies of a tree.
+
+    :param tree: Tree after organize
+    :param counts: map of ID -> epitope count
+    :param precious: list of taxa to keep
+    :param prune_thresholds: prune thresholds to try
+    :param rehome_thresholds: rehome thresholds to try
+    :param jobs: number of worker processes
+    :return: list of rows of HEADERS, in grid order
+    """
+    settings = [(p, r) for p in prune_thresholds for r in rehome_thresholds]
+    # Build the indexes once, before forking
+    tree.get_precious_index(precious)
+    _state.update(tree=tree, counts=counts, precious=precious, precious_set=set(precious))
+    try:
+        # Each worker runs one setting, so each setting starts from a fresh fork of the tree
+        context = multiprocessing.get_context("fork")
+        with context.Pool(jobs, maxtasksperchild=1) as pool:
+            return pool.map(run_setting, settings, chunksize=1)
+    finally:
+        _state.clear()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="Organized database (e.g. build/ncbi-organized.db)")
+    parser.add_argument("precious", help="List of taxa to keep")
+    parser.add_argument("counts", help="TSV containing ID -> epitope count")
+    parser.add_argument(
+        "--prune",
+        type=lambda x: [float(t) for t in x.split(",")],
+        default=[0.95, 0.98, 0.99, 0.995],
+        help="Comma-separated prune thresholds",
+    )
+    parser.add_argument(
+        "--rehome",
+        type=lambda x: [float(t) for t in x.split(",")],
+        default=[0.005, 0.01, 0.02, 0.05],
+        help="Comma-separated rehome thresholds",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+
+    precious = []
+    with open(args.precious, "r") as f:
+        reader = csv.reader(f, delimiter="\t")
+        for row in reader:
+            precious.append(get_curie(row[0]))
+
+    counts = get_count_map(args.counts, header=True)
+
+    with sqlite3.connect(args.db) as conn:
+        tree = Tree.load(conn.cursor())
+    rows = sweep(tree, counts, precious, args.prune, args.rehome, jobs=args.jobs)
+
+    writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+    writer.writerow(HEADERS)
+    writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+from collections import defaultdict, namedtuple
+from itertools import chain
+from helpers import get_curie
+
+
+# Summary of the descendants of one node:
+# - precious: top-most precious descendants (precious nodes under another precious descendant
+#   are left out, they move along with it)
+# Rank queries over a subtree use the RankIndex instead (see Tree.get_at_rank).
+Summary = namedtuple("Summary", ["precious"])
+
+
+class Tree:
+    """In-memory snapshot of the rdfs:subClassOf hierarchy of a statements table.
+
+    Stages read and rewire the tree in memory, then write the final child -> parent changes (and
+    any new 'other' nodes) back to the database in one bulk write.
+    """
+
+    def __init__(
+        self, child_parents, labels=None, ranks=None, terms=None, order=None, classes=None
+    ):
+        # child -> parent
+        self.child_parents = dict(child_parents)
+        # child -> parent as loaded, used to find the edges that changed
+        self.original = dict(child_parents)
+        # parent -> children (dict as ordered set)
+        self.children = defaultdict(dict)
+        for child, parent in self.child_parents.items():
+            self.children[parent][child] = None
+        self.labels = dict(labels or {})
+        self.ranks = dict(ranks or {})
+        self.rank_index = RankIndex(self.ranks)
+        self.terms = set(terms or ()) | set(self.child_parents.keys()) | set(self.labels.keys())
+        # terms with rdf:type owl:Class
+        self.classes = set(classes or ())
+        # term -> load position, so that children are returned in table order
+        # This is also the interned ID of the term, new terms are numbered after the loaded ones
+        self.order = dict(order or {})
+        for term in chain(self.child_parents, self.labels, sorted(self.terms)):
+            self.intern(term)
+        # new 'other' node -> label
+        self.created = {}
+        # SubtreeSummaries for the current precious set
+        self.summaries = None
+        # PreciousIndex for the current precious set
+        self.precious_index = None
+
+    @classmethod
+    def load(cls, cur):
+        """Load the hierarchy, labels and ranks from a statements table in one scan.
+
+        :param cur: database connection cursor
+        :return: Tree
+        """
+        cur.execute(
+            """SELECT stanza, predicate, object, value FROM statements
+            WHERE subject = stanza
+              AND predicate IN
+                ('rdf:type', 'rdfs:subClassOf', 'rdfs:label', 'ncbitaxon:has_rank')"""
+        )
+        child_parents = {}
+        labels = {}
+        ranks = {}
+        order = {}
+        classes = set()
+        for stanza, predicate, obj, value in cur:
+            if stanza not in order:
+                order[stanza] = len(order)
+            if predicate == "rdf:type":
+                if obj == "owl:Class":
+                    classes.add(stanza)
+            elif predicate == "rdfs:subClassOf":
+                if obj and not obj.startswith("_:"):
+                    child_parents[stanza] = obj
+            elif predicate == "rdfs:label":
+                if stanza not in labels:
+                    labels[stanza] = value
+            elif stanza not in ranks:
+                ranks[stanza] = obj
+        return cls(
+            child_parents,
+            labels=labels,
+            ranks=ranks,
+            terms=order.keys(),
+            order=order,
+            classes=classes,
+        )
+
+    def intern(self, node):
+        """Get the interned ID of a node, numbering it after all known nodes if it is new."""
+        node_id = self.order.get(node)
+        if node_id is None:
+            node_id = len(self.order)
+            self.order[node] = node_id
+        return node_id
+
+    def get_parent(self, node):
+        return self.child_parents.get(node)
+
+    def get_children(self, node):
+        """Get the direct children of a node in the order they appear in the statements table."""
+        children = self.children.get(node)
+        if not children:
+            return []
+        return sorted(children, key=lambda x: self.order.get(x, len(self.order)))
+
+    def get_child_ranks(self, node):
+        """Get the rank histogram of the direct children of a node.
+
+        :param node: node to get child ranks of
+        :return: map of rank -> number of children with that rank
+        """
+        return self.rank_index.get_histogram(self.children.get(node, ()))
+
+    def get_at_rank(self, node, rank):
+        """Get a node and all of its descendants with the given rank (e.g. NCBITaxon:species), in
+        the same order as the ranks from helpers.get_descendants_and_ranks.
+
+        :param node: node to start from
+        :param rank: rank CURIE
+        :return: list of nodes with the rank
+        """
+        code = self.rank_index.codes.get(rank)
+        if code is None:
+            return []
+        node_codes = self.rank_index.node_codes
+        at_rank = []
+        stack = [node]
+        seen = set()
+        while stack:
+            n = stack.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            if node_codes.get(n) == code:
+                at_rank.append(n)
+            stack.extend(self.children.get(n, ()))
+        return at_rank
+
+    def get_ancestors(self, node, limit):
+        """Get the ancestors of a node below a limit, closest first, the same as
+        helpers.get_all_ancestors over the descendants of the limit: a node that is not under the
+        limit has none.
+
+        :param node: node to start from
+        :param limit: ancestor to stop at (not included)
+        :return: list of ancestors
+        """
+        ancestors = []
+        seen = {node}
+        parent = self.child_parents.get(node)
+        while parent != limit:
+            if parent is None or parent in seen:
+                return []
+            seen.add(parent)
+            ancestors.append(parent)
+            parent = self.child_parents.get(parent)
+        return ancestors
+
+    def get_leaves(self):
+        """Get all classes without children."""
+        return [x for x in self.classes if not self.children.get(x)]
+
+    def get_roots(self):
+        """Get all nodes that have children but no parent (or are their own parent)."""
+        return [x for x, c in self.children.items() if c and self.child_parents.get(x, x) == x]
+
+    def get_topological_order(self, roots=None):
+        """Get all nodes reachable from the roots (default all roots of the tree), with every
+        parent before its children.
+        """
+        if roots is None:
+            roots = self.get_roots()
+        order = list(roots)
+        seen = set(order)
+        i = 0
+        while i < len(order):
+            for child in self.children.get(order[i], ()):
+                if child not in seen:
+                    seen.add(child)
+                    order.append(child)
+            i += 1
+        return order
+
+    def get_cumulative_counts(self, counts, roots=None):
+        """Get the cumulative epitope counts for all nodes in one bottom-up pass.
+
+        :param counts: map of ID -> epitope count
+        :param roots: only count the subtrees of these nodes (default the whole tree)
+        :return: map of ID -> cumulative epitope count
+        """
+        roots = set(roots or ())
+        cuml_counts = {}
+        for node in reversed(self.get_topological_order(roots or None)):
+            count = cuml_counts.get(node, 0) + counts.get(node, 0)
+            cuml_counts[node] = count
+            parent = self.child_parents.get(node)
+            if parent is not None and parent != node and node not in roots:
+                cuml_counts[parent] = cuml_counts.get(parent, 0) + count
+        return cuml_counts
+
+    def get_descendants(self, node, limits=None):
+        """Get descendants of a node, the same as helpers.get_descendants.
+
+        When a child is in limits, the rest of its siblings are skipped.
+        """
+        if not limits:
+            limits = ()
+        descendants = []
+        seen = set()
+
+        def walk(n):
+            if n in seen:
+                return
+            seen.add(n)
+            for child in self.get_children(n):
+                if child in limits:
+                    return
+                descendants.append(child)
+                walk(child)
+
+        walk(node)
+        return descendants
+
+    def get_summaries(self, precious):
+        """Get the subtree summaries for a precious set. The summaries are kept up to date as
+        nodes are moved, so one precious set can be queried over a whole stage.
+
+        :param precious: set of taxa to keep
+        :return: SubtreeSummaries
+        """
+        if self.summaries is None or self.summaries.precious is not precious:
+            self.summaries = SubtreeSummaries(self, precious)
+        return self.summaries
+
+    def get_precious_index(self, precious):
+        """Get the precious index for a precious set, building it if this is a new set. Passing an
+        index returns it unchanged.
+
+        :param precious: collection of taxa to keep, or a PreciousIndex
+        :return: PreciousIndex
+        """
+        if isinstance(precious, PreciousIndex):
+            return precious
+        if self.precious_index is None or self.precious_index.source is not precious:
+            self.precious_index = PreciousIndex(self, precious)
+        return self.precious_index
+
+    def move(self, node, parent):
+        """Move a node under a new parent. Nodes without a parent are not moved, the same as an
+        UPDATE on their (missing) rdfs:subClassOf statement.
+        """
+        old_parent = self.child_parents.get(node)
+        if old_parent is None or old_parent == parent:
+            return
+        if self.summaries:
+            self.summaries.invalidate(old_parent)
+            self.summaries.invalidate(parent)
+        if self.precious_index:
+            self.precious_index.remove_edge(node, old_parent)
+        del self.children[old_parent][node]
+        self.child_parents[node] = parent
+        self.children[parent][node] = None
+        if self.precious_index:
+            self.precious_index.add_edge(node, parent)
+
+    def move_all(self, nodes, parent):
+        for node in nodes:
+            self.move(node, parent)
+
+    def create_other(self, parent_tax, parent_label):
+        """Create an 'other' node under a parent if it does not exist, the same as
+        helpers.create_other.
+
+        :param parent_tax: parent tax ID (without prefix)
+        :param parent_label: parent label
+        :return: ID of the 'other' node
+        """
+        other_id = f"iedb-taxon:{parent_tax}-other"
+        if other_id in self.terms:
+            return other_id
+        self.add_node(other_id, get_curie(parent_tax), "Other " + parent_label)
+        return other_id
+
+    def add_node(self, node, parent, label):
+        """Add a new node with a label under a parent. The node is written with Tree.write."""
+        self.terms.add(node)
+        self.intern(node)
+        self.labels[node] = label
+        self.created[node] = label
+        self.child_parents[node] = parent
+        self.children[parent][node] = None
+        if self.summaries:
+            self.summaries.invalidate(parent)
+        if self.precious_index:
+            self.precious_index.add_edge(node, parent)
+
+    def get_changes(self):
+        """Get the child -> new parent map for all loaded nodes whose parent changed."""
+        return {
+            child: parent
+            for child, parent in self.child_parents.items()
+            if child not in self.created and self.original.get(child) != parent
+        }
+
+    def pop_changes(self):
+        """Get the new nodes and changed edges since the tree was loaded (or the last call), and
+        track changes from the current state on.
+
+        :return: map of new node -> (parent, label), map of child -> new parent
+        """
+        created = {x: (self.child_parents[x], label) for x, label in self.created.items()}
+        changes = self.get_changes()
+        self.original = dict(self.child_parents)
+        self.created = {}
+        return created, changes
+
+    def apply_changes(self, created, changes):
+        """Apply new nodes and changed edges from Tree.pop_changes on another copy of the tree.
+
+        :param created: map of new node -> (parent, label)
+        :param changes: map of child -> new parent
+        """
+        for node, (parent, label) in created.items():
+            self.add_node(node, parent, label)
+        for node, parent in changes.items():
+            self.move(node, parent)
+
+    def write(self, cur):
+        """Write the new 'other' nodes and all changed edges back to the statements table.
+
+        :param cur: database connection cursor
+        :return: number of changed edges
+        """
+        created, changes = self.pop_changes()
+        cur.executemany(
+            """INSERT INTO statements (stanza, subject, predicate, object, value) VALUES
+            (?, ?, 'rdfs:subClassOf', ?, null)""",
+            [(x, x, parent) for x, (parent, _) in created.items()],
+        )
+        cur.executemany(
+            """INSERT INTO statements (stanza, subject, predicate, object, value) VALUES
+            (?, ?, 'rdfs:label', null, ?)""",
+            [(x, x, label) for x, (_, label) in created.items()],
+        )
+        cur.execute("CREATE TEMP TABLE moves (child TEXT PRIMARY KEY, parent TEXT)")
+        cur.executemany("INSERT INTO moves VALUES (?, ?)", changes.items())
+        cur.execute(
+            """UPDATE statements
+            SET object = (SELECT parent FROM moves WHERE child = statements.subject)
+            WHERE predicate = 'rdfs:subClassOf' AND subject IN (SELECT child FROM moves)"""
+        )
+        cur.execute("DROP TABLE moves")
+        return len(changes)
+
+
+class RankIndex:
+    """Ranks of all nodes interned as small integer codes, with the set of nodes of each rank.
+    The index is built once when a stage loads its tree; ranks do not change within a stage.
+    """
+
+    def __init__(self, ranks=None):
+        # code -> rank CURIE
+        self.names = []
+        # rank CURIE -> code
+        self.codes = {}
+        # node -> code
+        self.node_codes = {}
+        # code -> set of nodes
+        self.members = []
+        for node, rank in (ranks or {}).items():
+            self.add(node, rank)
+
+    def intern(self, rank):
+        code = self.codes.get(rank)
+        if code is None:
+            code = len(self.names)
+            self.codes[rank] = code
+            self.names.append(rank)
+            self.members.append(set())
+        return code
+
+    def add(self, node, rank):
+        code = self.intern(rank)
+        self.node_codes[node] = code
+        self.members[code].add(node)
+
+    def get(self, node):
+        """Get the rank CURIE of a node, or None."""
+        code = self.node_codes.get(node)
+        if code is None:
+            return None
+        return self.names[code]
+
+    def get_nodes(self, rank):
+        """Get all nodes with the given rank."""
+        code = self.codes.get(rank)
+        if code is None:
+            return set()
+        return self.members[code]
+
+    def get_histogram(self, nodes):
+        """Get the number of nodes of each rank in a collection of nodes (unranked nodes are not
+        counted).
+
+        :param nodes: nodes to count
+        :return: map of rank CURIE -> count
+        """
+        counts = [0] * len(self.names)
+        for node in nodes:
+            code = self.node_codes.get(node)
+            if code is not None:
+                counts[code] += 1
+        return {self.names[code]: count for code, count in enumerate(counts) if count}
+
+
+class PreciousIndex:
+    """Precious set of a Tree as a membership bitmap keyed by interned node ID, with the number of
+    precious descendants of every node. The counts are kept up to date as nodes are moved, so
+    "has a precious descendant" is one lookup.
+
+    The index can be used in place of the precious set: it supports `in` and intersection.
+    """
+
+    def __init__(self, tree, precious):
+        self.tree = tree
+        # The collection this index was built from
+        self.source = precious
+        # Precious taxa that are not in the tree (yet), e.g. 'other' nodes that a stage creates
+        # later: they get their bit when they are added
+        self.missing = set()
+        self.bits = bytearray(len(tree.order))
+        for node in precious:
+            node_id = tree.order.get(node)
+            if node_id is None:
+                self.missing.add(node)
+            else:
+                self.bits[node_id] = 1
+        # node ID -> number of precious descendants
+        self.counts = [0] * len(tree.order)
+        for node in reversed(tree.get_topological_order()):
+            count = self.get_weight(node)
+            if not count:
+                continue
+            parent = tree.child_parents.get(node)
+            if parent is not None:
+                self.counts[self.get_id(parent)] += count
+
+    def __contains__(self, node):
+        node_id = self.tree.order.get(node)
+        if node_id is not None and node_id < len(self.bits) and self.bits[node_id] == 1:
+            return True
+        return node in self.missing
+
+    def get_id(self, node):
+        node_id = self.tree.intern(node)
+        if node_id >= len(self.bits):
+            # New nodes (e.g. 'other' nodes) are never precious unless they were in the source
+            grow = node_id + 1 - len(self.bits)
+            self.bits.extend(bytes(grow))
+            self.counts.extend([0] * grow)
+        if node in self.missing:
+            self.missing.discard(node)
+            self.bits[node_id] = 1
+        return node_id
+
+    def get_weight(self, node):
+        """Get the number of precious nodes in the subtree of a node, including the node."""
+        node_id = self.get_id(node)
+        return self.counts[node_id] + self.bits[node_id]
+
+    def intersection(self, nodes):
+        return {x for x in nodes if x in self}
+
+    def has_precious_descendant(self, node):
+        return self.counts[self.get_id(node)] > 0
+
+    def get_precious_ancestor(self, node, limit=None):
+        """Get the closest precious ancestor of a node below the limit, or None."""
+        seen = set()
+        node = self.tree.child_parents.get(node)
+        while node is not None and node != limit and node not in seen:
+            if node in self:
+                return node
+            seen.add(node)
+            node = self.tree.child_parents.get(node)
+        return None
+
+    def update_ancestors(self, node, diff):
+        seen = set()
+        while node is not None and node not in seen:
+            seen.add(node)
+            self.counts[self.get_id(node)] += diff
+            node = self.tree.child_parents.get(node)
+
+    def add_edge(self, node, parent):
+        weight = self.get_weight(node)
+        if weight:
+            self.update_ancestors(parent, weight)
+
+    def remove_edge(self, node, parent):
+        weight = self.get_weight(node)
+        if weight:
+            self.update_ancestors(parent, -weight)
+
+
+class SubtreeSummaries:
+    """Cache of per-subtree summaries of a Tree for one precious set.
+
+    Summaries are computed in one post-order pass over the subtree of the first node that is asked
+    for. A moved edge only changes the summaries of the ancestors of the old and new parent, so
+    only those are dropped; everything else stays cached for the rest of the stage.
+    """
+
+    def __init__(self, tree, precious):
+        self.tree = tree
+        self.precious = precious
+        # node -> Summary
+        self.summaries = {}
+
+    def get(self, node):
+        """Get the summary of the descendants of a node.
+
+        :param node: node to summarize
+        :return: Summary
+        """
+        summary = self.summaries.get(node)
+        if summary is not None:
+            return summary
+
+        # Post-order walk over the part of the subtree that is not cached yet
+        children = self.tree.children
+        stack = [(node, False)]
+        on_stack = set()
+        while stack:
+            n, closed = stack.pop()
+            if not closed:
+                if n in self.summaries or n in on_stack:
+                    continue
+                on_stack.add(n)
+                stack.append((n, True))
+                stack.extend((c, False) for c in children.get(n, ()) if c not in self.summaries)
+                continue
+            precious = set()
+            for c in children.get(n, ()):
+                # Missing only when the child is on a cycle back to this node
+                child_summary = self.summaries.get(c)
+                if c in self.precious:
+                    precious.add(c)
+                elif child_summary:
+                    precious.update(child_summary.precious)
+            self.summaries[n] = Summary(frozenset(precious))
+        return self.summaries[node]
+
+    def get_precious_descendants(self, node):
+        """Get the top-most precious descendants of a node."""
+        return self.get(node).precious
+
+    def invalidate(self, node):
+        """Drop the summaries of a node and all of its ancestors. A node is only cached when all of
+        its descendants are, so the walk stops at the first node that is not cached.
+        """
+        while node in self.summaries:
+            del self.summaries[node]
+            node = self.tree.child_parents.get(node)
@@ -5,6 +5,7 @@ import logging
 import sqlite3
 
 from argparse import ArgumentParser
+from edges import add_edge_tables
 from helpers import get_curie
 
 
@@ -32,115 +33,124 @@ def add_iedb_taxa(cur, iedb_taxa):
                 )
 
 
-def main():
-    parser = ArgumentParser()
-    parser.add_argument("db", help="NCBITaxon database")
-    parser.add_argument("active_taxa", help="Active tax IDs used in IEDB")
-    parser.add_argument("iedb_taxa", help="IEDB custom taxa")
-    parser.add_argument("output", help="Output database")
-    args = parser.parse_args()
+def trim(cur, cur_new, active_taxa, iedb_taxa):
+    """Copy the active taxa and their ancestors to a new statements table and add the IEDB taxa.
 
+    :param cur: NCBITaxon database cursor
+    :param cur_new: output database cursor
+    :param active_taxa: path to active tax IDs used in IEDB
+    :param iedb_taxa: path to IEDB custom taxa
+    """
     weights = {}
-    with sqlite3.connect(args.db) as conn:
-        cur = conn.cursor()
+    cur.execute(
+        """SELECT DISTINCT stanza FROM statements
+        WHERE stanza LIKE 'iedb-taxon:%' OR stanza LIKE 'NCBITaxon:%'"""
+    )
+    for row in cur.fetchall():
+        tax_id = row[0]
+        try:
+            int(tax_id.split(":")[1])
+        except ValueError:
+            # Not a tax ID
+            continue
+        weights[tax_id] = 0
+
+    active_tax_ids = set()
+    with open(active_taxa, "r") as f:
+        for line in f:
+            tax_id = get_curie(line.strip())
+            active_tax_ids.add(tax_id)
+
+    # Add the parents of IEDB taxa
+    with open(iedb_taxa, "r") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            for pid in row["Parent IDs"].split("|"):
+                active_tax_ids.add(get_curie(pid))
+
+    # print(f"Retrieving ancestors for {len(active_tax_ids)} active taxa...")
+
+    for act_tax in active_tax_ids:
+        weights[act_tax] = 1
         cur.execute(
-            """SELECT DISTINCT stanza FROM statements
-            WHERE stanza LIKE 'iedb-taxon:%' OR stanza LIKE 'NCBITaxon:%'"""
+            """WITH RECURSIVE active(node) AS (
+            VALUES (?)
+            UNION
+            SELECT parent AS node
+            FROM edges
+            WHERE parent = ?
+            UNION
+            SELECT edges.parent AS node
+            FROM edges, active
+            WHERE active.node = edges.child
+          )
+          SELECT * FROM active""",
+            (act_tax, act_tax),
         )
         for row in cur.fetchall():
-            tax_id = row[0]
-            try:
-                int(tax_id.split(":")[1])
-            except ValueError:
-                # Not a tax ID
+            parent_id = row[0]
+            if parent_id == act_tax:
                 continue
-            weights[tax_id] = 0
-
-        active_tax_ids = set()
-        with open(args.active_taxa, "r") as f:
-            for line in f:
-                tax_id = get_curie(line.strip())
-                active_tax_ids.add(tax_id)
+            weights[parent_id] = 1
+
+    active_nodes = [x for x, y in weights.items() if y > 0]
+    # print(f"Filtering for {len(active_nodes)} active nodes...")
+
+    # use f-string because we don't know how many values we have
+    active_nodes = ", ".join([f"'{x}'" for x in active_nodes])
+    cur.execute(
+        f"""SELECT stanza, subject, predicate, object, value, datatype, language
+        FROM statements WHERE stanza IN ({active_nodes})"""
+    )
+    insert = []
+    for r in cur.fetchall():
+        vals = []
+        for itm in r:
+            if not itm:
+                vals.append("null")
+            else:
+                itm = itm.replace("'", "''")
+                vals.append(f"'{itm}'")
+        insert.append(", ".join(vals))
+    insert = ", ".join([f"({x})" for x in insert])
+
+    # print(f"Adding {len(rows)} stanzas to new database...")
+    cur_new.execute(
+        """CREATE TABLE statements (stanza TEXT,
+                                    subject TEXT,
+                                    predicate TEXT,
+                                    object TEXT,
+                                    value TEXT,
+                                    datatype TEXT,
+                                    language TEXT)"""
+    )
+    cur_new.execute("INSERT INTO statements VALUES " + insert)
+    add_edge_tables(cur_new)
+
+    # Add the IEDB taxa
+    add_iedb_taxa(cur_new, iedb_taxa)
+
+    # Check for active taxa not in database
+    cur_new.execute("SELECT DISTINCT stanza FROM statements WHERE object = 'owl:Class'")
+    existing_ids = set([x[0] for x in cur_new.fetchall()])
+    missing = set(active_tax_ids) - existing_ids
+    if missing:
+        logging.error(
+            f"{len(missing)} active taxa missing from NCBITaxonomy:\n- "
+            + "\n- ".join(missing)
+        )
 
-        # Add the parents of IEDB taxa
-        with open(args.iedb_taxa, "r") as f:
-            reader = csv.DictReader(f, delimiter="\t")
-            for row in reader:
-                for pid in row["Parent IDs"].split("|"):
-                    active_tax_ids.add(get_curie(pid))
 
-        # print(f"Retrieving ancestors for {len(active_tax_ids)} active taxa...")
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="NCBITaxon database")
+    parser.add_argument("active_taxa", help="Active tax IDs used in IEDB")
+    parser.add_argument("iedb_taxa", help="IEDB custom taxa")
+    parser.add_argument("output", help="Output database")
+    args = parser.parse_args()
 
-        for act_tax in active_tax_ids:
-            weights[act_tax] = 1
-            cur.execute(
-                """WITH RECURSIVE active(node) AS (
-                VALUES (?)
-                UNION
-                 SELECT object AS node
-                FROM statements
-                WHERE predicate = 'rdfs:subClassOf'
-                  AND object = ?
-                UNION
-                SELECT object AS node
-                FROM statements, active
-                WHERE active.node = statements.stanza
-                  AND statements.predicate = 'rdfs:subClassOf'
-                  AND statements.object NOT LIKE '_:%'
-              )
-              SELECT * FROM active""",
-                (act_tax, act_tax),
-            )
-            for row in cur.fetchall():
-                parent_id = row[0]
-                if parent_id == act_tax:
-                    continue
-                weights[parent_id] = 1
-
-        active_nodes = [x for x, y in weights.items() if y > 0]
-        # print(f"Filtering for {len(active_nodes)} active nodes...")
-
-        # use f-string because we don't know how many values we have
-        active_nodes = ", ".join([f"'{x}'" for x in active_nodes])
-        cur.execute(f"SELECT * FROM statements WHERE stanza IN ({active_nodes})")
-        insert = []
-        for r in cur.fetchall():
-            vals = []
-            for itm in r:
-                if not itm:
-                    vals.append("null")
-                else:
-                    itm = itm.replace("'", "''")
-                    vals.append(f"'{itm}'")
-            insert.append(", ".join(vals))
-        insert = ", ".join([f"({x})" for x in insert])
-
-        # print(f"Adding {len(rows)} stanzas to new database...")
-        with sqlite3.connect(args.output) as conn_new:
-            cur_new = conn_new.cursor()
-            cur_new.execute(
-                """CREATE TABLE statements (stanza TEXT,
-                                            subject TEXT,
-                                            predicate TEXT,
-                                            object TEXT,
-                                            value TEXT,
-                                            datatype TEXT,
-                                            language TEXT)"""
-            )
-            cur_new.execute("INSERT INTO statements VALUES " + insert)
-
-            # Add the IEDB taxa
-            add_iedb_taxa(cur_new, args.iedb_taxa)
-
-            # Check for active taxa not in database
-            cur_new.execute("SELECT DISTINCT stanza FROM statements WHERE object = 'owl:Class'")
-            existing_ids = set([x[0] for x in cur_new.fetchall()])
-            missing = set(active_tax_ids) - existing_ids
-            if missing:
-                logging.error(
-                    f"{len(missing)} active taxa missing from NCBITaxonomy:\n- "
-                    + "\n- ".join(missing)
-                )
+    with sqlite3.connect(args.db) as conn, sqlite3.connect(args.output) as conn_new:
+        trim(conn.cursor(), conn_new.cursor(), args.active_taxa, args.iedb_taxa)
 
 
 if __name__ == "__main__":
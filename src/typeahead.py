@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import json
+import os
+import urllib.parse
+
+
+# CGI entry point for the browser typeahead (?dbs=x,y,z&text=foo). Each keystroke starts a new
+# interpreter, so this module only imports the standard library; gizmos.search is imported when a
+# search runs, and the page rendering modules (gizmos.hiccup, gizmos.tree, jinja2) never are.
+# `make typeahead_budget` checks the import cost.
+
+# Number of results to return
+LIMIT = 20
+
+
+def get_sort_key(result):
+    """Get the sort key of a search result: longest label first, then by label. The static
+    search index (static.py) uses the same order.
+
+    :param result: {"id", "label", ...} result
+    :return: sort key
+    """
+    return -len(result["label"]), result["label"]
+
+
+def search(dbs, text):
+    """Search the labels of each database, longest matches first (then by label).
+
+    :param dbs: list of browser databases
+    :param text: search text
+    :return: list of {"id", "label", ...} results
+    """
+    from gizmos.search import search as search_db
+
+    results = []
+    for db in dbs:
+        results.extend(json.loads(search_db(f"../build/{db}.db", text)))
+    # Sort by length (longest first) & name and take the first LIMIT results
+    results = sorted(results, key=lambda i: i["label"])
+    return sorted(results, key=get_sort_key)[:LIMIT]
+
+
+def main():
+    args = dict(urllib.parse.parse_qsl(os.environ.get("QUERY_STRING", "")))
+    results = []
+    if args.get("dbs") and args.get("text"):
+        results = search(args["dbs"].split(","), urllib.parse.unquote(args["text"]))
+    print("Content-Type: application/json")
+    print("")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()